@@ -9,15 +9,54 @@ DEFAULT_METATAB_FILE = 'metadata.csv'
 LINES_METATAB_FILE = 'metadata.txt'
 IPYNB_METATAB_FILE = 'metadata.ipynb'
 
-from .parser import *
 from .exc import *
-from .doc import MetatabDoc
-from .resolver import WebResolver
-
-from pkg_resources import get_distribution, DistributionNotFound
-try:
-    __version__ = get_distribution(__name__).version
-except DistributionNotFound:
-    # package is not installed
-    pass
+
+# The parser, document and resolver modules import rowgenerators, which is slow to import, so they are loaded
+# on first access to one of their names, rather than when the package is imported.
+_lazy_names = {
+    'MetatabDoc': 'metatab.doc',
+    'WebResolver': 'metatab.resolver',
+    'MirrorResolver': 'metatab.resolver',
+}
+
+# Names from the parser module, which used to be imported with *
+_parser_names = ('TermParser', 'DeclaredTerm', 'Term', 'SectionTerm', 'RootSectionTerm', 'ROOT_TERM', 'ELIDED_TERM',
+                 'METATAB_ASSETS_URL', 'error_summary', 'parse_app_url', 'get_generator')
+
+__all__ = ['DEFAULT_METATAB_FILE', 'LINES_METATAB_FILE', 'IPYNB_METATAB_FILE',
+           'MetatabError', 'ReferenceError', 'ParserError', 'IncludeError', 'DeclarationError', 'GenerateError',
+           'ConversionError', 'FormatError', 'ServerError'] + list(_lazy_names) + list(_parser_names)
+
+
+def __getattr__(name):
+    from importlib import import_module
+
+    if name == '__version__':
+        try:
+            from importlib.metadata import version, PackageNotFoundError
+        except ImportError:  # Python < 3.8
+            from importlib_metadata import version, PackageNotFoundError
+
+        try:
+            v = version(__name__)
+        except PackageNotFoundError:
+            # package is not installed, as when running from a source checkout
+            v = '0+unknown'
+
+    elif name in _lazy_names:
+        v = getattr(import_module(_lazy_names[name]), name)
+
+    elif not name.startswith('_'):
+        # Names exported from the parser module, including the ones that aren't in _parser_names
+        try:
+            v = getattr(import_module('metatab.parser'), name)
+        except AttributeError:
+            raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    else:
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    globals()[name] = v
+
+    return v
 
@@ -5,18 +5,46 @@
 
 """
 
+import threading
+from collections import OrderedDict
 from metatab import DEFAULT_METATAB_FILE
-from os.path import basename, join
+from os.path import basename, exists, join
 from rowgenerators import Url
 from rowgenerators.appurl.file.file import InnerFile
 from rowgenerators.appurl.util import file_ext
 from rowgenerators.appurl.web.web import WebUrl
 
+# Resolved resource and target urls, keyed by the canonical url string and the downloader cache. Shared
+# between MetatabUrl instances, so that urls that are parsed repeatedly, such as includes, are only resolved once.
+_resolved = OrderedDict()
+_resolved_lock = threading.Lock()
+RESOLVED_CACHE_SIZE = 256
+
+
+def clear_resolved():
+    """Clear the cache of resolved MetatabUrls"""
+    with _resolved_lock:
+        _resolved.clear()
+
+
+def _cache_identity(cache):
+    """Return a key for a downloader cache that stays the same for the same cache directory. Caches without a
+    system path are their own key, which keeps them alive, so their ids can't be reused by another cache"""
+
+    if cache is not None and cache.hassyspath('/'):
+        return cache.getsyspath('/')
+
+    return cache
+
+
 class MetatabUrl(InnerFile, Url):
     match_priority = WebUrl.match_priority - 1
 
     simple_file_formats = ('csv', 'txt', 'ipynb')
 
+    _resource_memo = None
+    _target_memo = None
+
     def __init__(self, url=None, downloader=None, **kwargs):
         kwargs['proto'] = 'metatab'
 
@@ -92,6 +120,12 @@ class MetatabUrl(InnerFile, Url):
     def doc(self):
         """Return the metatab document for the URL"""
         from metatab import MetatabDoc
+
+        g = self.archive_generator()
+
+        if g is not None:
+            return MetatabDoc(g, package_url=self)
+
         t = self.get_resource().get_target()
         return MetatabDoc(t.inner)
 
@@ -100,6 +134,11 @@ class MetatabUrl(InnerFile, Url):
 
         from rowgenerators import get_generator
 
+        g = self.archive_generator()
+
+        if g is not None:
+            return g
+
         ##
         ## Hack! This used to be
         ## target = self.get_resource().get_target().inner
@@ -108,22 +147,79 @@ class MetatabUrl(InnerFile, Url):
 
         return get_generator(target)
 
-    def get_resource(self):
+    def archive_generator(self):
+        """For a local ZIP or Excel package, return a row generator that reads the metadata directly from
+        the archive, skipping resource and target resolution. Returns None for other URLs. """
+        from os.path import exists
+        from metatab.rowgen import ZipMetadataSource, XlsxMetadataSource
+
+        if self.scheme != 'file' or self.resource_format not in ('zip', 'xlsx'):
+            return None
+
+        path = str(self.fspath)
+
+        if not exists(path):
+            return None
 
-        if self.scheme == 'file':
-            u = self
+        if self.resource_format == 'zip':
+            return ZipMetadataSource(path, member=self.target_file)
         else:
-            u = WebUrl(str(self), downloader=self._downloader).get_resource()
+            return XlsxMetadataSource(path, sheet=self.target_file)
 
-        return MetatabUrl(str(u), downloader=self._downloader)
+    def _resolve(self, kind, f):
+        """Return a copy of a resolved url, from the instance memo or the shared cache, calling f() to resolve it
+        if neither has a valid entry. Entries are valid while the files they refer to, which for remote urls
+        are entries in the downloader's cache, still exist. Copies are returned, since urls are mutable. """
+
+        memo_attr = '_' + kind + '_memo'
+        key = (kind, str(self), _cache_identity(self._downloader.cache))
+
+        memo = getattr(self, memo_attr)
+
+        if memo is not None and memo[0] == key and self._resolved_exists(memo[1]):
+            return memo[1].clone()
+
+        with _resolved_lock:
+            u = _resolved.get(key)
+
+            if u is not None:
+                _resolved.move_to_end(key)
+
+        if u is None or not self._resolved_exists(u):
+            u = f()  # Not under the lock, since resolving remote urls downloads them
+
+            with _resolved_lock:
+                _resolved[key] = u
+
+                while len(_resolved) > RESOLVED_CACHE_SIZE:
+                    _resolved.popitem(last=False)
+
+        setattr(self, memo_attr, (key, u))
+
+        return u.clone()
+
+    @staticmethod
+    def _resolved_exists(u):
+        return u.scheme != 'file' or exists(u.path)
+
+    def get_resource(self):
+
+        def resolve():
+            if self.scheme == 'file':
+                u = self
+            else:
+                u = WebUrl(str(self), downloader=self._downloader).get_resource()
+
+            return MetatabUrl(str(u), downloader=self._downloader)
+
+        return self._resolve('resource', resolve)
 
     def get_target(self):
-        return MetatabUrl(str(self.inner.get_target()), downloader=self._downloader)
+        return self._resolve('target',
+                             lambda: MetatabUrl(str(self.inner.get_target()), downloader=self._downloader))
 
     def join_target(self, tf):
 
-        print("Type=", type(self))
-
         if self.target_file == DEFAULT_METATAB_FILE:
             return self.inner.join_dir(tf)
         else:
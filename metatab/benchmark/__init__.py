@@ -0,0 +1,16 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Benchmarks for the parser and for documents, run on synthetic Metatab documents.
+
+Run the suite from the command line with:
+
+    python -m metatab.benchmark --sections 50 --terms 100 --schema-width 50 --include-depth 3
+
+Use ``--save BASELINE`` to store the results as JSON, and ``--baseline BASELINE`` to compare a later run with
+them. The comparison reports operations that got slower, and operations whose output changed.
+"""
+
+from .synthetic import synthetic_rows, rows_to_lines, write_synthetic_doc
+from .suite import run_benchmarks, compare_results
@@ -0,0 +1,67 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Run the benchmarks on a synthetic document
+"""
+
+import argparse
+import json
+import sys
+from tempfile import TemporaryDirectory
+
+from .suite import run_benchmarks, compare_results
+from .synthetic import write_synthetic_doc, FORMATS
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(prog='python -m metatab.benchmark',
+                                     description='Benchmark the Metatab parser and documents on a synthetic document')
+
+    parser.add_argument('--sections', type=int, default=10, help='Number of sections')
+    parser.add_argument('--terms', type=int, default=20, help='Number of terms per section')
+    parser.add_argument('--schema-width', type=int, default=20, help='Number of columns per table')
+    parser.add_argument('--tables', type=int, default=2, help='Number of tables')
+    parser.add_argument('--include-depth', type=int, default=0, help='Depth of the chain of included documents')
+    parser.add_argument('--format', choices=tuple(FORMATS), default='csv', help='Format of the documents')
+    parser.add_argument('--repeat', type=int, default=3, help='Number of times to time each benchmark')
+    parser.add_argument('--baseline', help='Compare the results with baseline results saved with --save. '
+                                           'Exits with 1 if a benchmark is slower, or its output has changed')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='Fraction a benchmark may be slower than the baseline. Default 0.2')
+    parser.add_argument('--save', help='Save the results as JSON to a file, for use with --baseline')
+
+    args = parser.parse_args(argv)
+
+    params = {'sections': args.sections, 'terms_per_section': args.terms, 'schema_width': args.schema_width,
+              'tables': args.tables, 'include_depth': args.include_depth, 'format': args.format}
+
+    with TemporaryDirectory() as d:
+        results = run_benchmarks(write_synthetic_doc(d, **params), repeat=args.repeat)
+
+    for name, r in results.items():
+        print("{:<24} {:>9.2f}ms {:>9.1f}MB".format(name, r['time'] * 1000, r['peak'] / 1e6))
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump({'params': params, 'results': results}, f, indent=4)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+        if baseline['params'] != params:
+            parser.error("The baseline was run with different parameters: {}".format(baseline['params']))
+
+        messages = compare_results(results, baseline['results'], args.tolerance)
+
+        for m in messages:
+            print(m, file=sys.stderr)
+
+        if messages:
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,128 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Time, and measure the peak memory of, the parser and document operations
+"""
+
+import json
+import tracemalloc
+from collections import OrderedDict
+from hashlib import sha1
+from time import perf_counter
+
+
+def _digest(v):
+    """Return a digest of an operation's output, so runs can be compared without storing the output"""
+
+    if not isinstance(v, str):
+        v = json.dumps(v, sort_keys=True, default=str)
+
+    return sha1(v.encode('utf8')).hexdigest()
+
+
+def measure(f, repeat=3):
+    """Call f() repeat times, returning the shortest time, the peak memory of another call, and the result
+    of the last call. Memory is measured separately, since tracing slows the call down"""
+
+    times = []
+
+    for _ in range(repeat):
+        t0 = perf_counter()
+        result = f()
+        times.append(perf_counter() - t0)
+
+    tracemalloc.start()
+    try:
+        f()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return min(times), peak, result
+
+
+def benchmarks(path, resolver=None):
+    """Return an OrderedDict of benchmark name to a (function, output) pair. The output function
+    converts the benchmark function's result to the output that is compared between runs."""
+    from metatab import MetatabDoc, parse_app_url
+    from metatab.datapackage import convert_to_datapackage
+    from metatab.parser import TermParser
+    from metatab.resolver import default_resolver
+
+    resolver = resolver or default_resolver()
+
+    # A metatab URL, so Lines files, which have no generator of their own, get the Lines row generator
+    path = parse_app_url(str(path), proto='metatab', downloader=resolver.downloader)
+
+    # Declarations are cached for the process, so load them before timing anything
+    doc = MetatabDoc(path, resolver=resolver)
+
+    def parse():
+        # The parser needs a document for its section terms, but doesn't add the terms to it
+        return [(t.join_lc, t.value) for t in TermParser(path, resolver=resolver, doc=MetatabDoc())]
+
+    def find():
+        return [[t.value for t in doc.find(term)]
+                for term in ('Root.Item', 'Table.Column', 'Root.Datafile', 'Root.Name')]
+
+    return OrderedDict([
+        ('TermParser', (parse, len)),
+        ('MetatabDoc', (lambda: MetatabDoc(path, resolver=resolver), lambda d: len(list(d.all_terms)))),
+        ('find', (find, None)),
+        ('as_dict', (doc.as_dict, None)),
+        ('as_csv', (doc.as_csv, None)),
+        ('as_lines', (doc.as_lines, None)),
+        ('convert_to_datapackage', (lambda: convert_to_datapackage(doc), None)),
+    ])
+
+
+def run_benchmarks(path, repeat=3, resolver=None, names=None):
+    """Run the benchmarks on a document, returning an OrderedDict of benchmark name to a dict of the best time,
+    in seconds, the peak memory, in bytes, and a digest of the output.
+
+    :param path: Path to the document
+    :param repeat: Number of times to time each benchmark
+    :param resolver: Resolver for the documents. Defaults to default_resolver()
+    :param names: If not None, run only the benchmarks with these names
+    """
+
+    results = OrderedDict()
+
+    for name, (f, output) in benchmarks(path, resolver).items():
+
+        if names is not None and name not in names:
+            continue
+
+        dt, peak, result = measure(f, repeat)
+
+        results[name] = {
+            'time': dt,
+            'peak': peak,
+            'digest': _digest(output(result) if output else result)
+        }
+
+    return results
+
+
+def compare_results(results, baseline, tolerance=0.2):
+    """Compare results with baseline results, returning a list of messages for benchmarks that are more than
+    tolerance slower than the baseline, or whose output differs from it"""
+
+    messages = []
+
+    for name, r in results.items():
+
+        try:
+            b = baseline[name]
+        except KeyError:
+            continue
+
+        if r['digest'] != b['digest']:
+            messages.append("{}: output differs from the baseline".format(name))
+
+        if r['time'] > b['time'] * (1 + tolerance):
+            messages.append("{}: {:.3f}s, {:.0%} slower than the baseline's {:.3f}s"
+                            .format(name, r['time'], r['time'] / b['time'] - 1, b['time']))
+
+    return messages
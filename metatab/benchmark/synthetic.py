@@ -0,0 +1,120 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Generate synthetic Metatab documents, of a controlled size and shape, for benchmarks
+"""
+
+import csv
+from os.path import join
+
+FORMATS = {'csv': '.csv', 'lines': '.txt'}
+
+
+def synthetic_rows(sections=10, terms_per_section=20, schema_width=20, tables=2, include=None, name='synthetic'):
+    """Return the rows of a synthetic document.
+
+    :param sections: Number of sections, in addition to the Resources and Schema sections
+    :param terms_per_section: Number of terms in each of those sections
+    :param schema_width: Number of columns in each table of the schema
+    :param tables: Number of tables in the schema, each with a Datafile in the Resources section
+    :param include: If not None, the name of a document to include
+    :param name: The document name
+    """
+
+    rows = [
+        ['Declare', 'metatab-latest'],
+        ['Title', 'Synthetic document {}'.format(name)],
+        ['Name', name],
+        ['Identifier', name],
+        ['Version', '1'],
+        ['Description', 'A generated document, for benchmarks'],
+    ]
+
+    if include:
+        rows.append(['Include', include])
+
+    for i in range(sections):
+        rows.append([])
+        rows.append(['Section', '{}_section_{}'.format(name, i), 'Description', 'Note'])
+
+        for j in range(terms_per_section):
+            rows.append(['Item', 'item_{}_{}'.format(i, j), 'Item {} in section {}'.format(j, i), 'Note {}'.format(j)])
+
+    rows.append([])
+    rows.append(['Section', 'Resources', 'Name', 'Schema'])
+
+    for i in range(tables):
+        rows.append(['Datafile', 'data/{}_table_{}.csv'.format(name, i),
+                     '{}_table_{}'.format(name, i), '{}_table_{}'.format(name, i)])
+
+    rows.append([])
+    rows.append(['Section', 'Schema', 'DataType', 'Description'])
+
+    for i in range(tables):
+        rows.append(['Table', '{}_table_{}'.format(name, i)])
+
+        for j in range(schema_width):
+            rows.append(['Table.Column', 'col_{}'.format(j), ('integer', 'number', 'string')[j % 3],
+                         'Column {} of table {}'.format(j, i)])
+
+    return rows
+
+
+def rows_to_lines(rows):
+    """Convert rows to the text of a Lines format document"""
+
+    lines = []
+
+    for row in rows:
+        if not row:
+            lines.append('')
+        else:
+            lines.append('{}: {}'.format(row[0], '|'.join(str(e).replace('|', '\\|') for e in row[1:])))
+
+    return '\n'.join(lines) + '\n'
+
+
+def write_rows(rows, path, format='csv'):
+
+    with open(path, 'w', newline='' if format == 'csv' else None) as f:
+        if format == 'csv':
+            csv.writer(f).writerows(rows)
+        else:
+            f.write(rows_to_lines(rows))
+
+    return path
+
+
+def write_synthetic_doc(directory, sections=10, terms_per_section=20, schema_width=20, tables=2, include_depth=0,
+                        format='csv'):
+    """Write a synthetic document, and the documents it includes, into a directory, returning the path
+    of the document.
+
+    The document includes a chain of include_depth documents, each of which includes the next, and has
+    a tenth of the sections of the document, and a single table.
+
+    :param format: 'csv' or 'lines'
+    """
+
+    if format not in FORMATS:
+        raise ValueError("Unknown format '{}'; must be one of {}".format(format, tuple(FORMATS)))
+
+    ext = FORMATS[format]
+
+    def include_name(depth):
+        return 'include-{}{}'.format(depth, ext) if depth <= include_depth else None
+
+    for depth in range(include_depth, 0, -1):
+        rows = synthetic_rows(max(sections // 10, 1), terms_per_section, schema_width, 1,
+                              include=include_name(depth + 1), name='include_{}'.format(depth))
+
+        # Includes add to the including document, so they don't declare, or repeat the root terms
+        rows = [row for row in rows if not row or row[0] not in
+                ('Declare', 'Title', 'Name', 'Identifier', 'Version', 'Description')]
+
+        write_rows(rows, join(directory, include_name(depth)), format)
+
+    rows = synthetic_rows(sections, terms_per_section, schema_width, tables, include=include_name(1))
+
+    return write_rows(rows, join(directory, 'metadata' + ext), format)
@@ -0,0 +1,378 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Bound the size of the download cache.
+
+The CacheManager tracks how often, and how recently, each file in a cache is used, in a small SQLite index in
+the cache directory, and prunes the cache to keep it under a byte and an entry budget. Entries are removed when
+they are older than the TTL for their class, then in LRU or LFU order until the cache is within budget.
+"""
+
+import sqlite3
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from os import environ, getpid
+from time import time
+
+DAY = 24 * 60 * 60
+
+# Files that belong to an entry, and are removed with it
+SIDECAR_EXTENSIONS = ('.validators',)
+
+# Lock files belong to their entries too, and count toward their sizes, but are never removed, since other
+# processes may be waiting on them; a new lock file would let two processes hold the lock at once
+LOCK_EXTENSION = '.lock'
+
+CacheEntry = namedtuple('CacheEntry', 'path entry_class size created last_access hits')
+
+
+class CacheManager(object):
+    """Track use of, and prune, a download cache"""
+
+    index_file = '.metatab-cache.db'
+
+    # Seconds an entry may live, by entry class. None for no limit
+    default_ttls = {
+        'declaration': 30 * DAY,
+        'include': 7 * DAY,
+        'snapshot': None,
+    }
+
+    policies = ('lru', 'lfu')
+
+    def __init__(self, cache=None, max_bytes=None, max_entries=None, ttls=None, policy='lru'):
+        """
+        :param cache: A PyFs filesystem object for the cache. Defaults to get_cache()
+        :param max_bytes: Maximum total size of the entries, in bytes. Defaults to METATAB_CACHE_MAX_BYTES
+        :param max_entries: Maximum number of entries. Defaults to METATAB_CACHE_MAX_ENTRIES
+        :param ttls: A dict of entry class to seconds, updating default_ttls
+        :param policy: Eviction order for entries that are within their TTL, 'lru' or 'lfu'
+        """
+
+        if cache is None:
+            from metatab.util import get_cache
+            cache = get_cache()
+
+        if policy not in self.policies:
+            raise ValueError("Unknown cache policy '{}'; must be one of {}".format(policy, self.policies))
+
+        self.cache = cache
+        self.max_bytes = max_bytes if max_bytes is not None else self._env_int('METATAB_CACHE_MAX_BYTES')
+        self.max_entries = max_entries if max_entries is not None else self._env_int('METATAB_CACHE_MAX_ENTRIES')
+        self.ttls = dict(self.default_ttls, **(ttls or {}))
+        self.policy = policy
+
+        self._db = None
+        self._lock = threading.RLock()  # The connection is shared by threads, so queries are serialized
+
+    @staticmethod
+    def _env_int(name):
+        v = environ.get(name)
+        return int(v) if v else None
+
+    @property
+    def db(self):
+        """The index database, created on first use. The connection may be used from any thread, but only
+        while holding the manager's lock; use query() """
+        from fs.errors import NoSysPath
+
+        with self._lock:
+            if self._db is None:
+                try:
+                    path = self.cache.getsyspath(self.index_file)
+                except NoSysPath:
+                    path = ':memory:'
+
+                db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+                db.execute('CREATE TABLE IF NOT EXISTS entries '
+                           '(path TEXT PRIMARY KEY, hits INTEGER, last_access REAL)')
+                db.execute('CREATE TABLE IF NOT EXISTS counters (name TEXT PRIMARY KEY, value INTEGER)')
+
+                self._db = db
+
+            return self._db
+
+    def query(self, sql, params=()):
+        """Execute a statement on the index, returning the list of result rows"""
+
+        with self._lock:
+            return self.db.execute(sql, params).fetchall()
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
+
+    @contextmanager
+    def transaction(self):
+        """Run the queries in the block in one transaction, so a file-backed index is only synced once"""
+
+        with self._lock:
+            self.db.execute('BEGIN IMMEDIATE')
+
+            try:
+                yield
+            except BaseException:
+                self.db.execute('ROLLBACK')
+                raise
+            else:
+                self.db.execute('COMMIT')
+
+    def _count(self, name, n=1):
+        self.query('INSERT INTO counters VALUES (?, ?) ON CONFLICT(name) DO UPDATE SET value = value + excluded.value',
+                   (name, n))
+
+    def record(self, path, hit):
+        """Record a use of a cache entry, and whether it was already in the cache"""
+
+        path = path.lstrip('/')
+
+        with self.transaction():
+            self.query('INSERT INTO entries VALUES (?, 1, ?) '
+                       'ON CONFLICT(path) DO UPDATE SET hits = hits + 1, last_access = excluded.last_access',
+                       (path, time()))
+
+            self._count('hits' if hit else 'misses')
+
+    @property
+    def counters(self):
+        d = {'hits': 0, 'misses': 0, 'evictions': 0}
+        d.update(self.query('SELECT name, value FROM counters'))
+        return d
+
+    @staticmethod
+    def entry_class(path):
+        """Return the class of an entry, from its path in the cache"""
+        from metatab.parser import METATAB_ASSETS_URL
+        from urllib.parse import urlparse
+
+        if path.startswith('mirrors/'):
+            return 'snapshot'
+        elif path.startswith(urlparse(METATAB_ASSETS_URL).netloc + '/'):
+            return 'declaration'
+        else:
+            return 'include'
+
+    def entries(self):
+        """Return a list of CacheEntry for the entries in the cache. Files that the index has no record of are
+        treated as created, and last used, when they were last modified."""
+
+        index = {path: (hits, last_access)
+                 for path, hits, last_access in self.query('SELECT path, hits, last_access FROM entries')}
+
+        sizes = {}
+        modified = {}
+        locks_only = set()  # Entries that only have a lock file left, which aren't listed
+
+        for path, info in self.cache.walk.info(namespaces=['details']):
+            if not info.is_file:
+                continue
+
+            path = path.lstrip('/')
+
+            if path.startswith(self.index_file) or '.tmp-' in path:
+                continue
+
+            # Extracted mirrors are one entry each
+            key = '/'.join(path.split('/')[:2]) if path.startswith('mirrors/') else path
+
+            is_lock = key.endswith(LOCK_EXTENSION)
+
+            for ext in SIDECAR_EXTENSIONS + (LOCK_EXTENSION,):
+                if key.endswith(ext):
+                    key = key[:-len(ext)]
+                    break
+
+            if key not in sizes and is_lock:
+                locks_only.add(key)
+            elif not is_lock:
+                locks_only.discard(key)
+
+            sizes[key] = sizes.get(key, 0) + info.size
+            modified[key] = max(modified.get(key, 0), info.raw['details'].get('modified') or 0)
+
+        entries = []
+
+        for key, size in sizes.items():
+            if key in locks_only:
+                continue
+
+            hits, last_access = index.get(key, (0, None))
+
+            entries.append(CacheEntry(key, self.entry_class(key), size, modified[key],
+                                      last_access or modified[key], hits))
+
+        return entries
+
+    def expired(self, entry, now=None):
+        """Return True if the entry is older than the TTL for its class"""
+        ttl = self.ttls.get(entry.entry_class)
+
+        return ttl is not None and ((now or time()) - entry.created) > ttl
+
+    def remove(self, entry):
+        """Remove an entry and its sidecar files from the cache, holding the entry's lock, so entries aren't
+        removed while another process is fetching or extracting them. The lock file is kept. """
+        from fs.errors import ResourceNotFound
+
+        with cache_lock(self.cache, entry.path):
+            try:
+                if self.cache.isdir(entry.path):
+                    self.cache.removetree(entry.path)
+
+                for p in (entry.path,) + tuple(entry.path + ext for ext in SIDECAR_EXTENSIONS):
+                    if self.cache.isfile(p):
+                        self.cache.remove(p)
+            except ResourceNotFound:
+                pass  # Another process got it first
+
+            self.query('DELETE FROM entries WHERE path = ?', (entry.path,))
+
+    def prune(self, now=None, dry_run=False):
+        """Remove expired entries, then remove entries in eviction order until the cache is within its budgets.
+        Returns the list of removed entries"""
+
+        now = now or time()
+
+        entries = self.entries()
+
+        evicted = [e for e in entries if self.expired(e, now)]
+        kept = [e for e in entries if not self.expired(e, now)]
+
+        if self.policy == 'lfu':
+            kept.sort(key=lambda e: (e.hits, e.last_access))
+        else:
+            kept.sort(key=lambda e: e.last_access)
+
+        size = sum(e.size for e in kept)
+
+        while kept and ((self.max_bytes is not None and size > self.max_bytes) or
+                        (self.max_entries is not None and len(kept) > self.max_entries)):
+            e = kept.pop(0)
+            size -= e.size
+            evicted.append(e)
+
+        if not dry_run:
+            for e in evicted:
+                self.remove(e)
+
+            self._count('evictions', len(evicted))
+
+        return evicted
+
+    def report(self):
+        """Return a dict describing the size of the cache and its entry classes, the budgets, and the counters"""
+
+        entries = self.entries()
+
+        classes = {}
+        for e in entries:
+            c = classes.setdefault(e.entry_class, {'entries': 0, 'bytes': 0, 'ttl': self.ttls.get(e.entry_class)})
+            c['entries'] += 1
+            c['bytes'] += e.size
+
+        return {
+            'path': self.cache.getsyspath('/') if self.cache.hassyspath('/') else str(self.cache),
+            'entries': len(entries),
+            'bytes': sum(e.size for e in entries),
+            'max_entries': self.max_entries,
+            'max_bytes': self.max_bytes,
+            'policy': self.policy,
+            'classes': classes,
+            'counters': self.counters
+        }
+
+
+class _FcntlLock(object):
+    """An exclusive flock() on a lock file, for when the filelock package isn't installed"""
+
+    def __init__(self, path):
+        self.path = path
+        self._f = None
+
+    def __enter__(self):
+        import fcntl
+
+        self._f = open(self.path, 'a')
+        fcntl.flock(self._f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        import fcntl
+
+        fcntl.flock(self._f, fcntl.LOCK_UN)
+        self._f.close()
+        self._f = None
+
+
+_thread_locks = {}
+_thread_locks_lock = threading.Lock()
+
+
+def cache_lock(cache, path):
+    """Return an advisory lock for a cache entry, shared between processes through a lock file next to the entry.
+    Caches without system paths, like memory caches, only lock between threads. """
+    from fs.errors import NoSysPath
+
+    try:
+        lock_path = cache.getsyspath(path + '.lock')
+    except NoSysPath:
+        with _thread_locks_lock:
+            return _thread_locks.setdefault((id(cache), path), threading.Lock())
+
+    try:
+        from filelock import FileLock
+        return FileLock(lock_path)
+    except ImportError:
+        return _FcntlLock(lock_path)
+
+
+@contextmanager
+def atomic_write(cache, path, mode='wb'):
+    """Open a temporary file for writing a cache entry, then rename it to the entry's path, so other processes
+    never see a partly written file. The temporary file is removed if the write fails. """
+    from os import replace
+    from fs.errors import NoSysPath
+
+    tmp_path = '{}.tmp-{}-{}'.format(path, getpid(), threading.get_ident())
+
+    try:
+        with cache.open(tmp_path, mode) as f:
+            yield f
+
+        try:
+            replace(cache.getsyspath(tmp_path), cache.getsyspath(path))
+        except NoSysPath:
+            cache.move(tmp_path, path, overwrite=True)
+
+    except BaseException:
+        if cache.exists(tmp_path):
+            cache.remove(tmp_path)
+        raise
+
+
+_managers = {}
+_managers_lock = threading.Lock()
+
+
+def get_cache_manager(cache=None):
+    """Return a memoized CacheManager for a cache. Managers may be shared between threads"""
+    from metatab.util import get_cache
+
+    cache = cache if cache is not None else get_cache()
+
+    with _managers_lock:
+        try:
+            c, m = _managers[id(cache)]
+            if c is cache:
+                return m
+        except KeyError:
+            pass
+
+        m = CacheManager(cache)
+        _managers[id(cache)] = (cache, m)
+
+        return m
@@ -9,25 +9,187 @@ import json
 import sys
 from genericpath import exists
 
-from metatab import  DEFAULT_METATAB_FILE, MetatabDoc, parse_app_url
-from rowgenerators.util import get_cache, clean_cache
-from os.path import dirname
-from rowgenerators.util import fs_join as join
+from metatab import DEFAULT_METATAB_FILE
+from metatab.util import get_cache
+from os.path import dirname, join
 
 import logging
 
+# The document, parser and resolver modules, and the cache, are loaded when they are first used, since
+# importing rowgenerators is slow, and commands like --help and --cache don't need it.
+
 logger = logging.getLogger('user')
 logger_err = logging.getLogger('cli-errors')
 debug_logger = logging.getLogger('debug')
 
-cache = get_cache()
+_cache = None
+
+# A DocumentCache for process_file() to open documents through. The server sets it while it runs commands
+document_cache = None
+
+
+def cli_cache():
+    global _cache
+
+    if _cache is None:
+        _cache = get_cache()
+
+    return _cache
+
+
+def __getattr__(name):
+    # The module used to create the cache when it was imported
+    if name == 'cache':
+        return cli_cache()
+
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+def metatab(argv=None):
+    """Run the metatab command, with arguments from argv or sys.argv"""
+
+    argv = sys.argv[1:] if argv is None else argv
+
+    if argv and argv[0] == 'compile-decl':
+        return compile_decl(argv[1:])
+
+    parser = make_parser(argv)
+
+    cli_init()
+
+    args = parser.parse_args(argv)
+
+    if args.profile:
+        from metatab.profiling import profiled
+
+        with profiled(args.profile, args.profile_mode, args.profile_interval / 1000):
+            try:
+                run_command(args)
+            finally:
+                exts = {'both': '.pstats and .collapsed', 'cprofile': '.pstats', 'sample': '.collapsed'}
+                print("Wrote profile to {}{}".format(args.profile, exts[args.profile_mode]), file=sys.stderr)
+    else:
+        run_command(args)
+
+
+def run_command(args):
+    """Run the command for parsed arguments"""
+
+    if args.serve:
+        from metatab.server import serve
+
+        serve(args.serve, args)
+
+        exit(0)
+
+    if args.create is not False:
+        path = args.file[0] if args.file else DEFAULT_METATAB_FILE
+
+        if new_metatab_file(path, args.create):
+            prt("Created ", path)
+        else:
+            warn("File", path, 'already exists.')
+
+        exit(0)
+
+    if args.cache:
+        from metatab.cache import CacheManager
+
+        cm = CacheManager(cli_cache(), max_bytes=args.cache_max_bytes, max_entries=args.cache_max_entries,
+                          policy=args.cache_policy)
+
+        if args.cache == 'prune':
+            evicted = cm.prune()
+            prt("Removed {} entries, {} bytes".format(len(evicted), sum(e.size for e in evicted)))
+
+        print(json.dumps(cm.report(), indent=4))
+
+        exit(0)
+
+    paths = expand_paths(args.file, args.file_list)
+
+    if args.snapshot:
+        from metatab.resolver import snapshot
+
+        urls = snapshot(paths, args.snapshot)
+        prt("Wrote {} urls to mirror {}".format(len(urls), args.snapshot))
+
+        exit(0)
+
+    if len(paths) == 1 and not (args.file_list or args.jsonl or args.jobs > 1):
+        # A single file; errors exit
+        try:
+            output = process_file(paths[0], args, stream=sys.stdout)
+        except Exception as e:
+            err("Failed to process '{}': {}".format(paths[0], e))
+
+        if output is not None:
+            print(format_output(output, args))
 
-def metatab():
+        exit(0)
+
+    errors = 0
+    all_parse_errors = []
+    encode = json.dumps
+
+    if args.fast_json:
+        from metatab.emit import fast_json_encoder
+
+        encode = fast_json_encoder() or json.dumps
+
+    for path, output, error, parse_errors in process_files(paths, args):
+        if error:
+            errors += 1
+
+        if args.jsonl:
+            d = {'file': path}
+
+            if error:
+                d['error'] = error
+            elif output is not None:
+                d['output'] = output
+
+            if parse_errors:
+                d['parse_errors'] = parse_errors
+
+            print(encode(d))
+
+        else:
+            warn_parse_errors(path, parse_errors)
+
+            if error:
+                warn("Failed to process '{}': {}".format(path, error))
+
+            elif output is not None:
+                print(format_output(output, args))
+
+        all_parse_errors.extend(dict(e, path=path) for e in parse_errors)
+
+    if args.tolerant:
+        from metatab.parser import error_summary
+
+        summary = error_summary(all_parse_errors)
+        summary['documents'] = len(paths)
+        summary['failed'] = errors
+        summary['documents_with_errors'] = len(set(e['path'] for e in all_parse_errors))
+
+        print(json.dumps(summary), file=sys.stderr)
+
+    exit(1 if errors else 0)
+
+def make_parser(argv):
+    """Return the argument parser for the metatab command"""
     import argparse
+
+    if '-h' in argv or '--help' in argv:
+        epilog = 'Cache dir: {}\n'.format(str(cli_cache().getsyspath('/')))
+    else:
+        epilog = None
+
     parser = argparse.ArgumentParser(
         prog='metatab',
-        description='Matatab file parser',
-        epilog='Cache dir: {}\n'.format(str(cache.getsyspath('/') ) ))
+        description="Matatab file parser. Run 'metatab compile-decl -h' for compiling declarations",
+        epilog=epilog)
 
     g = parser.add_mutually_exclusive_group()
 
@@ -46,6 +208,10 @@ def metatab():
     g.add_argument('-l', '--line', default=False, action='store_const', dest='out_type', const='line',
                    help='Parse a file and print out a Metatab Line representation')
 
+    g.add_argument('--validate', default=False, action='store_const', dest='out_type', const='validate',
+                   help="Parse a file and print out a JSON list of the problems found by checking it against its "
+                        "declarations")
+
     g.add_argument('-c', '--csv', default=False, action='store_const', dest='out_type', const='csv',
                    help='Parse a file and print out a Metatab Line representation')
 
@@ -64,47 +230,160 @@ def metatab():
     parser.add_argument('-d', '--show-declaration', default=False, action='store_true',
                         help='Parse a declaration file and print out declaration dict. Use -j or -y for the format')
 
-    parser.add_argument('file', nargs='?', default=DEFAULT_METATAB_FILE, help='Path to a Metatab file')
+    parser.add_argument('-M', '--mirror',
+                        help='Resolve remote documents, declarations and includes from a mirror directory or archive, '
+                             'made with --snapshot, rather than the network. Defaults to the METATAB_MIRROR '
+                             'environmental variable')
 
-    cli_init()
+    parser.add_argument('-S', '--snapshot', metavar='MIRROR',
+                        help='Download the remote documents, declarations and includes that the file references '
+                             'into a mirror directory, for use with --mirror')
 
-    args = parser.parse_args(sys.argv[1:])
+    parser.add_argument('--cache', choices=('report', 'prune'),
+                        help="Report on the download cache, or prune it to its budgets, removing expired "
+                             "entries, then least recently or least frequently used ones")
 
-    # Specing a fragment screws up setting the default metadata file name
-    if args.file.startswith('#'):
-        args.file = DEFAULT_METATAB_FILE + args.file
+    parser.add_argument('--cache-max-bytes', type=int,
+                        help='Byte budget for --cache prune. Defaults to METATAB_CACHE_MAX_BYTES')
 
-    if args.create is not False:
-        if new_metatab_file(args.file, args.create):
-            prt("Created ", args.file)
-        else:
-            warn("File",args.file,'already exists.')
+    parser.add_argument('--cache-max-entries', type=int,
+                        help='Entry budget for --cache prune. Defaults to METATAB_CACHE_MAX_ENTRIES')
 
-        exit(0)
+    parser.add_argument('--cache-policy', choices=('lru', 'lfu'), default='lru',
+                        help='Eviction order for --cache prune')
 
-    metadata_url = parse_app_url(args.file, proto='metatab')
-    try:
-        doc = MetatabDoc(metadata_url, cache=cache)
-    except IOError as e:
+    parser.add_argument('--stats', action='store_true',
+                        help='Print the time spent in each phase of parsing each file, and counts of rows and terms, '
+                             'by file and term type, to stderr')
 
-        err("Failed to open '{}': {}".format(metadata_url, e))
+    parser.add_argument('--profile', nargs='?', const='metatab-profile', metavar='OUT',
+                        help="Profile the command, writing cProfile stats to OUT.pstats, and sampled stacks, "
+                             "annotated with the document, include and section, to OUT.collapsed, for flamegraph "
+                             "tools. OUT defaults to 'metatab-profile'; use --profile=OUT before file arguments. "
+                             "Only the main process is profiled")
 
-    def write_or_print(t):
-        from pathlib import Path
+    parser.add_argument('--profile-mode', choices=('both', 'cprofile', 'sample'), default='both',
+                        help='Profilers to run with --profile. With both, the samples include the overhead of '
+                             'cProfile')
 
-        if metadata_url.scheme != 'file':
-            err("Can only use -w with local files")
-            return
+    parser.add_argument('--profile-interval', type=float, default=1.0, metavar='MS',
+                        help='Milliseconds between samples for --profile')
 
-        ext = 'txt' if args.out_type == 'line' else args.out_type
+    parser.add_argument('-F', '--file-list',
+                        help="Process the files listed in a file, one per line, or on stdin for '-'")
 
-        if args.write_in_place:
-            with metadata_url.fspath.with_suffix('.'+ext).open('w') as f:
-                f.write(t)
+    parser.add_argument('-J', '--jobs', type=int, default=1,
+                        help='With many files, process them in a pool of this many processes')
+
+    parser.add_argument('--jsonl', action='store_true',
+                        help="Print one JSON object per file, with the file's path and its output or error")
+
+    parser.add_argument('--fast-json', action='store_true',
+                        help="Encode --jsonl records with orjson, if it is installed, which is much faster for large "
+                             "documents. The JSON is compact, and non-ASCII characters aren't escaped")
+
+    parser.add_argument('--tolerant', action='store_true',
+                        help='Finish parsing documents with broken includes or declarations, or terms without a '
+                             'parent term, reporting them as parse errors. With more than one file, the errors are '
+                             "in the 'parse_errors' of --jsonl output, and a JSON summary is printed to stderr")
+
+    parser.add_argument('file', nargs='*',
+                        help='Paths to Metatab files, or globs. Defaults to {}. With more than one file, '
+                             'errors are reported for each file, rather than stopping'.format(DEFAULT_METATAB_FILE))
+
+    parser.add_argument('--serve', nargs='?', const='default', metavar='SOCKET',
+                        help="Run a server that keeps declarations and recently used documents loaded, and answers "
+                             "JSON-RPC requests on a Unix socket, or on stdin and stdout for '-'. The socket defaults to "
+                             "METATAB_SOCKET, or one in the user's runtime directory. Use metatab-client to "
+                             "run commands through the server")
+
+    return parser
+
+
+
+def expand_paths(files, file_list=None):
+    """Return the paths for the file arguments, expanding globs and adding the paths in the file list,
+    one per line, which is read from stdin if it is '-' """
+    from glob import glob, has_magic
+
+    paths = []
+
+    for f in files:
+        if has_magic(f):
+            paths.extend(sorted(glob(f, recursive=True)))
         else:
-            print(t)
+            paths.append(f)
 
+    if file_list:
+        with (sys.stdin if file_list == '-' else open(file_list)) as fl:
+            paths.extend(l.strip() for l in fl if l.strip())
 
+    if not paths and not file_list:
+        paths = [DEFAULT_METATAB_FILE]
+
+    # Specing a fragment screws up setting the default metadata file name
+    return [DEFAULT_METATAB_FILE + p if p.startswith('#') else p for p in paths]
+
+
+def compile_decl(argv):
+    """Run the compile-decl command, which compiles declaration documents to Python modules"""
+    import argparse
+    from metatab.compiledecl import compile_declaration, default_module_path
+
+    parser = argparse.ArgumentParser(
+        prog='metatab compile-decl',
+        description="Compile a declaration document to a Python module, which loads without parsing. Select the "
+                    "compiled declaration with decl='py:<module name or path>'")
+
+    parser.add_argument('decl', nargs='+', help='Names, paths or URLs of declaration documents')
+
+    parser.add_argument('-o', '--output', help='Path of the module to write, for a single declaration. Defaults '
+                                               'to the name of the declaration, in the current directory')
+
+    parser.add_argument('-M', '--mirror',
+                        help='Resolve remote declarations from a mirror directory or archive, '
+                             'created with --snapshot')
+
+    cli_init()
+
+    args = parser.parse_args(argv)
+
+    if args.output and len(args.decl) > 1:
+        parser.error('--output can only be used with a single declaration')
+
+    for decl in args.decl:
+        path = args.output or default_module_path(decl)
+
+        try:
+            compile_declaration(decl, path, cache=cli_cache(), resolver=get_resolver(args))
+        except Exception as e:
+            err("Failed to compile '{}': {}".format(decl, e))
+
+        prt("Compiled {} to {}".format(decl, path))
+
+    exit(0)
+
+
+def get_resolver(args):
+    from metatab.resolver import MirrorResolver, default_resolver
+
+    return MirrorResolver(args.mirror) if args.mirror else default_resolver()
+
+
+def process_file(path, args, docs=None, parse_errors=None, stream=None):
+    """Parse one file and return its output for the output type in args. The output is a dict for JSON
+    output, text otherwise, or None if the output was written to a file. If docs is a DocumentCache, documents
+    are opened through it, or through document_cache if docs is None. With args.tolerant, the document's parse
+    errors are added to the parse_errors list, or printed if there is no list. If stream is given, JSON and YAML
+    output is written to it while walking the document, followed by a newline, as print() would, and None is
+    returned. """
+    from metatab import MetatabDoc, parse_app_url
+
+    cache = cli_cache()
+    docs = docs if docs is not None else document_cache
+    resolver = get_resolver(args)
+
+    metadata_url = parse_app_url(path, proto='metatab', downloader=resolver.downloader)
 
     if args.show_declaration:
 
@@ -115,69 +394,193 @@ def metatab():
             'sections': decl_doc.decl_sections
         }
 
-        if args.out_type == 'json':
-            print(json.dumps(d, indent=4))
-
-        elif args.out_type == 'yaml':
+        if args.out_type == 'yaml':
             import yaml
-            print(yaml.safe_dump(d, default_flow_style=False, indent=4))
+            return yaml.safe_dump(d, default_flow_style=False, indent=4)
+        else:
+            return d
 
-    elif args.find_first:
+    def open_doc():
+        return MetatabDoc(metadata_url, cache=cache, resolver=resolver, stats=args.stats, tolerant=args.tolerant)
 
-        t = doc.find_first(args.find_first)
-        print(t.value)
+    try:
+        options = (bool(args.tolerant), bool(args.stats), args.mirror)
+        doc = docs.get(metadata_url, open_doc, options) if docs is not None else open_doc()
+    except IOError as e:
+        raise IOError("Failed to open '{}': {}".format(metadata_url, e))
 
+    if args.tolerant:
+        if parse_errors is not None:
+            parse_errors.extend(doc.errors)
+        else:
+            warn_parse_errors(path, doc.errors)
 
-    elif args.out_type == 'terms':
-        for t in doc._term_parser:
-            print(t)
+    if args.stats and doc.stats is not None:
+        print("Parse stats for '{}':\n{}\n".format(path, doc.stats.report()), file=sys.stderr)
 
-    elif args.out_type == 'json':
-        write_or_print(json.dumps(doc.as_dict(), indent=4))
+    if args.find_first:
+        return doc.find_first(args.find_first).value
 
-    elif args.out_type == 'yaml':
-        import yaml
-        from collections import OrderedDict
+    elif args.out_type == 'terms':
+        return '\n'.join(str(t) for t in doc._term_parser)
 
-        def ordered_dump(data, stream=None, Dumper=yaml.Dumper, **kwds):
-            class OrderedDumper(Dumper):
-                pass
+    elif args.out_type in ('json', 'yaml'):
+        from metatab.emit import write_json, write_yaml
 
-            def _dict_representer(dumper, data):
-                return dumper.represent_mapping(
-                    yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG,
-                    data.items())
+        emit = write_json if args.out_type == 'json' else write_yaml
 
-            OrderedDumper.add_representer(OrderedDict, _dict_representer)
-            return yaml.dump(data, stream, OrderedDumper, **kwds)
+        if args.write_in_place:
+            output = None  # Written from the document, below
+        elif stream is not None:
+            emit(doc, stream)
+            stream.write('\n')
+            return None
+        elif args.out_type == 'json':
+            output = doc.as_dict()
+        else:
+            from io import StringIO
+            output = StringIO()
+            write_yaml(doc, output)
+            output = output.getvalue()
 
-        write_or_print(ordered_dump(doc.as_dict(), default_flow_style=False, indent=4, Dumper=yaml.SafeDumper))
+    elif args.out_type == 'validate':
+        from metatab.validate import validate
+        return [f.as_dict() for f in validate(doc)]
 
     elif args.out_type == 'line':
-        write_or_print(doc.as_lines())
+        output = doc.as_lines()
 
     elif args.out_type == 'csv':
-        write_or_print(doc.as_csv())
+        output = doc.as_csv()
 
     elif args.out_type == 'prety':
-        from pprint import pprint
-        pprint(doc.as_dict())
+        from pprint import pformat
+        return pformat(doc.as_dict())
+
+    if args.write_in_place:
+
+        if metadata_url.scheme != 'file':
+            raise IOError("Can only use -W with local files")
+
+        ext = 'txt' if args.out_type == 'line' else args.out_type
+
+        with metadata_url.fspath.with_suffix('.' + ext).open('w') as f:
+            if args.out_type in ('json', 'yaml'):
+                emit(doc, f)
+            else:
+                f.write(format_output(output, args))
+
+        return None
+
+    return output
 
-    exit(0)
 
+def format_output(output, args):
+
+    if isinstance(output, (dict, list)):
+        return json.dumps(output, indent=4)
+    else:
+        return str(output)
+
+
+_worker_args = None
+
+# The mirrors, or None for the web, that warm_declarations() has loaded declarations for, in this process or the
+# process it was forked from
+_warmed = set()
+
+
+def init_worker(args):
+    """Set the arguments for a batch worker, and load the declarations that most documents use, if the
+    worker didn't inherit them from the parent process"""
+    global _worker_args
+
+    _worker_args = args
+
+    if args.mirror not in _warmed:
+        warm_declarations(args)
+
+
+def warm_declarations(args, names=('metatab-latest',)):
+    """Parse a document that declares the common declarations, which caches their rows in the TermParser and
+    loads them into get_declaration()"""
+    from metatab.doc import MetatabDoc, get_declaration
+    from metatab.rowgen import TextRowGenerator
+
+    cache = cli_cache()
+
+    _warmed.add(args.mirror)
+
+    for name in names:
+        try:
+            MetatabDoc(TextRowGenerator('Declare: ' + name), cache=cache, resolver=get_resolver(args))
+            get_declaration(name, cache=cache)
+        except Exception as e:
+            debug_logger.debug("Failed to load declaration '{}': {}".format(name, e))
+
+
+def warn_parse_errors(path, parse_errors):
+
+    for e in parse_errors:
+        warn("{}: {}:{}:{}: {}".format(path, e['file'], e['row'], e['col'], e['error']))
+
+
+def process_one(path):
+    """Process a file in a batch worker, returning the path, output, error message and parse errors"""
+
+    parse_errors = []
+
+    try:
+        return path, process_file(path, _worker_args, parse_errors=parse_errors), None, parse_errors
+    except Exception as e:
+        return path, None, '{}: {}'.format(type(e).__name__, e), parse_errors
 
 
+def process_files(paths, args):
+    """Yield (path, output, error, parse errors) for each of the paths, in order, processing them in a pool of
+    args.jobs processes. Declarations are loaded before the pool starts, so workers that are forked share them."""
+    from concurrent.futures import ProcessPoolExecutor
+
+    init_worker(args)
+
+    if args.jobs <= 1:
+        for path in paths:
+            yield process_one(path)
+        return
+
+    chunksize = max(1, min(64, len(paths) // (args.jobs * 4)))
+
+    with ProcessPoolExecutor(args.jobs, initializer=init_worker, initargs=(args,)) as executor:
+        for r in executor.map(process_one, paths, chunksize=chunksize):
+            yield r
+
+
+class _StdStream(object):
+    """Write to sys.stdout or sys.stderr as it is when written to, rather than when the handler was created, so
+    that the server can capture the output of commands"""
+
+    def __init__(self, name):
+        self.name = name
+
+    def write(self, s):
+        return getattr(sys, self.name).write(s)
+
+    def flush(self):
+        getattr(sys, self.name).flush()
 
 
 def cli_init(log_level=logging.INFO):
 
-    out_hdlr = logging.StreamHandler(sys.stdout)
+    if logger.handlers:
+        return  # Already initialized, by an earlier command in the same process
+
+    out_hdlr = logging.StreamHandler(_StdStream('stdout'))
     out_hdlr.setFormatter(logging.Formatter('%(message)s'))
     out_hdlr.setLevel(log_level)
     logger.addHandler(out_hdlr)
     logger.setLevel(log_level)
 
-    out_hdlr = logging.StreamHandler(sys.stderr)
+    out_hdlr = logging.StreamHandler(_StdStream('stderr'))
     out_hdlr.setFormatter(logging.Formatter('%(levelname)s: %(message)s'))
     out_hdlr.setLevel(logging.WARN)
     logger_err.addHandler(out_hdlr)
@@ -196,6 +599,7 @@ def err(*args, **kwargs):
 
 def make_metatab_file(template='metatab'):
     import metatab.templates as tmpl
+    from metatab import MetatabDoc
 
     template_path = join(dirname(tmpl.__file__),template+'.csv')
 
@@ -204,14 +608,46 @@ def make_metatab_file(template='metatab'):
     return doc
 
 
+_templates = {}
+
+
+def template_csv(template):
+    """Return the CSV text of a template, which is parsed once for each process, for writing new files. The
+    text is cached, not the document, since writing a document changes it. Use make_metatab_file() for a
+    document to modify. """
+    from os.path import getmtime
+    import metatab.templates as tmpl
+
+    mtime = getmtime(join(dirname(tmpl.__file__), template + '.csv'))
+
+    try:
+        csv_mtime, csv = _templates[template]
+        if csv_mtime == mtime:
+            return csv
+    except KeyError:
+        pass
+
+    csv = make_metatab_file(template).as_csv()
+
+    _templates[template] = (mtime, csv)
+
+    return csv
+
 
 def new_metatab_file(mt_file, template):
+    from pathlib import Path
+    from metatab import MetatabError
+
     template = template if template else 'metatab'
 
     if not exists(mt_file):
-        doc = make_metatab_file(template)
+        path = Path(str(mt_file))
+
+        if path.suffix != '.csv':
+            raise MetatabError("Writing CSV file, but extension is wrong: {} ".format(str(path)))
 
-        doc.write_csv(mt_file)
+        with path.open('wb') as f:
+            f.write(template_csv(template).encode('utf8'))
 
         return True
 
@@ -0,0 +1,200 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Compile declaration documents to Python modules.
+
+Loading a declaration document means parsing its rows and building the term and section dicts. A compiled
+declaration is a generated Python module that holds the result, as read-only mappings, so after the first
+import it is loaded from the bytecode cache, with no parsing. Compile a declaration with:
+
+    metatab compile-decl metatab-latest -o metatab_latest.py
+
+and select it with a 'py:' declaration name, either a dotted module name or the path to the module:
+
+    doc = MetatabDoc('metadata.csv', decl='py:metatab_latest')
+
+The module has these attributes:
+
+* TERMS: Declared terms, keyed by the lowercased qualified term name
+* SECTIONS: Declared sections, keyed by the lowercased section name
+* TERM_SECTIONS: The name of the section each declared term belongs in
+* SYNONYMS: The term that each synonym term name is substituted with
+* VALUE_SETS: The values, and their display values, of each term with a ValueSetName
+* SUPER_TERMS: The super term of each term declared with InheritsFrom
+* ANCESTORS, DESCENDANTS: SUPER_TERMS expanded transitively, as in get_declaration()
+
+"""
+
+import sys
+from os.path import abspath, basename, exists, splitext
+
+from .exc import DeclarationError
+
+PREFIX = 'py:'
+
+FORMAT_VERSION = 1  # The METATAB_DECLARATION value of modules from this version of compile_declaration
+
+
+def is_compiled(decl):
+    """Return True if a declaration name refers to a compiled declaration"""
+
+    return isinstance(decl, str) and decl.startswith(PREFIX)
+
+
+def _literal(v, indent=0):
+    """Return Python source for a value, with dicts as read-only mappings and lists as tuples"""
+
+    if isinstance(v, dict) or hasattr(v, 'items'):
+        if not v:
+            return '_frozen({})'
+
+        pad = ' ' * (indent + 4)
+        items = ',\n'.join('{}{!r}: {}'.format(pad, k, _literal(e, indent + 4)) for k, e in v.items())
+
+        return '_frozen({{\n{}\n{}}})'.format(items, ' ' * indent)
+
+    elif isinstance(v, (list, tuple)):
+        return '({}{})'.format(', '.join(_literal(e, indent) for e in v), ',' if len(v) == 1 else '')
+
+    elif isinstance(v, (set, frozenset)):
+        return _literal(sorted(v), indent)
+
+    elif v is None or isinstance(v, (str, int, float, bool)):
+        return repr(v)
+
+    else:
+        return repr(str(v))
+
+
+def declaration_tables(doc):
+    """Return an OrderedDict of the tables of a compiled declaration, from a document with declarations
+    loaded"""
+    from collections import OrderedDict
+    from .terms import Term
+
+    term_sections = {}
+
+    for section_name, section in doc.decl_sections.items():
+        for term_name in section['terms']:
+            term_sections.setdefault(Term.normalize_term(term_name), section_name)
+
+    synonyms = {}
+    value_sets = {}
+
+    for term_name, td in doc.decl_terms.items():
+        if td.get('synonym'):
+            synonyms[term_name] = td['synonym']
+
+        if td.get('valuesetname'):
+            value_sets[term_name] = td.get('values', {})
+
+    index = doc.super_index
+
+    return OrderedDict([
+        ('TERMS', doc.decl_terms),
+        ('SECTIONS', doc.decl_sections),
+        ('TERM_SECTIONS', term_sections),
+        ('SYNONYMS', synonyms),
+        ('VALUE_SETS', value_sets),
+        ('SUPER_TERMS', index.super_terms),
+        ('ANCESTORS', {t: index.ancestors(t) for t in index.super_terms}),
+        ('DESCENDANTS', {t: index.descendants(t) for t in index.derived_terms}),
+    ])
+
+
+def module_source(doc, source):
+    """Return the source of a compiled declaration module for a document with declarations loaded
+
+    :param doc: A MetatabDoc, with the declaration loaded into decl_terms and decl_sections
+    :param source: The name of the declaration, for the module's SOURCE
+    """
+
+    lines = [
+        "# Metatab declaration '{}', compiled by 'metatab compile-decl'. Don't edit; compile it again."
+        .format(source),
+        '',
+        'from types import MappingProxyType as _frozen',
+        '',
+        'METATAB_DECLARATION = {!r}'.format(FORMAT_VERSION),
+        '',
+        'SOURCE = {!r}'.format(source),
+    ]
+
+    for name, table in declaration_tables(doc).items():
+        lines.append('')
+        lines.append('{} = {}'.format(name, _literal(table)))
+
+    lines.append('')
+
+    return '\n'.join(lines)
+
+
+def compile_declaration(decl, path, cache=None, resolver=None):
+    """Parse a declaration document and write it as a compiled declaration module, along with its bytecode
+
+    :param decl: Name, path or URL of a declaration document
+    :param path: Path of the module to write
+    :param cache: Cache for loading the declaration
+    :param resolver: Resolver for loading the declaration
+    :return: The path of the module
+    """
+    import py_compile
+    from .doc import MetatabDoc
+
+    doc = MetatabDoc(decl=decl, cache=cache, resolver=resolver)
+
+    if not doc.decl_terms:
+        raise DeclarationError("Declaration '{}' has no declared terms".format(decl))
+
+    with open(path, 'w', encoding='utf8') as f:
+        f.write(module_source(doc, decl))
+
+    py_compile.compile(path, doraise=True)
+
+    return path
+
+
+def load_compiled(decl):
+    """Import a compiled declaration module, from a 'py:' declaration name of a dotted module name or the path
+    to a module file"""
+    import re
+    from importlib import import_module
+    from importlib.util import spec_from_file_location, module_from_spec
+
+    name = decl[len(PREFIX):] if is_compiled(decl) else decl
+
+    if name.endswith('.py') or exists(name):
+        path = abspath(name)
+        mod_name = 'metatab_compiled_decl_' + re.sub(r'\W', '_', path)
+
+        try:
+            mod = sys.modules[mod_name]
+        except KeyError:
+            if not exists(path):
+                raise DeclarationError("No compiled declaration at '{}'".format(path))
+
+            spec = spec_from_file_location(mod_name, path)
+            mod = module_from_spec(spec)
+            spec.loader.exec_module(mod)
+            sys.modules[mod_name] = mod
+    else:
+        try:
+            mod = import_module(name)
+        except ImportError as e:
+            raise DeclarationError("Failed to import compiled declaration '{}': {}".format(name, e))
+
+    if getattr(mod, 'METATAB_DECLARATION', None) != FORMAT_VERSION:
+        raise DeclarationError("Module '{}' is not a compiled declaration, or is from a different version "
+                               "of metatab; compile it again".format(name))
+
+    return mod
+
+
+def default_module_path(decl):
+    """Return the default path for the compiled module of a declaration"""
+    import re
+
+    name = splitext(basename(decl.rstrip('/')))[0]
+
+    return re.sub(r'\W', '_', name) + '.py'
@@ -10,44 +10,70 @@ import logging
 import pathlib
 from collections import OrderedDict
 from collections.abc import MutableSequence
-from itertools import groupby
 from os.path import dirname, getmtime
-from time import time
+from time import time, perf_counter
 
 from metatab import DEFAULT_METATAB_FILE
 from metatab.exc import MetatabError, FormatError
-from metatab.parser import TermParser
-from metatab.resolver import WebResolver
+from metatab.compiledecl import is_compiled, load_compiled
+from metatab.parser import TermParser, SuperTermIndex, DeclaredTerm
+from metatab.resolver import WebResolver, default_resolver
 from metatab.util import slugify, get_cache
 from rowgenerators import parse_app_url
 from rowgenerators.exceptions import SourceError, AppUrlError
 
-from .terms import SectionTerm, RootSectionTerm, Term
+from .terms import SectionTerm, RootSectionTerm, Term, TermList, copy_dict
 from .util import import_name_or_class
 
 logger = logging.getLogger('doc')
 debug_logger = logging.getLogger('debug')
 
 
+_NOT_CACHED = object()  # Markers for the state of dicts in MetatabDoc.cached_dict()
+_REQUESTED = object()
+
+
 class MetatabDoc(object):
 
-    def __init__(self, ref=None, decl=None, package_url=None, cache=None, resolver=None, clean_cache=False):
+    def __init__(self, ref=None, decl=None, package_url=None, cache=None, resolver=None, clean_cache=False,
+                 stats=False, tolerant=False):
+        """
+        :param stats: If True, or a ParseStats object, record the times and counts for the phases of parsing
+            the document in the stats property. A ParseStats object can accumulate stats for several documents.
+        :param tolerant: If True, finish loading the document when includes or declarations fail, or terms have
+            no parent term, skipping them and recording the failures in errors, rather than raising an exception.
+        """
 
         self._input_ref = ref
+        self.tolerant = tolerant
+
+        if stats is True:
+            from metatab.stats import ParseStats
+            self.stats = ParseStats()
+        else:
+            self.stats = stats or None
 
         self._cache = cache if cache else get_cache()
 
         self.decl_terms = {}
         self.decl_sections = {}
+        self._decl_records = {}  # DeclaredTerm records for decl_terms, by term name
 
-        self.terms = []
+        self.terms = TermList(self.changed)
         self.sections = OrderedDict()
-        self.super_terms = {}
-        self.derived_terms = {}
+
+        self.change_version = 0  # Incremented by changed(), on every change to the terms or sections
+        self._flat_terms = None  # (change_version, terms) for flat_terms
+        self._dicts = (0, {})  # (change_version, dicts) for cached_dict()
+
+        # Shared with the parsers for the document's terms and declarations, which update it
+        self.super_index = SuperTermIndex()
+        self.super_terms = self.super_index.super_terms
+        self.derived_terms = self.super_index.derived_terms
         self.errors = []
         self.package_url = package_url
 
-        self.resolver = resolver or WebResolver()
+        self.resolver = resolver or default_resolver()
 
         if decl is None:
             self.decls = []
@@ -74,7 +100,15 @@ class MetatabDoc(object):
                     self._mtime = 0
 
             except AppUrlError as e:  # ref is probably a generator, not a string or Url
-                self._ref = None
+                # Generators for packages, such as those that read metadata from archives, use the package's url
+                self._ref = parse_app_url(str(package_url)) if package_url else None
+
+                try:
+                    self._mtime = getmtime(self._ref.path) if self._ref and self._ref.scheme == 'file' else 0
+                except (FileNotFoundError, OSError):
+                    self._mtime = 0
+
+            t0 = perf_counter()
 
             self._term_parser = TermParser(ref, resolver=self.resolver, doc=self)
 
@@ -83,6 +117,9 @@ class MetatabDoc(object):
             except SourceError as e:
                 raise MetatabError("Failed to load terms for document '{}': {}".format(self._ref, e))
 
+            if self.stats is not None:
+                self.stats.add('total', perf_counter() - t0)
+
 
         else:
             self._ref = None
@@ -116,6 +153,11 @@ class MetatabDoc(object):
     def mtime(self):
         return self._mtime
 
+    @property
+    def sources(self):
+        """Urls of the documents that were included or declared while loading the document"""
+        return self._term_parser.sources if self._term_parser is not None else []
+
     def as_version(self, ver):
         """Return an edited name, with a different version number or no version
 
@@ -159,10 +201,18 @@ class MetatabDoc(object):
         if not decls:
             return
 
+        for dcl in decls:
+            if is_compiled(dcl):
+                self.load_compiled_declaration(load_compiled(dcl))
+
         extant_decls = [t.value for t in self.find('Root.Declare')]
 
-        rg = self.resolver.get_row_generator([['Declare', dcl] for dcl in decls if dcl not in extant_decls],
-                                             cache=self._cache)
+        decls = [dcl for dcl in decls if dcl not in extant_decls and not is_compiled(dcl)]
+
+        if not decls:
+            return self
+
+        rg = self.resolver.get_row_generator([['Declare', dcl] for dcl in decls], cache=self._cache)
 
         term_interp = TermParser(rg, resolver=self.resolver, doc=self)
 
@@ -172,6 +222,26 @@ class MetatabDoc(object):
 
         self.decl_terms.update(dd['terms'])
         self.decl_sections.update(dd['sections'])
+        self._decl_records.clear()
+
+        return self
+
+    def load_compiled_declaration(self, mod):
+        """Load the terms, sections and super terms of a compiled declaration module. The declared terms and
+        sections are shared with the module, and are read-only. Adds a Declare term for the declaration the
+        module was compiled from, as loading the declaration does, so written documents declare it. """
+
+        source = getattr(mod, 'SOURCE', None)
+
+        if source and source not in [t.value for t in self.find('Root.Declare')]:
+            self['Root'].new_term('Root.Declare', source)
+
+        self.decl_terms.update(mod.TERMS)
+        self.decl_sections.update(mod.SECTIONS)
+        self._decl_records.clear()
+
+        for term, super_term in mod.SUPER_TERMS.items():
+            self.super_index.add(term, super_term)
 
         return self
 
@@ -193,18 +263,28 @@ class MetatabDoc(object):
             t.section = self.add_section(t.section)
             t.section.add_term(t)
 
+        dt = self.decl_record(t.join_lc)
+
         if not t.child_property_type or t.child_property_type == 'any':
-            t.child_property_type = self.decl_terms \
-                .get(t.join, {}) \
-                .get('childpropertytype', 'any')
+            t.child_property_type = dt.child_property_type
 
         if not t.term_value_name or t.term_value_name == t.section.default_term_value_name:
-            t.term_value_name = self.decl_terms \
-                .get(t.join, {}) \
-                .get('termvaluename', t.section.default_term_value_name)
+            t.term_value_name = dt.term_value_name or t.section.default_term_value_name
 
         assert t.section or t.join_lc == 'root.root', t
 
+    def decl_record(self, term_name):
+        """Return the DeclaredTerm record for a lowercased, qualified term name, from decl_terms"""
+
+        try:
+            return self._decl_records[term_name]
+        except KeyError:
+            pass
+
+        dt = self._decl_records[term_name] = DeclaredTerm.from_declaration(self.decl_terms.get(term_name))
+
+        return dt
+
     def get_term_class(self, term_name):
 
         tnl = term_name.lower()
@@ -214,10 +294,11 @@ class MetatabDoc(object):
         except KeyError:
             pass
 
-        try:
-            return import_name_or_class(TermParser.term_classes[self.super_terms[tnl]])
-        except KeyError:
-            pass
+        for super_term in self.super_index.ancestors(tnl):
+            try:
+                return import_name_or_class(TermParser.term_classes[super_term])
+            except KeyError:
+                pass
 
         return Term
 
@@ -250,6 +331,7 @@ class MetatabDoc(object):
         # it will get re-assigned to the local section
         if s.value.lower() not in self.sections:
             self.sections[s.value.lower()] = s
+            self.changed()
 
         return self.sections[s.value.lower()]
 
@@ -260,6 +342,7 @@ class MetatabDoc(object):
     def new_section(self, name, params=None):
         """Return a new section"""
         self.sections[name.lower()] = SectionTerm(None, name, term_args=params, doc=self)
+        self.changed()
 
         # Set the default arguments
         s = self.sections[name.lower()]
@@ -273,6 +356,7 @@ class MetatabDoc(object):
         """Create a new section or return an existing one of the same name"""
         if name not in self.sections:
             self.sections[name.lower()] = SectionTerm(None, name, term_args=params, doc=self)
+            self.changed()
 
         return self.sections[name.lower()]
 
@@ -303,6 +387,7 @@ class MetatabDoc(object):
         assert len(self.sections) == len(sections)
 
         self.sections = sections
+        self.changed()
 
     def __getitem__(self, item):
         """Dereference a section name"""
@@ -322,6 +407,7 @@ class MetatabDoc(object):
                     self.terms.remove(t)
 
             del self.sections[item.lower()]
+            self.changed()
         except KeyError:
             # Ignore errors
             pass
@@ -375,18 +461,17 @@ class MetatabDoc(object):
         # Try to replace the term with the list of its derived terms; that is, replace the super-class with all
         # of the derived classes, but only do this expansion once.
         if _expand_derived:
-            try:
-                try:
-                    # Term is a string
-                    term = list(self.derived_terms[term.lower()]) + [term]
-                except AttributeError:  # Term is hopefully a list
-                    terms = []
-                    for t in term:
-                        terms.append(term)
-                        for dt in self.derived_terms[t.lower()]:
-                            terms.append(dt)
-            except KeyError as e:
-                pass
+            if isinstance(term, str):
+                if term.lower() in self.derived_terms:
+                    term = self.super_index.expand(term)
+            else:
+                # Term is hopefully a list. Expand each, without repeating terms
+                terms = OrderedDict()
+                for t in term:
+                    for dt in self.super_index.expand(t):
+                        terms.setdefault(dt.lower(), dt)
+
+                term = list(terms.values())
 
         # Find any of a list of terms
         if isinstance(term, (list, tuple)):
@@ -405,7 +490,7 @@ class MetatabDoc(object):
             if term.startswith('root.'):
                 term_gen = self.terms  # Just the root level terms
             else:
-                term_gen = self.all_terms  # All terms, root level and children.
+                term_gen = self.flat_terms  # All terms, root level and children.
 
             for t in term_gen:
 
@@ -467,8 +552,13 @@ class MetatabDoc(object):
         # if self.root and len(self.root.children) > 0:
         #    raise MetatabError("Can't run after adding terms to document.")
 
+        stats = self.stats
+
         for t in terms:
 
+            if stats is not None:
+                t0 = perf_counter()
+
             t.doc = self
 
             if t.term_is('root.root'):
@@ -476,9 +566,7 @@ class MetatabDoc(object):
                     self.root = t
                     self.add_section(t)
 
-                continue
-
-            if t.term_is('root.section'):
+            elif t.term_is('root.section'):
                 self.add_section(t)
 
             elif t.parent_term_lc == 'root':
@@ -489,17 +577,21 @@ class MetatabDoc(object):
                 # parent term that is added to the doc.
                 assert t.parent is not None
 
+            if stats is not None:
+                stats.add('load_terms', perf_counter() - t0)
+
+        if stats is not None:
+            t0 = perf_counter()
+
         try:
             dd = terms.declare_dict
 
             self.decl_terms.update(dd['terms'])
             self.decl_sections.update(dd['sections'])
+            self._decl_records.clear()
 
-            self.super_terms.update(terms.super_terms())
-
-            kf = lambda e: e[1]  # Sort on the value
-            self.derived_terms = {k: set(e[0] for e in g)
-                                  for k, g in groupby(sorted(self.super_terms.items(), key=kf), kf)}
+            if terms.super_index is not self.super_index:
+                self.super_index.update(terms.super_index)
 
         except AttributeError as e:
             pass
@@ -507,10 +599,19 @@ class MetatabDoc(object):
         try:
             self.errors = terms.errors_as_dict()
         except AttributeError:
-            self.errors = {}
+            self.errors = []
+
+        if stats is not None:
+            stats.add('load_terms', perf_counter() - t0, 0)
 
         return self
 
+    def error_summary(self):
+        """Return a summary of the parse errors in errors, from parser.error_summary()"""
+        from metatab.parser import error_summary
+
+        return error_summary(self.errors)
+
     def load_rows(self, row_generator):
 
         term_interp = TermParser(self, row_generator)
@@ -772,21 +873,56 @@ class MetatabDoc(object):
 
         return '-'.join(parts)
 
-    def as_dict(self, replace_value_names=True):
-        """Iterate, link terms and convert to a dict"""
+    def as_dict(self, replace_value_names=True, copy=True):
+        """Iterate, link terms and convert to a dict. The dict is cached until the document changes.
+
+        :param copy: If False, return the cached dict, which must not be modified, rather than a copy of it.
+        """
+
+        return self.cached_dict(self, replace_value_names, lambda: self._build_dict(replace_value_names), copy)
+
+    def _build_dict(self, replace_value_names=True):
+
+        # The root of the document contains all terms, while the root section has only terms that are not
+        # in another section. So, the terms of all of the sections are converted as if they were the terms
+        # of the Root section.
 
-        # This function is a hack, due to confusion between the root of the document, which
-        # should contain all terms, and the root section, which has only terms that are not
-        # in another section. So, here we are taking the Root section, and adding all of the other
-        # terms to it, as if it were also the root of the document tree.
+        terms = [t for s in self for t in s]
 
-        r = RootSectionTerm(doc=self)
+        if not terms:
+            return 'Root'
 
-        for s in self:  # Iterate over sections
-            for t in s:  # Iterate over the terms in each section.
-                r.terms.append(t)
+        d = Term._fold_children(terms, Term._convert_terms(terms, replace_value_names))
 
-        return r.as_dict(replace_value_names)
+        if not replace_value_names:
+            d['@value'] = 'Root'
+
+        return d
+
+    def cached_dict(self, o, replace_value_names, build, copy=True):
+        """Return the dict for the document or a section, o, from the cache, or by calling build(). The dict is
+        cached until the document changes, from the second request after a change, or the first with copy False.
+
+        :param copy: If True, return a copy of the cached dict, so it can be modified
+        """
+
+        version, dicts = self._dicts
+
+        if version != self.change_version:
+            version, dicts = self._dicts = (self.change_version, {})
+
+        key = (o, replace_value_names)
+        d = dicts.get(key, _NOT_CACHED)
+
+        if d is _NOT_CACHED and copy:
+            # Don't cache the dict until it is requested again, so a single conversion isn't slowed by copying
+            dicts[key] = _REQUESTED
+            return build()
+
+        elif d is _NOT_CACHED or d is _REQUESTED:
+            d = dicts[key] = build()
+
+        return copy_dict(d) if copy else d
 
     @property
     def rows(self):
@@ -820,7 +956,8 @@ class MetatabDoc(object):
     @property
     def all_terms(self):
         """Iterate over all of the terms. The self.terms property has only root level terms. This iterator
-        iterates over all terms"""
+        iterates over all terms, in pre-order: each section term, then each of the section's terms followed by
+        its descendents"""
 
         for s_name, s in self.sections.items():
 
@@ -828,11 +965,28 @@ class MetatabDoc(object):
             if s.name != 'Root':
                 yield s
 
-            # Yield all of the rows for terms in the section
-            for rterm in s:
-                yield rterm
-                for d in rterm.descendents:
-                    yield d
+            # Walk the terms of the section with a stack, pushed in reverse
+            stack = s.terms[::-1]
+
+            while stack:
+                t = stack.pop()
+                yield t
+                stack.extend(reversed(t.children))
+
+    def changed(self):
+        """Record a change to the document's terms or sections, invalidating the cached views of the document,
+        such as flat_terms. The term and section methods, and the children and terms lists, call it; call it after
+        changing the sections dict directly."""
+        self.change_version += 1
+
+    @property
+    def flat_terms(self):
+        """A tuple of all of the terms, in the order of all_terms, cached until the document changes"""
+
+        if self._flat_terms is None or self._flat_terms[0] != self.change_version:
+            self._flat_terms = (self.change_version, tuple(self.all_terms))
+
+        return self._flat_terms[1]
 
     def as_csv(self):
         """Return a CSV representation as a string"""
@@ -926,3 +1080,64 @@ class MetatabDoc(object):
             self.write_csv(path)
         else:
             raise FormatError("Can't write to filetype of {}".format(path.suffix))
+
+
+_declarations = {}
+
+
+def get_declaration(decl, cache=None):
+    """Return the declared terms and sections for a declaration document, loading each declaration only
+    once per process. The returned dict has the keys:
+
+    * terms: Declared terms, keyed by the lowercased qualified term name
+    * sections: Declared sections, keyed by the lowercased section name
+    * term_sections: The name of the section each declared term belongs in
+    * super_terms: The super terms of each term declared with InheritsFrom, transitively, nearest first
+    * derived_terms: The terms derived from each super term, transitively, in name order
+
+    The dicts are shared by all callers, so they must not be modified.
+
+    :param decl: Name, path or URL of a declaration document
+    :param cache: Cache for loading the declaration
+    :return: A dict
+    """
+
+    try:
+        return _declarations[decl]
+    except KeyError:
+        pass
+
+    if is_compiled(decl):
+        mod = load_compiled(decl)
+
+        _declarations[decl] = {
+            'terms': mod.TERMS,
+            'sections': mod.SECTIONS,
+            'term_sections': mod.TERM_SECTIONS,
+            'super_terms': mod.ANCESTORS,
+            'derived_terms': mod.DESCENDANTS
+        }
+
+        return _declarations[decl]
+
+    doc = MetatabDoc(decl=decl, cache=cache)
+
+    # Some terms are declared in more than one section; the first declaration wins
+    term_sections = {}
+
+    for section_name, section in doc.decl_sections.items():
+        for term_name in section['terms']:
+            term_sections.setdefault(Term.normalize_term(term_name), section_name)
+
+    # Expand the inheritance hierarchy once, so users of the declaration don't walk it
+    index = doc.super_index
+
+    _declarations[decl] = {
+        'terms': doc.decl_terms,
+        'sections': doc.decl_sections,
+        'term_sections': term_sections,
+        'super_terms': {t: list(index.ancestors(t)) for t in index.super_terms},
+        'derived_terms': {t: sorted(index.descendants(t)) for t in index.derived_terms}
+    }
+
+    return _declarations[decl]
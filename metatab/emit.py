@@ -0,0 +1,331 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Write documents as JSON, JSON Lines and YAML, incrementally.
+
+The writers walk the term tree of a document, a section or a term, and write the same structure as
+as_dict(), without building it. The tree is walked with a stack, so the memory used depends on the depth
+of the tree, and on the number of children of the terms being written, not on the size of the document.
+
+The walk is done by events(), which generates (event, value) tuples in the form of ijson's basic_parse(),
+like metatab.rowgen.tree_events() does for a dict, so the output can be fed to any consumer of those events:
+
+    with open('metadata.json', 'w') as f:
+        write_json(doc, f)
+
+With fast=True, write_jsonl() encodes the dicts of terms that have only terminal children with orjson, if it
+is installed, which is several times faster than the json module for large schemas.
+"""
+
+import json
+from collections import OrderedDict
+from json.encoder import encode_basestring_ascii
+
+from .terms import Term
+
+BUFFER_SIZE = 1000  # Pieces of output to collect before writing them to the stream
+
+
+class _Sequence(list):
+    """The terms of a list in the output"""
+
+
+class _Value(object):
+    """A value in the output, which is not converted, even if it is a term"""
+
+    __slots__ = ('v',)
+
+    def __init__(self, v):
+        self.v = v
+
+
+def _entries(children, value, value_key, replace_value_names):
+    """Return a list of (key, value) for the dict of a term with the given children and value, in which
+    each value is a Term, a _Sequence, or a _Value. The values of children with the same name
+    are combined by their child_property_type, as in Term._fold_children()"""
+
+    groups = OrderedDict()
+
+    for c in children:
+        groups.setdefault(c.record_term_lc, []).append(c)
+
+    entries = OrderedDict()
+
+    for k, group in groups.items():
+
+        if any(c.child_property_type in ('sconcat', 'bconcat') for c in group):
+            # Concatenated values are just strings, so get the value for the group from as_dict()
+            v = _Value(Term._fold_children(group, Term._convert_terms(group, replace_value_names))[k])
+
+        elif len(group) == 1 and group[0].child_property_type != 'sequence':
+            v = group[0]
+
+        else:
+            v = None
+
+            for c in group:
+                if c.child_property_type == 'scalar':
+                    v = c
+                elif isinstance(v, _Sequence):
+                    v.append(c)
+                elif c.child_property_type == 'sequence':
+                    v = _Sequence([c])
+                elif v is None:
+                    v = c
+                else:
+                    v = _Sequence([v, c])
+
+        entries[k] = v
+
+    if value:
+        entries[value_key.lower() if replace_value_names else '@value'] = _Value(value)
+
+    return list(entries.items())
+
+
+def _scalar_event(v):
+    if v is None:
+        return ('null', None)
+    elif isinstance(v, bool):
+        return ('boolean', v)
+    elif isinstance(v, (int, float)):
+        return ('number', v)
+    else:
+        return ('string', v)
+
+
+def events(o, replace_value_names=True, leaf_maps=False):
+    """Generate (event, value) tuples for the dict form of a document, section or term, the same as
+    metatab.rowgen.tree_events(o.as_dict()) would
+
+    :param o: A MetatabDoc, SectionTerm or Term
+    :param replace_value_names: As for as_dict()
+    :param leaf_maps: If True, a term with only terminal children is generated as a single ('map', dict) event,
+        with the term's dict from as_dict()
+    """
+    from .doc import MetatabDoc
+    from .terms import SectionTerm, RootSectionTerm
+
+    if isinstance(o, MetatabDoc):
+        terms = [t for s in o for t in s]
+
+        if not terms:
+            yield ('string', 'Root')
+            return
+
+        root = _entries(terms, None if replace_value_names else 'Root', '@value', replace_value_names)
+
+    elif isinstance(o, SectionTerm):
+        if not o.terms:
+            yield _scalar_event(o.value)
+            return
+
+        root = _entries(o.terms, o.value, o.term_value_name, replace_value_names)
+
+        if isinstance(o, RootSectionTerm) and replace_value_names:
+            root = [(k, v) for k, v in root if k != '@value']
+
+    else:
+        root = None
+
+    stack = []  # (True, iterator of (key, value)) for a map, or (False, iterator of values) for a list
+
+    def start(e):
+        """Return the event for a value, and for a map or list, push a frame for its contents"""
+
+        if isinstance(e, _Value):
+            return _scalar_event(e.v)
+
+        elif isinstance(e, Term):
+            if not e.children:
+                return _scalar_event(e.value)
+
+            elif leaf_maps and not any(c.children for c in e.children):
+                return ('map', e.as_dict(replace_value_names))
+
+            stack.append((True, iter(_entries(e.children, e.value, e.term_value_name, replace_value_names))))
+            return ('start_map', None)
+
+        else:
+            stack.append((False, iter(e)))
+            return ('start_array', None)
+
+    if root is None:
+        yield start(o)
+    else:
+        stack.append((True, iter(root)))
+        yield ('start_map', None)
+
+    while stack:
+        is_map, it = stack[-1]
+
+        try:
+            e = next(it)
+        except StopIteration:
+            stack.pop()
+            yield ('end_map', None) if is_map else ('end_array', None)
+            continue
+
+        if is_map:
+            k, e = e
+            yield ('map_key', k)
+
+        yield start(e)
+
+
+def fast_json_encoder():
+    """Return a function that encodes a value as compact JSON text with orjson, or None if it isn't installed"""
+
+    try:
+        import orjson
+    except ImportError:
+        return None
+
+    return lambda v: orjson.dumps(v).decode('utf8')
+
+
+def _json_scalar(event, v):
+
+    if event == 'string':
+        return encode_basestring_ascii(v)
+    elif event == 'null':
+        return 'null'
+    elif event == 'boolean':
+        return 'true' if v else 'false'
+    else:
+        return json.dumps(v)
+
+
+def write_json(o, stream, indent=4, separators=None, replace_value_names=True, fast=False):
+    """Write the dict form of a document, section or term to a stream as JSON, with the same text as
+    json.dump(o.as_dict(), stream, indent=indent, separators=separators)
+
+    :param fast: If True, and orjson is installed, encode the dicts of terms with only terminal children with
+        orjson. orjson writes compact JSON, so it is only used if indent is None and separators is (',', ':'),
+        and it doesn't escape non-ASCII characters.
+    """
+
+    if separators is None:
+        separators = (', ', ': ') if indent is None else (',', ': ')
+
+    item_sep, key_sep = separators
+
+    if isinstance(indent, int):
+        indent = ' ' * indent
+
+    encode = fast_json_encoder() if fast and indent is None and separators == (',', ':') else None
+
+    pieces = []
+    stack = []  # The number of items written to each open map or array
+    after_key = False
+
+    for event, v in events(o, replace_value_names, leaf_maps=encode is not None):
+
+        if event == 'end_map' or event == 'end_array':
+            n = stack.pop()
+
+            if n and indent is not None:
+                pieces.append('\n' + indent * len(stack))
+
+            pieces.append('}' if event == 'end_map' else ']')
+
+        else:
+            if after_key:
+                after_key = False
+
+            elif stack:
+                if stack[-1]:
+                    pieces.append(item_sep)
+
+                stack[-1] += 1
+
+                if indent is not None:
+                    pieces.append('\n' + indent * len(stack))
+
+            if event == 'map_key':
+                pieces.append(encode_basestring_ascii(v))
+                pieces.append(key_sep)
+                after_key = True
+
+            elif event == 'start_map':
+                pieces.append('{')
+                stack.append(0)
+
+            elif event == 'start_array':
+                pieces.append('[')
+                stack.append(0)
+
+            elif event == 'map':
+                pieces.append(encode(v))
+
+            else:
+                pieces.append(_json_scalar(event, v))
+
+        if len(pieces) >= BUFFER_SIZE:
+            stream.write(''.join(pieces))
+            del pieces[:]
+
+    stream.write(''.join(pieces))
+
+
+def write_jsonl(objects, stream, replace_value_names=True, fast=False):
+    """Write documents, sections or terms to a stream as JSON Lines, with the dict form of each object as
+    compact JSON on a line of its own
+
+    :param objects: An iterable of documents, sections or terms, or a single one
+    :param fast: If True, and orjson is installed, encode with orjson, as for write_json()
+    """
+    from .doc import MetatabDoc
+
+    if isinstance(objects, (MetatabDoc, Term)):
+        objects = [objects]
+
+    for o in objects:
+        write_json(o, stream, indent=None, separators=(',', ':'), replace_value_names=replace_value_names,
+                   fast=fast)
+        stream.write('\n')
+
+
+def write_yaml(o, stream, replace_value_names=True, indent=4):
+    """Write the dict form of a document, section or term to a stream as YAML, with the same text as dumping
+    o.as_dict() with yaml.SafeDumper, default_flow_style=False, and the key order of the dict"""
+    import yaml
+    from yaml.events import (DocumentStartEvent, DocumentEndEvent, MappingStartEvent, MappingEndEvent,
+                             SequenceStartEvent, SequenceEndEvent, ScalarEvent)
+    from yaml.nodes import ScalarNode
+
+    dumper = yaml.SafeDumper(stream, default_flow_style=False, indent=indent)
+
+    def scalar(v):
+        # As the serializer does for the node the representer makes for the value
+        node = dumper.represent_data(v)
+        implicit = (node.tag == dumper.resolve(ScalarNode, node.value, (True, False)),
+                    node.tag == dumper.resolve(ScalarNode, node.value, (False, True)))
+
+        return ScalarEvent(None, node.tag, implicit, node.value, style=node.style)
+
+    try:
+        dumper.open()
+        dumper.emit(DocumentStartEvent(explicit=dumper.use_explicit_start, version=dumper.use_version,
+                                       tags=dumper.use_tags))
+
+        for event, v in events(o, replace_value_names):
+
+            if event == 'start_map':
+                dumper.emit(MappingStartEvent(None, yaml.resolver.BaseResolver.DEFAULT_MAPPING_TAG, True,
+                                              flow_style=False))
+            elif event == 'end_map':
+                dumper.emit(MappingEndEvent())
+            elif event == 'start_array':
+                dumper.emit(SequenceStartEvent(None, yaml.resolver.BaseResolver.DEFAULT_SEQUENCE_TAG, True,
+                                               flow_style=False))
+            elif event == 'end_array':
+                dumper.emit(SequenceEndEvent())
+            else:
+                dumper.emit(scalar(v))
+
+        dumper.emit(DocumentEndEvent(explicit=dumper.use_explicit_end))
+        dumper.close()
+    finally:
+        dumper.dispose()
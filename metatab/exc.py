@@ -41,3 +41,11 @@ class ConversionError(MetatabError):
 
 class FormatError(MetatabError):
     pass
+
+
+class ServerError(MetatabError):
+    """An error response from the metatab server"""
+
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
@@ -14,15 +14,18 @@ ROOT_TERM = 'root'  # No parent term -- no '.' --  in term cell
 
 ELIDED_TERM = '<elided_term>'  # A '.' in term cell, but no term before it.
 
+SKIPPED_TERM = object()  # Stands in for a term that failed to parse, in tolerant mode, so its children are skipped
+
 METATAB_ASSETS_URL = 'http://assets.metatab.org/'
 
 from .terms import Term, SectionTerm, RootSectionTerm
 
 from .exc import IncludeError, DeclarationError, ParserError, GenerateError
-from os.path import dirname, join, exists
+from os.path import dirname, join, exists, getmtime
 from .util import declaration_path, import_name_or_class
 
-from functools import lru_cache
+from collections import OrderedDict, namedtuple
+from time import perf_counter, time
 
 # Python2 doesn't have FileNotFoundError
 try:
@@ -30,6 +33,155 @@ try:
 except NameError:
     FileNotFoundError = IOError
 
+def error_summary(errors):
+    """Return a dict that summarizes parse errors, as returned by errors_as_dict(), from one or more documents,
+    with the number of errors, and the numbers by error type and by file"""
+
+    by_type = OrderedDict()
+    by_file = OrderedDict()
+
+    for e in errors:
+        by_type[e['type']] = by_type.get(e['type'], 0) + 1
+        by_file[e['file']] = by_file.get(e['file'], 0) + 1
+
+    return OrderedDict([('errors', len(errors)), ('types', by_type), ('files', by_file)])
+
+
+class DeclaredTerm(namedtuple('DeclaredTerm', 'valid child_property_type term_value_name options')):
+    """The properties of a declared term that are set on each parsed term. Records are immutable, so parsed terms
+    share the options tuple of their record. term_value_name is None if the declaration doesn't set one. """
+
+    __slots__ = ()
+
+    _options = {}  # Interned options tuples, by options string
+
+    @classmethod
+    def from_declaration(cls, td):
+        """Return the record for a term declaration dict, or for an undeclared term if td is None"""
+
+        if td is None:
+            return UNDECLARED_TERM
+
+        options_str = td.get('options', '')
+
+        try:
+            options = cls._options[options_str]
+        except KeyError:
+            options = cls._options[options_str] = tuple(options_str.split(','))
+
+        return cls(True, td.get('childpropertytype', 'any'), td.get('termvaluename'), options)
+
+
+UNDECLARED_TERM = DeclaredTerm(False, 'any', None, ('',))
+
+
+class SuperTermIndex(object):
+    """Map declared terms to the super terms they inherit from, with InheritsFrom, and super terms to the set of
+    terms derived from them. The index is updated as terms are declared, and a document shares it with the parsers
+    that load its terms and declarations. """
+
+    def __init__(self):
+        self.super_terms = {}  # Derived term -> super term
+        self.derived_terms = {}  # Super term -> set of derived terms
+
+        self._ancestors = {}  # Memoized results of ancestors() and descendants(), cleared on changes
+        self._descendants = {}
+
+    def add(self, term, super_term):
+        """Set the super term of a term, replacing any previous super term"""
+
+        term = term.lower()
+        super_term = super_term.lower()
+
+        if self.super_terms.get(term) == super_term:
+            return
+
+        self.remove(term)
+
+        self.super_terms[term] = super_term
+        self.derived_terms.setdefault(super_term, set()).add(term)
+        self._clear()
+
+    def remove(self, term):
+        """Remove a term's super term, if it has one"""
+
+        term = term.lower()
+
+        try:
+            super_term = self.super_terms.pop(term)
+        except KeyError:
+            return
+
+        derived = self.derived_terms[super_term]
+        derived.discard(term)
+
+        if not derived:
+            del self.derived_terms[super_term]
+
+        self._clear()
+
+    def _clear(self):
+        if self._ancestors or self._descendants:
+            self._ancestors = {}
+            self._descendants = {}
+
+    def update(self, other):
+        """Add the super terms from another index"""
+
+        for term, super_term in other.super_terms.items():
+            self.add(term, super_term)
+
+    def expand(self, term):
+        """Return a list of the terms derived from a term, in name order, followed by the term"""
+
+        return sorted(self.derived_terms.get(term.lower(), ())) + [term]
+
+    def ancestors(self, term):
+        """Return a tuple of the super terms of a term, transitively, nearest first. A cycle of InheritsFrom
+        ends at the first repeated term"""
+
+        term = term.lower()
+
+        try:
+            return self._ancestors[term]
+        except KeyError:
+            pass
+
+        chain = []
+        t = self.super_terms.get(term)
+
+        while t is not None and t != term and t not in chain:
+            chain.append(t)
+            t = self.super_terms.get(Term.normalize_term(t))
+
+        self._ancestors[term] = tuple(chain)
+
+        return self._ancestors[term]
+
+    def descendants(self, term):
+        """Return a frozenset of the terms derived from a term, transitively"""
+
+        term = term.lower()
+
+        try:
+            return self._descendants[term]
+        except KeyError:
+            pass
+
+        found = set()
+        stack = [term]
+
+        while stack:
+            for d in self.derived_terms.get(stack.pop(), ()):
+                if d not in found and d != term:
+                    found.add(d)
+                    stack.append(d)
+
+        self._descendants[term] = frozenset(found)
+
+        return self._descendants[term]
+
+
 class TermParser(object):
     """Takes a stream of terms and sets the parameter map, valid term names, etc """
 
@@ -39,10 +191,20 @@ class TermParser(object):
         'root.root': 'metatab.terms.RootSectionTerm'
     }
 
-    def __init__(self, ref,  resolver=None, doc=None, remove_special=True):
+    # Rows of declaration documents, by url, for declaration_rows(), in least recently used order
+    _declaration_rows = OrderedDict()
+
+    declaration_cache_size = 32  # Maximum number of declaration documents in _declaration_rows
+    remote_declaration_ttl = 300  # Seconds before the rows of a remote declaration are fetched again
+
+    def __init__(self, ref,  resolver=None, doc=None, remove_special=True, stats=None, tolerant=None):
         """
         :param term_gen: an an iterator that generates terms
         :param remove_special: If true ( default ) remove the special terms from the stream
+        :param stats: A ParseStats to record parse times and counts in. Defaults to the document's stats
+        :param tolerant: If true, record errors in includes, declarations and terms without a parent term in
+            errors, skip the include or term, and continue parsing, rather than raising an exception. Defaults to
+            the document's tolerant
         :return:
         """
 
@@ -56,7 +218,7 @@ class TermParser(object):
         if isinstance(ref, (Url, Source)):
             self._ref = ref
         else:
-            self._ref = parse_app_url(ref)
+            self._ref = parse_app_url(ref, downloader=self.resolver.downloader)
 
         assert isinstance(self._ref, (Url, Source)), (type(ref), ref)
 
@@ -72,15 +234,43 @@ class TermParser(object):
         self._declared_sections = {}  # Declared sections and their arguments
         self._declared_terms = {}  # Pre-defined terms, plus TermValueName and ChildPropertyType
 
-        self.errors = set()
+        self._section_terms = {}  # Sets of the term names in each declared section's term list
+        self._section_children = {}  # Section -> parent record term -> names of the section's child terms
+        self._inherited = {}  # Memoized (section, record term) -> inherited children, for inherited_children()
+        self._valueset_terms = {}  # Value set name -> {term name: declared term}, for terms with a ValueSetName
+        self._synonyms = {}  # Term name -> the term it is a synonym for
+        self._term_records = {}  # Term name -> DeclaredTerm, built on first use
+
+        self.errors = []
+        self.sources = []  # Urls of the included and declaration documents, as they are resolved
+        self.tolerant = tolerant if tolerant is not None else getattr(doc, 'tolerant', False)
 
         if self.doc:
             self.root = self.doc.root
+            self.super_index = self.doc.super_index
         else:
             self.root = RootSectionTerm(file_name=self.path, doc=self.doc)
+            self.super_index = SuperTermIndex()
 
         self.install_declare_terms()
 
+        self.stats = stats if stats is not None else getattr(doc, 'stats', None)
+
+        if self.stats is not None:
+            self.instrument(self.stats)
+
+    def instrument(self, stats):
+        """Replace the methods for the phases of parsing with ones that record their times in stats.
+        Uninstrumented parsers don't make any timing calls. """
+
+        for phase, names in (('resolve', ('find_include_doc', 'find_declare_doc', 'declaration_rows',
+                                          'include_rows')),
+                             ('term_class', ('get_term_class',)),
+                             ('synonyms', ('substitute_synonym',)),
+                             ('declarations', ('manage_declare_terms',))):
+            for name in names:
+                setattr(self, name, stats.timed(phase, getattr(self, name)))
+
     @property
     def path(self):
         """Return the path from the row generator, if it is avilable"""
@@ -105,31 +295,21 @@ class TermParser(object):
     @property
     def synonyms(self):
         """Return a dict of term synonyms"""
-        syns = {}
-
-        for k, v in self._declared_terms.items():
-            k = k.strip()
-            if v.get('synonym'):
-                syns[k.lower()] = v['synonym']
-
-                if not '.' in k:
-                    syns[ROOT_TERM + '.' + k.lower()] = v['synonym']
+        return self._synonyms
 
-        return syns
+    @staticmethod
+    def _synonym_keys(term_name):
+        k = term_name.strip().lower()
+        return (k,) if '.' in k else (k, ROOT_TERM + '.' + k)
 
 
-    @lru_cache()
     def super_terms(self):
         """Return a dictionary mapping term names to their super terms"""
+        return self.super_index.super_terms
 
-        # If the doc already has super terms, we've already parsed something, so
-        # assume we parsed the declaration, and can use re-use the old decls.
-        if self.doc and self.doc.super_terms:
-            return self.doc.super_terms
-
-
-        return  {k.lower(): v['inheritsfrom'].lower()
-                         for k, v in self._declared_terms.items() if 'inheritsfrom' in v}
+    def derived_terms(self):
+        """Return a dictionary mapping term names to the sets of terms derived from them"""
+        return self.super_index.derived_terms
 
     @property
     def declare_dict(self):
@@ -144,9 +324,23 @@ class TermParser(object):
             'synonyms': self.synonyms
         }
 
+    def term_record(self, term_name):
+        """Return the DeclaredTerm record for a lowercased, qualified term name"""
+
+        try:
+            return self._term_records[term_name]
+        except KeyError:
+            pass
+
+        dt = self._term_records[term_name] = DeclaredTerm.from_declaration(self._declared_terms.get(term_name))
+
+        return dt
+
     def install_declare_terms(self):
         """Set pre-defined terms that are requred for parsing declaration documents"""
 
+        self._term_records.clear()
+
         self._declared_terms.update({
             'root.section': {'termvaluename': 'name'},
             'root.synonym': {'termvaluename': 'term', 'childpropertytype': 'sequence'},
@@ -209,29 +403,54 @@ class TermParser(object):
         except KeyError:
             pass
 
-        try:
-            return import_name_or_class(self.term_classes[self.super_terms()[tnl]])
-        except KeyError:
-            pass
+        for super_term in self.super_index.ancestors(tnl):
+            try:
+                return import_name_or_class(self.term_classes[super_term])
+            except KeyError:
+                pass
 
         return Term
 
+    def add_error(self, e, term=None):
+        """Record a parse error, setting its term, if it doesn't have one"""
+
+        if term is not None and getattr(e, 'term', None) is None:
+            e.term = term
+
+        self.errors.append(e)
+
+    @staticmethod
+    def _include_error(e):
+        """Return an IncludeError for an exception from resolving an include or declaration"""
+
+        if isinstance(e, IncludeError):
+            return e
+
+        return IncludeError("Failed to Include; {}: {}".format(type(e).__name__, e))
+
     def errors_as_dict(self):
-        """Return parse errors as a dict"""
+        """Return parse errors as a list of dicts, in the order they happened"""
         errors = []
 
         for e in self.errors:
 
+            term = getattr(e, 'term', None)
+
             errors.append({
-                'file': e.term.file_name,
-                'row': e.term.row if e.term else '<unknown>',
-                'col': e.term.col if e.term else '<unknown>',
-                'term': e.term.join if e.term else '<unknown>',
+                'file': term.file_name if term else self.path,
+                'row': term.row if term else '<unknown>',
+                'col': term.col if term else '<unknown>',
+                'term': term.join if term else '<unknown>',
+                'type': type(e).__name__,
                 'error': str(e)
             })
 
         return errors
 
+    def error_summary(self):
+        """Return a summary of the parse errors, with error_summary()"""
+        return error_summary(self.errors_as_dict())
+
     def find_declare_doc(self, d, name):
         """Given a name, try to resolve the name to a path or URL to
         a declaration document. It will try:
@@ -277,18 +496,28 @@ class TermParser(object):
 
             raise IncludeError("No local declaration file for '{}'".format(name))
 
-        return parse_app_url(path)
+        return parse_app_url(path, downloader=self.resolver.downloader)
 
-    def find_include_doc(self, d, name):
+    def find_include_doc(self, d, name, source=None):
         """Resolve a name or path for an include doc to a an absolute path or url
         :param name:
+        :param source: The row generator of the including document. Relative includes in a document read
+            from a ZIP archive are members of the same archive.
         """
         from metatab import parse_app_url
+        from metatab.rowgen import ZipMetadataSource
 
         include_ref = name.strip('/')
 
         if include_ref.startswith('http'):
             path = include_ref
+        elif isinstance(source, ZipMetadataSource):
+            url = source.member_url(include_ref)
+
+            if url.target_file == source.member().filename:
+                raise IncludeError("Include loop for '{}' ".format(url))
+
+            return url
         else:
             if not d:
                 raise IncludeError("Can't include '{}' because don't know current path "
@@ -296,7 +525,52 @@ class TermParser(object):
 
             path = join(d, include_ref)
 
-        return parse_app_url(path)
+        # Included files are Metatab documents, so Lines files get the Lines row generator
+        return parse_app_url(path, proto='metatab', downloader=self.resolver.downloader)
+
+    def declaration_rows(self, url):
+        """Return a row generator for a declaration document. The rows of the most recently used declarations
+        are cached for the process, since most documents declare the same few declarations; local files are read
+        again if they have changed, and remote ones after remote_declaration_ttl seconds."""
+        from metatab.rowgen import MetatabRowGenerator
+
+        key = str(url)
+        cache = TermParser._declaration_rows
+
+        if url.scheme == 'file':
+            try:
+                mtime = getmtime(url.path)
+            except OSError:
+                mtime = None
+        else:
+            mtime = None
+
+        try:
+            cached_mtime, loaded, rows = cache[key]
+
+            if cached_mtime != mtime or (mtime is None and time() - loaded > self.remote_declaration_ttl):
+                raise KeyError(key)
+
+            cache.move_to_end(key)
+
+        except KeyError:
+            rows = [list(row) for row in get_generator(url.get_resource().get_target())]
+            cache[key] = (mtime, time(), rows)
+
+            while len(cache) > self.declaration_cache_size:
+                cache.popitem(last=False)
+
+        return MetatabRowGenerator(rows, path=key)
+
+    def include_rows(self, url):
+        """Return a row generator for an included document. Documents in local ZIP archives, including the
+        members that the relative includes of a ZIP package refer to, are read directly from the archive. """
+        from metatab.rowgen import ZipMetadataSource
+
+        if url.scheme == 'file' and url.resource_format == 'zip' and exists(url.path):
+            return ZipMetadataSource(url.path, member=url.target_file)
+
+        return get_generator(url.get_resource().get_target())
 
     def generate_terms(self, ref, root, file_type=None):
         """An generator that yields term objects, handling includes and argument
@@ -313,14 +587,17 @@ class TermParser(object):
 
         if isinstance(ref, Source):
             row_gen = ref
-            ref_path = row_gen.__class__.__name__
+            # Included documents arrive as sources; use the source's URL, so their own includes can be resolved
+            ref_path = ref.ref.path if isinstance(ref.ref, Url) else row_gen.__class__.__name__
         else:
             row_gen = get_generator(ref)
             ref_path = ref.path
 
 
+        rows = row_gen if self.stats is None else self.stats.rows(ref_path, row_gen)
+
         try:
-            for line_n, row in enumerate(row_gen, 1):
+            for line_n, row in enumerate(rows, 1):
 
                 if not row or not row[0] or not row[0].strip() or row[0].strip().startswith('#'):
                     continue
@@ -342,34 +619,60 @@ class TermParser(object):
 
                 if t.term_is('include') or t.term_is('declare'):
 
-                    if t.term_is('include'):
-                        resolved = self.find_include_doc(dirname(ref_path), t.value.strip())
-                    else:
-                        resolved = self.find_declare_doc(dirname(ref_path), t.value.strip())
+                    include_term = t
+
+                    try:
+                        if t.term_is('include'):
+                            resolved = self.find_include_doc(dirname(ref_path), t.value.strip(), row_gen)
+                        else:
+                            resolved = self.find_declare_doc(dirname(ref_path), t.value.strip())
 
-                    if row_gen.ref == resolved:
-                        raise IncludeError("Include loop for '{}' ".format(resolved))
+                        if row_gen.ref == resolved:
+                            raise IncludeError("Include loop for '{}' ".format(resolved))
+
+                    except Exception as e:
+                        if not self.tolerant:
+                            raise
+
+                        self.add_error(self._include_error(e), include_term)
+                        yield include_term
+                        continue
+
+                    self.sources.append(resolved)
 
                     yield t
 
                     try:
 
-                        sub_gen = get_generator(resolved.get_resource().get_target())
+                        if t.term_is('declare'):
+                            sub_gen = self.declaration_rows(resolved)
+                        else:
+                            sub_gen = self.include_rows(resolved)
 
                         for t in self.generate_terms(sub_gen, root, file_type=t.record_term_lc):
                             yield t
 
-                        if last_section:
-                            yield last_section  # Re-assert the last section
-
                     except IncludeError as e:
-                        e.term = t
-                        raise
+                        if not self.tolerant:
+                            e.term = t
+                            raise
+
+                        self.add_error(e, include_term)
+
+                    except Exception as e:
+                        if not self.tolerant and not isinstance(e, (OSError, GenerateError, DownloadError)):
+                            raise
 
-                    except (OSError,  FileNotFoundError, GenerateError, DownloadError) as e:
                         e = IncludeError("Failed to Include; {}".format(e))
-                        e.term = t
-                        raise e
+
+                        if not self.tolerant:
+                            e.term = t
+                            raise e
+
+                        self.add_error(e, include_term)
+
+                    if last_section:
+                        yield last_section  # Re-assert the last section
 
                     continue  # Already yielded the include/declare term, and includes can't have children
 
@@ -426,13 +729,16 @@ class TermParser(object):
         except AttributeError as e:
             target = self._ref # Hopefully a generator
 
+        stats = self.stats
+
         try:
 
             for i, t in enumerate(self.generate_terms(target, self.root)):
 
-                # Substitute synonyms
-                if t.join_lc in self.synonyms:
-                    t.parent_term, t.record_term = Term.split_term_lower(self.synonyms[t.join_lc]);
+                if stats is not None:
+                    t0 = perf_counter()
+
+                self.substitute_synonym(t)
 
                 # Remap integer record terms to names from the parameter map
                 try:
@@ -472,48 +778,68 @@ class TermParser(object):
 
                     # Case for normal, value-bearing terms
 
-                    t.child_property_type = self._declared_terms \
-                        .get(t.join, {}) \
-                        .get('childpropertytype', 'any')
+                    dt = self.term_record(t.join_lc)
 
-                    t.term_value_name = self._declared_terms \
-                        .get(t.join, {}) \
-                        .get('termvaluename', default_term_value_name)
-
-                    t.valid = t.join_lc in self._declared_terms  # advisory.
-
-                    t.options = self._declared_terms \
-                        .get(t.join, {}) \
-                        .get('options', '').split(',')
+                    t.child_property_type = dt.child_property_type
+                    t.term_value_name = dt.term_value_name or default_term_value_name
+                    t.valid = dt.valid  # advisory.
+                    t.options = dt.options
 
                     # Only terms with the term name in the first column can be parents of
                     # other terms. This rule excludes argument terms and terms with an elided parent
 
+                    can_be_parent = False
+
                     if t.has_elided_parent:
                         # Elided parent terms refer to the last term that can be a parent
                         t.parent_term = last_parent_term # After this t.has_elided_parent will be False
 
-                        last_term_map[last_parent_term].add_child(t)
+                        parent = last_term_map[last_parent_term]
 
                     elif t.is_arg_child:
-                        last_term_map[last_parent_term].add_child(t)
+                        parent = last_term_map[last_parent_term]
 
                     else:
+                        can_be_parent = True
                         last_parent_term = t.record_term
                         last_term_map[ELIDED_TERM] = t
                         last_term_map[t.record_term] = t
 
                         try:
-                            last_term_map[t.parent_term].add_child(t)
+                            parent = last_term_map[t.parent_term]
                         except KeyError:
-                            raise ParserError("No parent term for '{}' in term '{}', row = {}"
-                                              .format(t.parent_term, t.term, t.row))
+                            e = ParserError("No parent term for '{}' in term '{}', row = {}"
+                                            .format(t.parent_term, t.term, t.row))
+                            e.term = t
+
+                            if not self.tolerant:
+                                raise e
+
+                            self.add_error(e)
+                            parent = SKIPPED_TERM
+
+                    if parent is SKIPPED_TERM:
+                        # In tolerant mode, the term and its children are dropped with the term that failed
+                        if can_be_parent:
+                            last_term_map[ELIDED_TERM] = last_term_map[t.record_term] = SKIPPED_TERM
+                        continue
+
+                    parent.add_child(t)
 
                     if t.parent_term_lc == 'root':
                         last_section.add_term(t)
 
+                if stats is not None:
+                    stats.term(t, perf_counter() - t0)
+
                 if t.file_type == 'declare':
-                    self.manage_declare_terms(t)
+                    try:
+                        self.manage_declare_terms(t)
+                    except DeclarationError as e:
+                        if not self.tolerant:
+                            raise
+
+                        self.add_error(e, t)
                     # Declare terms aren't part of document, so they aren't yieled
                 else:
 
@@ -521,7 +847,7 @@ class TermParser(object):
 
         except IncludeError as e:
             assert e is not None
-            self.errors.add(e)
+            self.add_error(e)
             raise
 
     def manage_declare_terms(self, t):
@@ -535,8 +861,6 @@ class TermParser(object):
         elif t.term_is('value.*'):
             self.add_value_set_value(t)
 
-        self.super_terms.cache_clear()
-
     def add_declared_section(self, t):
 
         self._declared_sections[t.value.lower()] = {
@@ -544,6 +868,66 @@ class TermParser(object):
             'terms': []
         }
 
+        self._section_terms.pop(t.value.lower(), None)
+        self._section_children.pop(t.value.lower(), None)
+        self._inherited.clear()
+
+    def _index_section(self, section_name):
+        """Return the set of term names in a declared section, and the term names indexed by the record term
+        of their parent, building them from the section's term list if they haven't been"""
+
+        try:
+            return self._section_terms[section_name], self._section_children[section_name]
+        except KeyError:
+            pass
+
+        members = self._section_terms[section_name] = set()
+        children = self._section_children[section_name] = {}
+
+        for term_name in self._declared_sections[section_name]['terms']:
+            self._index_section_term(section_name, term_name)
+
+        return members, children
+
+    def _index_section_term(self, section_name, term_name):
+
+        self._section_terms[section_name].add(term_name)
+
+        parent, record = Term.split_term_lower(term_name)
+        self._section_children[section_name].setdefault(parent, []).append(term_name)
+
+    def _inherited_records(self, section_name, super_term, seen=()):
+        """Return an OrderedDict of the record terms of the children that a term inherits from a super term in a
+        section, to the name of the declared child term. The children are the super term's own children in
+        the section, then those that it inherits from its own super term, transitively, that it doesn't
+        override. The results are memoized until a term is declared. """
+
+        key = (section_name, super_term)
+
+        try:
+            return self._inherited[key]
+        except KeyError:
+            pass
+
+        _, children = self._index_section(section_name)
+
+        records = OrderedDict()
+
+        for term_name in children.get(Term.split_term_lower(super_term)[1], ()):
+            records.setdefault(Term.split_term_lower(term_name)[1], term_name)
+
+        next_super = self.super_index.super_terms.get(super_term)
+        next_super = Term.normalize_term(next_super) if next_super else None
+
+        if next_super and next_super != super_term and next_super not in seen:
+            inherited = self._inherited_records(section_name, next_super, seen + (super_term,))
+            for record, term_name in inherited.items():
+                records.setdefault(record, term_name)
+
+        self._inherited[key] = records
+
+        return records
+
     def inherited_children(self, t):
         """Generate inherited children based on a terms InhertsFrom property.
         The input term must have both an InheritsFrom property and a defined Section
@@ -559,25 +943,22 @@ class TermParser(object):
                                    .format(t['term']))
 
         t_p, t_r = Term.split_term(t['term'])
-        ih_p, ih_r = Term.split_term(t['inheritsfrom'])
 
-        # The inherited terms must come from the same section
-        section_terms = self._declared_sections[t['section'].lower()]['terms']
+        # The inherited terms must come from the same section. For each of the children of the
+        # term that the input term inherits from, yield the child after changing the term name to
+        # be a child of the input term.
+        super_term = Term.normalize_term(t['inheritsfrom'])
 
-        # For each of the terms in the section, look for terms that are children
-        # of the term that the input term inherits from. Then yield each of those terms
-        # after chang the term name to be a child of the input term.
-        for st_name in section_terms:
-            if st_name.lower().startswith(ih_r.lower() + '.'):
-                st_p, st_r = Term.split_term(st_name)
-                # Yield the term, but replace the parent part
-                subtype_name = t_r + '.' + st_r
+        for st_name in list(self._inherited_records(t['section'].lower(), super_term).values()):
+            st_p, st_r = Term.split_term(st_name)
+            # Yield the term, but replace the parent part
+            subtype_name = t_r + '.' + st_r
 
-                subtype_d = dict(self._declared_terms[st_name.lower()].items())
-                subtype_d['inheritsfrom'] = '';
-                subtype_d['term'] = subtype_name
+            subtype_d = dict(self._declared_terms[st_name.lower()].items())
+            subtype_d['inheritsfrom'] = ''
+            subtype_d['term'] = subtype_name
 
-                yield subtype_d
+            yield subtype_d
 
     def add_declared_term(self, t):
         from .exc import DeclarationError
@@ -588,7 +969,14 @@ class TermParser(object):
         td['values'] = {}
         td['term'] = t.value
 
-        self._declared_terms[term_name] = td
+        self.set_declared_term(term_name, td)
+
+        if td.get('inheritsfrom'):
+            self.super_index.add(term_name, td['inheritsfrom'])
+        else:
+            self.super_index.remove(term_name)
+
+        self._inherited.clear()
 
         def add_term_to_section(td):
 
@@ -599,27 +987,51 @@ class TermParser(object):
                                         "previously declared with DeclareSection, in '{}'")
                                        .format(section_name, t.file_name))
 
-            st = self._declared_sections[td['section'].lower()]['terms']
-
-            if td['term'] not in st:  # Should be a set, but I frequently print JSON for debugging
+            members, _ = self._index_section(section_name)
 
-                st.append(td['term'])
+            # The list is kept for the declare_dict, and the set and children for lookups
+            if td['term'] not in members:
+                self._declared_sections[section_name]['terms'].append(td['term'])
+                self._index_section_term(section_name, td['term'])
+                self._inherited.clear()
 
         if td.get('section'):
             add_term_to_section(td)
 
         for t in self.inherited_children(td):
-            self._declared_terms[Term.normalize_term(t['term'])] = t
+            self.set_declared_term(Term.normalize_term(t['term']), t)
             add_term_to_section(t)
 
+    def set_declared_term(self, term_name, td):
+        """Set the declaration for a term, and index it by its value set name and synonym"""
+
+        old = self._declared_terms.get(term_name)
+
+        if old is not None:
+            if 'valuesetname' in old:
+                self._valueset_terms.get(old['valuesetname'].lower(), {}).pop(term_name, None)
+
+            if old.get('synonym'):
+                for k in self._synonym_keys(term_name):
+                    self._synonyms.pop(k, None)
+
+        self._declared_terms[term_name] = td
+        self._term_records.pop(term_name, None)
+
+        if 'valuesetname' in td:
+            self._valueset_terms.setdefault(td['valuesetname'].lower(), {})[term_name] = td
+
+        if td.get('synonym'):
+            for k in self._synonym_keys(term_name):
+                self._synonyms[k] = td['synonym']
+
     def add_value_set_value(self, t):
 
         vs_name = t.parent.join_lc
         value = t.value
         disp_value = t.arg_props.get('displayvalue')
 
-        for k, v in self._declared_terms.items():
-            if 'valuesetname' in v and vs_name == v['valuesetname'].lower():
-                if value not in v['values']:
-                    v['values'][value] = disp_value
+        for v in self._valueset_terms.get(vs_name, {}).values():
+            if value not in v['values']:
+                v['values'][value] = disp_value
 
@@ -0,0 +1,134 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Profile metatab operations, with cProfile and with a sampling profiler.
+
+cProfile results are written as pstats files, for pstats, snakeviz and similar tools. The sampling profiler
+records the stack of the profiled thread at intervals, and writes the stacks in the collapsed format of
+Brendan Gregg's flamegraph.pl, speedscope and similar tools: one line per distinct stack, with frames
+separated by ';', followed by the number of samples.
+
+Sampled stacks are annotated with the document, the file or include, and the section that were being
+processed, as pseudo-frames like ``[doc metadata.csv]``, read from the locals of the functions in
+ANNOTATIONS. Nothing is added to the parser, so unprofiled runs are not slowed down.
+"""
+
+import sys
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from os.path import basename
+
+# (module path, function name): ((label, local name), ...) for pseudo-frames after the function's frame
+ANNOTATIONS = {
+    ('metatab/cli.py', 'process_file'): (('doc', 'path'),),
+    ('metatab/doc.py', '__init__'): (('doc', 'ref'),),
+    ('metatab/parser.py', 'generate_terms'): (('file', 'ref_path'), ('section', 'last_section')),
+}
+
+
+def _label(v):
+    """Return a label for an annotation value, without the separators of the collapsed format"""
+
+    if hasattr(v, 'record_term') and hasattr(v, 'value'):  # A section term
+        v = v.value
+    elif not isinstance(v, str) and type(v).__str__ is object.__str__:  # A row generator, with no better name
+        v = type(v).__name__
+
+    return str(v).replace(';', ',').replace('\n', ' ')
+
+
+class Sampler(object):
+    """Sample the stack of a thread at intervals, in a background thread"""
+
+    def __init__(self, interval=0.001, thread_id=None):
+        """
+        :param interval: Seconds between samples
+        :param thread_id: Identifier of the thread to sample. Defaults to the thread that creates the sampler
+        """
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.stacks = defaultdict(int)
+
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name='metatab-sampler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+
+            if frame is not None:
+                self.stacks[self.collapse(frame)] += 1
+
+            del frame
+
+    @staticmethod
+    def collapse(frame):
+        """Return the collapsed stack for a frame, from the outermost frame"""
+
+        names = []
+
+        while frame is not None:
+            code = frame.f_code
+            file_name = basename(code.co_filename)
+            module_path = '/'.join(code.co_filename.replace('\\', '/').split('/')[-2:])
+
+            for label, local in reversed(ANNOTATIONS.get((module_path, code.co_name), ())):
+                v = frame.f_locals.get(local)
+                if v is not None:
+                    names.append('[{} {}]'.format(label, _label(v)))
+
+            names.append('{} ({}:{})'.format(code.co_name, file_name, code.co_firstlineno))
+
+            frame = frame.f_back
+
+        return ';'.join(reversed(names))
+
+    def write(self, path):
+
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('{} {}\n'.format(stack, count))
+
+
+@contextmanager
+def profiled(prefix='metatab-profile', mode='both', interval=0.001):
+    """Profile the code in the context, writing the pstats to prefix + '.pstats' and the sampled stacks to
+    prefix + '.collapsed'. The files are written even if the code raises an exception or exits.
+
+    :param prefix: Path prefix for the output files
+    :param mode: 'cprofile', 'sample', or 'both'. With both, the samples include cProfile's overhead
+    :param interval: Seconds between samples
+    """
+    import cProfile
+
+    profiler = cProfile.Profile() if mode in ('cprofile', 'both') else None
+    sampler = Sampler(interval) if mode in ('sample', 'both') else None
+
+    if sampler:
+        sampler.start()
+
+    if profiler:
+        profiler.enable()
+
+    try:
+        yield profiler, sampler
+    finally:
+        if profiler:
+            profiler.disable()
+            profiler.dump_stats(prefix + '.pstats')
+
+        if sampler:
+            sampler.stop()
+            sampler.write(prefix + '.collapsed')
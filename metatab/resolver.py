@@ -5,31 +5,380 @@
 Generate rows from a variety of paths, references or other input
 """
 
+import json
+import threading
+from os import environ
+from os.path import dirname
+from time import time
+
+from rowgenerators.appurl.web.download import Downloader
+
 from .exc import IncludeError, GenerateError
 
-class WebResolver(object):
 
-    def fetch_row_source(self, url):
-        pass
+class HttpDownloader(Downloader):
+    """A Downloader that fetches http and https urls through a pooled session, with keep-alive connections,
+    timeouts, retries with backoff, and a limit on concurrent requests per host. Files that are already in the
+    cache are revalidated with conditional requests, using the ETag and Last-Modified headers of the response
+    that stored them, so unchanged files are not downloaded again. Files that were fetched or revalidated within
+    max_age seconds are used without a request, and if a request fails, the cached file, if there is one, is used
+    rather than raising an error.
 
-    def find_decl_doc(self, name):
+    Other schemes are handled by the base Downloader.
+    """
 
+    chunk_size = 64 * 1024
 
-        raise IncludeError(name)
+    # Record hits and misses with the cache manager
+    track_use = True
+
+    def __init__(self, cache=None, timeout=(5, 30), retries=3, backoff_factor=0.5, max_per_host=4,
+                 pool_size=10, max_age=300, **kwargs):
+        """
+        :param cache: A PyFs filesystem object for caching files
+        :param timeout: Connect and read timeouts, in seconds
+        :param retries: Number of times to retry failed connections and 5xx responses
+        :param backoff_factor: Retries wait backoff_factor * 2^(retry - 1) seconds
+        :param max_per_host: Maximum number of concurrent requests to a single host
+        :param pool_size: Number of connections kept alive per host
+        :param max_age: Seconds after a file is fetched or revalidated that it is used without revalidating it
+        :param kwargs: Passed to Downloader
+        """
+
+        super().__init__(cache, **kwargs)
+
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff_factor = backoff_factor
+        self.max_per_host = max_per_host
+        self.pool_size = pool_size
+        self.max_age = max_age
+
+        self._session = None
+        self._host_semaphores = {}
+        self._lock = threading.Lock()
+
+    @property
+    def session(self):
+        """A requests Session, with retrying adapters for http and https, created on first use"""
+
+        if self._session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+
+            retry = Retry(total=self.retries, backoff_factor=self.backoff_factor,
+                          status_forcelist=(500, 502, 503, 504),
+                          allowed_methods=('HEAD', 'GET'),
+                          raise_on_status=False)
+
+            adapter = HTTPAdapter(pool_connections=self.pool_size, pool_maxsize=self.pool_size,
+                                  max_retries=retry)
+
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+
+            self._session = session
+
+        return self._session
+
+    def host_semaphore(self, url):
+        """Return the semaphore that limits concurrent requests to the url's host"""
+        from urllib.parse import urlparse
+
+        host = urlparse(url).netloc
+
+        with self._lock:
+            try:
+                return self._host_semaphores[host]
+            except KeyError:
+                s = self._host_semaphores[host] = threading.BoundedSemaphore(self.max_per_host)
+                return s
+
+    def request(self, method, url, **kwargs):
+        """Make a request through the session, limited by the host semaphore"""
+
+        with self.host_semaphore(url):
+            return self.session.request(method, url, timeout=self.timeout, **kwargs)
+
+    def _download_with_lock(self, url):
+
+        if url.startswith(('http:', 'https:')):
+            return self.fetch(url)
+        else:
+            return super()._download_with_lock(url)
+
+    def _read_validators(self, meta_path):
 
-        import requests
-        from requests.exceptions import InvalidSchema
-        url = METATAB_ASSETS_URL + name + '.csv'
         try:
-            # See if it exists online in the official repo
-            r = requests.head(url, allow_redirects=False)
-            if r.status_code == requests.codes.ok:
+            with self.cache.open(meta_path, 'r') as f:
+                return json.load(f)
+        except Exception:
+            return {}
+
+    def fetch(self, url):
+        """Fetch a url into the cache, returning the cache path and the download time. If the cached copy is
+        still valid, the time is None.
+
+        Only one process fetches a url at a time; processes that wait for the lock on the entry reuse the file
+        that the lock holder fetched, if it was fetched while they were waiting, or within max_age seconds
+        before. """
+        from metatab.cache import cache_lock
+
+        cache_path = self.cache_path(url)
+        meta_path = cache_path + '.validators'
+
+        waiting_since = time()
+
+        self.cache.makedirs(dirname(cache_path), recreate=True)
+
+        with cache_lock(self.cache, cache_path):
+
+            if not self.clean and self._validated_since(meta_path, waiting_since - self.max_age):
+                self._record_use(cache_path, True)
+                return cache_path, None
+
+            return self._fetch(url, cache_path, meta_path)
+
+    def _validated_since(self, meta_path, t):
+        """Return true if the file for a validators file was fetched or revalidated since time t"""
+        from fs.errors import ResourceNotFound
+
+        try:
+            return self.cache.getinfo(meta_path, namespaces=['details']).raw['details']['modified'] >= t
+        except ResourceNotFound:
+            return False
+
+    def _fetch(self, url, cache_path, meta_path):
+        from os import utime
+        from requests.exceptions import RequestException
+        from rowgenerators.exceptions import AccessError, DownloadError
+        from metatab.cache import atomic_write
+
+        headers = {}
+
+        cached = self.cache.exists(cache_path) and not self.clean
+
+        if cached:
+            validators = self._read_validators(meta_path)
+
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        self.callback('download', url)
+
+        try:
+            r = self.request('GET', url, headers=headers, stream=True)
+        except RequestException as e:
+            if cached:  # Serve the stale file while the host is unreachable
+                self._record_use(cache_path, True)
+                return cache_path, None
+
+            raise DownloadError("Failed to GET {}: {}".format(url, e))
+
+        with r:
+            if r.status_code != 200:
+                r.content  # Consume the body, so the connection goes back to the pool, rather than closing
+
+            if r.status_code == 304:
+                # Mark the time of the revalidation, for processes waiting on the lock
+                if self.cache.hassyspath(meta_path):
+                    utime(self.cache.getsyspath(meta_path))
+
+                self._record_use(cache_path, True)
+                return cache_path, None
+
+            if cached and r.status_code >= 500:  # Serve the stale file while the server is failing
+                self._record_use(cache_path, True)
+                return cache_path, None
+
+            if r.status_code == 403:
+                raise AccessError("Access error on download: {} {}".format(r.status_code, url))
+            elif not r.ok:
+                raise DownloadError("Failed to download: {} {}".format(r.status_code, url))
+
+            # Written to temporary files, then renamed, so a partial file never looks like a complete one
+            with atomic_write(self.cache, cache_path) as f:
+                for chunk in r.iter_content(self.chunk_size):
+                    f.write(chunk)
+
+            with atomic_write(self.cache, meta_path, 'w') as f:
+                json.dump({'url': url,
+                           'etag': r.headers.get('ETag'),
+                           'last_modified': r.headers.get('Last-Modified')}, f)
+
+        self._record_use(cache_path, False)
+
+        return cache_path, time()
+
+    def _record_use(self, cache_path, hit):
+
+        if self.track_use:
+            from metatab.cache import get_cache_manager
+            get_cache_manager(self.cache).record(cache_path, hit)
+
+
+MANIFEST_FILE = 'manifest.json'
+
+
+def read_manifest(path):
+    """Return the url map from a mirror's manifest, or an empty dict if the mirror has no manifest"""
+    from os.path import join, exists
+
+    manifest_path = join(path, MANIFEST_FILE)
+
+    if not exists(manifest_path):
+        return {}
+
+    with open(manifest_path) as f:
+        return json.load(f)['urls']
+
+
+def mirror_dir(mirror):
+    """Return the directory for a mirror. Mirrors that are ZIP archives are extracted into the cache, once for
+    each version of the archive. Archives are extracted into a temporary directory, which is renamed into place,
+    so other processes never see a partly extracted mirror. """
+    from os import getpid, replace
+    from os.path import isdir, getmtime, basename
+    from shutil import rmtree
+    from zipfile import ZipFile
+    from metatab.cache import cache_lock
 
-                return url
+    if isdir(mirror):
+        return mirror
 
-        except InvalidSchema:
-            pass  # It's probably FTP
+    from metatab.util import get_cache
 
+    cache_dir = 'mirrors/{}-{}'.format(basename(mirror), int(getmtime(mirror)))
+
+    cache = get_cache()
+
+    if cache.exists(cache_dir):
+        return cache.getsyspath(cache_dir)
+
+    cache.makedirs('mirrors', recreate=True)
+
+    with cache_lock(cache, cache_dir):
+        if not cache.exists(cache_dir):  # Another process may have extracted it while this one waited
+            tmp_dir = cache.getsyspath('{}.tmp-{}-{}'.format(cache_dir, getpid(), threading.get_ident()))
+
+            try:
+                with ZipFile(mirror) as zf:
+                    zf.extractall(tmp_dir)
+
+                replace(tmp_dir, cache.getsyspath(cache_dir))
+            finally:
+                rmtree(tmp_dir, ignore_errors=True)
+
+    return cache.getsyspath(cache_dir)
+
+
+class MirrorDownloader(Downloader):
+    """A Downloader that never uses the network. Remote urls are served from a mirror directory, or an archive
+    of one, through the url map in the mirror's manifest. Urls that are not in the mirror raise a DownloadError.
+    """
+
+    def __init__(self, mirror, **kwargs):
+        from fs.osfs import OSFS
+
+        self.path = mirror_dir(mirror)
+
+        super().__init__(OSFS(self.path), **kwargs)
+
+        self.manifest = read_manifest(self.path)
+
+    def _download_with_lock(self, url):
+        from rowgenerators.exceptions import DownloadError
+
+        try:
+            return self.manifest[url], None
+        except KeyError:
+            raise DownloadError("Url '{}' is not in the mirror at '{}'".format(url, self.path))
+
+
+class SnapshotDownloader(HttpDownloader):
+    """An HttpDownloader that downloads into a mirror directory and records each url in the mirror's manifest"""
+
+    track_use = False
+
+    def __init__(self, mirror, **kwargs):
+        from fs.osfs import OSFS
+
+        self.path = mirror
+
+        super().__init__(OSFS(mirror, create=True), **kwargs)
+
+        self.manifest = read_manifest(self.path)
+
+    def _download_with_lock(self, url):
+
+        cache_path, download_time = super()._download_with_lock(url)
+
+        self.manifest[url] = cache_path
+
+        return cache_path, download_time
+
+    def write_manifest(self):
+
+        with self.cache.open(MANIFEST_FILE, 'w') as f:
+            json.dump({'urls': self.manifest}, f, indent=4, sort_keys=True)
+
+
+def snapshot(refs, mirror):
+    """Download the remote documents, declarations and includes that the documents in refs reference into a
+    mirror directory, and write the mirror's manifest. Returns the manifest's url map"""
+    from metatab import MetatabDoc
+
+    downloader = SnapshotDownloader(mirror)
+    resolver = WebResolver(downloader)
+
+    try:
+        for ref in refs:
+            MetatabDoc(ref, resolver=resolver)
+    finally:
+        downloader.write_manifest()
+
+    return downloader.manifest
+
+
+_default_downloader = None
+
+
+def get_downloader():
+    """Return the HttpDownloader shared by WebResolvers, so they also share connection pools"""
+    global _default_downloader
+
+    if _default_downloader is None:
+        from metatab.util import get_cache
+        _default_downloader = HttpDownloader(get_cache())
+
+    return _default_downloader
+
+
+class WebResolver(object):
+
+    def __init__(self, downloader=None):
+        self._downloader = downloader
+
+    @property
+    def downloader(self):
+        if self._downloader is None:
+            self._downloader = get_downloader()
+
+        return self._downloader
+
+    def fetch_row_source(self, url):
+        pass
+
+    def find_decl_doc(self, name):
+        """Return the URL of a declaration document in the official repo. Declarations that aren't local files
+        or urls aren't looked for on the web, so this fails without a request"""
+
+        raise IncludeError(name)
 
     def get_row_generator(self, ref, cache=None):
 
@@ -44,3 +393,38 @@ class WebResolver(object):
         else:
             return g
 
+
+class MirrorResolver(WebResolver):
+    """Resolve remote declarations and includes from a mirror, made with snapshot(), without using the network"""
+
+    def __init__(self, mirror):
+        super().__init__(MirrorDownloader(mirror))
+
+    def find_decl_doc(self, name):
+        from metatab.parser import METATAB_ASSETS_URL
+
+        url = METATAB_ASSETS_URL + name + '.csv'
+
+        if url in self.downloader.manifest:
+            return url
+
+        raise IncludeError("Declaration '{}' is not in the mirror at '{}'".format(name, self.downloader.path))
+
+
+_mirror_resolvers = {}
+
+
+def default_resolver():
+    """Return the resolver for documents that don't specify one: a MirrorResolver if the METATAB_MIRROR
+    environmental variable names a mirror, or a WebResolver otherwise. """
+
+    mirror = environ.get('METATAB_MIRROR')
+
+    if not mirror:
+        return WebResolver()
+
+    try:
+        return _mirror_resolvers[mirror]
+    except KeyError:
+        r = _mirror_resolvers[mirror] = MirrorResolver(mirror)
+        return r
@@ -2,91 +2,493 @@
 # MIT License, included in this distribution as LICENSE.txt
 
 """ """
+import io
+import re
+import struct
+import threading
+from collections import OrderedDict
+
 from rowgenerators import Source
 from rowgenerators.source import Source
 from rowgenerators import SourceError
 
-class YamlMetatabSource(Source):
-    """Turn a metatab-formated YAML file into Metatab rows."""
+SCALAR_EVENTS = ('string', 'number', 'boolean', 'null')
+
+
+class TermTreeSource(Source):
+    """Base class for sources that turn a tree of terms, in the form produced by MetatabDoc.as_dict(),
+    into Metatab rows.
+
+    Subclasses implement events(), which generates (event, value) tuples for the tree, in the form
+    of ijson's basic_parse(): start_map, map_key, end_map, start_array, end_array, and the scalar
+    events string, number, boolean and null.
+
+    The rows are generated directly from the event stream, so memory use depends on the
+    depth of the tree, not the size of the file. The exception is a term whose value is written after
+    its children; the rows for the children are held until the value is found. The declaration, which
+    determines the term value names and the section for each term, is taken from a ``declare`` key,
+    which must appear before any other term in the tree.
+
+    The tree does not record includes, since the included terms are already in the tree, so
+    ``include`` keys are skipped.
+    """
+
+    default_declaration = 'metatab-latest'
 
     def __init__(self, ref, table=None, cache=None, working_dir=None, env=None, **kwargs):
         super().__init__(ref, cache, working_dir, **kwargs)
 
         self.url = ref
-        self.section_map = {}
-        self.sections = {}
+        self._cache = cache
+        self._decl = None
+
+    @property
+    def path(self):
+        return str(self.url)
+
+    def events(self):
+        raise NotImplementedError()
+
+    def declaration(self, name):
+        from metatab.doc import get_declaration
+        return get_declaration(name, cache=self._cache)
+
+    def __iter__(self):
+        """Iterate over all of the rows for the terms in the file"""
+
+        events = self.events()
 
-    def yield_dict(self, doc, d, parent=None):
+        event, _ = next(events)
+
+        if event != 'start_map':
+            raise SourceError("Term tree for '{}' must be a map".format(self.url))
+
+        decl = None
+        last_section = 'root'
+
+        for event, key in events:
+
+            if event == 'end_map':
+                break
 
-        for k, v in d.items():
+            term = 'root.' + key.lower()
+
+            if term == 'root.include':
+                self._skip_value(events)
+                continue
+
+            if term == 'root.declare':
+                for row in self._value_rows(events, 'Declare', next(events), {}):
+                    if decl is None and row[1]:
+                        decl = self.declaration(row[1])
+                    yield row
+                continue
+
+            if decl is None:
+                decl = self.declaration(self.default_declaration)
+
+            section = decl['term_sections'].get(term, 'root')
+
+            if section != last_section:
+                yield ['Section', section.title()] + decl['sections'].get(section, {}).get('args', [])
+                last_section = section
+
+            yield from self._value_rows(events, term, next(events), decl['terms'])
+
+    def _value_rows(self, events, term, first, decl_terms):
+        """Yield the rows for one value of a term, starting with the value's first event"""
+
+        event, value = first
+
+        if event == 'start_map':
+            yield from self._map_rows(events, term, decl_terms)
+
+        elif event == 'start_array':
+            # Each of the elements is another term with the same name
+            for first in events:
+                if first[0] == 'end_array':
+                    break
+
+                yield from self._value_rows(events, term, first, decl_terms)
+
+        elif event in SCALAR_EVENTS:
+            yield [term, self._scalar(value)]
+
+        else:
+            raise SourceError("Unexpected event '{}' for term '{}' in '{}' ".format(event, term, self.url))
+
+    def _map_rows(self, events, term, decl_terms):
+        """Yield rows for a term that has children. The key for the value of the term is the
+        term value name, or '@value' """
+
+        tvn = decl_terms.get(term.lower(), {}).get('termvaluename', '@value').lower()
+        record_term = term.split('.')[-1]
+
+        pending = []  # Rows for children that appear before the term value
+
+        for event, key in events:
+
+            if event == 'end_map':
+                break
 
-            tn = "{}.{}".format((parent or 'Root').split('.')[-1], k).lower()
-            t = doc.decl_terms.get(tn,{})
-            vtn = t.get('termvaluename','').lower()
+            first = next(events)
 
-            if isinstance(v, list):
-                for e in v:
-                    try:
-                        value = e[vtn]
-                        del e[vtn]
-                        yield (tn, value, parent)
-                    except KeyError:
-                        pass
+            if pending is not None and key.lower() in (tvn, '@value') and first[0] in SCALAR_EVENTS:
+                yield [term, self._scalar(first[1])]
+                yield from pending
+                pending = None
+
+            elif pending is None:
+                yield from self._value_rows(events, record_term + '.' + key, first, decl_terms)
 
-                    yield from self.yield_dict(doc, e, tn)
-            elif isinstance(v, dict):
-                yield from self.yield_dict(doc, v, tn)
             else:
-                yield (tn,v, parent)
+                pending.extend(self._value_rows(events, record_term + '.' + key, first, decl_terms))
 
+        if pending is not None:  # Never got a value
+            yield [term, '']
+            yield from pending
 
-    def __iter__(self):
-        """Iterate over all of the lines in the file"""
+    @staticmethod
+    def _skip_value(events):
+        """Consume the events for one value"""
+
+        depth = 0
+
+        for event, _ in events:
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+
+            if depth == 0:
+                break
+
+    @staticmethod
+    def _scalar(v):
+
+        if v is None:
+            return ''
+        elif v is True or v is False:
+            return str(v).lower()
+        else:
+            return str(v)
+
+
+class YamlMetatabSource(TermTreeSource):
+    """Turn a metatab-formated YAML file into Metatab rows."""
+
+    def events(self):
+        """Translate PyYAML parser events to term tree events. Only the PyYAML parser is used, so
+        no YAML objects are constructed"""
 
         import yaml
-        from metatab import MetatabDoc
+        from yaml.events import (ScalarEvent, MappingStartEvent, MappingEndEvent,
+                                 SequenceStartEvent, SequenceEndEvent, AliasEvent)
 
-        with open(self.url.fspath) as f:
-            d = yaml.load(f)
+        # For each open collection, True if it is a mapping that expects a key next.
+        # False for sequences, and mappings that expect a value
+        expect_key = []
 
-        decl = d.get('declare', 'metatab-latest')
+        with open(str(self.url.fspath)) as f:
 
-        doc = MetatabDoc(decl=decl)
+            for e in yaml.parse(f, Loader=yaml.SafeLoader):
 
-        #yield from doc.rows
+                if isinstance(e, ScalarEvent):
 
-        section_names = ['root','contacts','documentation','resources','references','schema']
+                    if expect_key and expect_key[-1]:
+                        expect_key[-1] = False
+                        yield ('map_key', e.value)
+                        continue
 
-        for section_name in section_names:
-            section =  doc.decl_sections[section_name]
-            #print(section_name, section)
+                    if expect_key and expect_key[-1] is False:
+                        expect_key[-1] = True
 
-            for tn in  section.get('terms',[]):
-                self.section_map[tn.lower()] = section_name
+                    if e.implicit[0] and e.value in YAML_NULLS:
+                        yield ('null', None)
+                    else:
+                        yield ('string', e.value)
 
-            self.sections[section_name] = doc.get_or_new_section(section_name, section['args'])
+                elif isinstance(e, (MappingStartEvent, SequenceStartEvent)):
 
-        last_section = None
-        last_term = { }
-        for term_name, value, parent in self.yield_dict(doc, d):
+                    if expect_key and expect_key[-1]:
+                        raise SourceError("Complex mapping keys are not supported, in '{}' ".format(self.url))
 
-            print(term_name, value, parent)
+                    if expect_key and expect_key[-1] is False:
+                        expect_key[-1] = True
 
-            section = self.sections.get(self.section_map.get(term_name) or 'root')
+                    if isinstance(e, MappingStartEvent):
+                        expect_key.append(True)
+                        yield ('start_map', None)
+                    else:
+                        expect_key.append(None)
+                        yield ('start_array', None)
 
-            if parent is None:
-                term = section.new_term(term_name, value)
-            else:
+                elif isinstance(e, (MappingEndEvent, SequenceEndEvent)):
+                    expect_key.pop()
+                    yield ('end_map' if isinstance(e, MappingEndEvent) else 'end_array', None)
+
+                elif isinstance(e, AliasEvent):
+                    raise SourceError("YAML aliases are not supported, in '{}' ".format(self.url))
+
+
+YAML_NULLS = ('', '~', 'null', 'Null', 'NULL')
+
+
+class JsonMetatabSource(TermTreeSource):
+    """Turn a metatab-formated JSON file, such as the output of MetatabDoc.as_dict(), into Metatab rows.
+
+    The ref can be a Url, a path, an open file, or a dict. If the ijson package is installed, the file is
+    parsed incrementally, otherwise it is loaded with the json module before generating rows.
+    """
+
+    def events(self):
+
+        from os import PathLike, fspath
+        from rowgenerators import Url
+
+        if isinstance(self.url, dict):
+            yield from tree_events(self.url)
+
+        # Check for paths before file handles, since Urls have a read() method too
+        elif isinstance(self.url, (Url, str, PathLike)):
+            path = str(self.url.fspath) if isinstance(self.url, Url) else fspath(self.url)
+
+            with open(path, 'rb') as f:
+                yield from self._file_events(f)
+
+        elif hasattr(self.url, 'read'):
+            yield from self._file_events(self.url)
+
+        else:
+            raise SourceError("Can't handle ref of type {}".format(type(self.url)))
+
+    @staticmethod
+    def _file_events(f):
+        try:
+            import ijson
+        except ImportError:
+            ijson = None
+
+        if ijson is not None:
+            yield from ijson.basic_parse(f)
+        else:
+            import json
+            from collections import OrderedDict
+
+            yield from tree_events(json.load(f, object_pairs_hook=OrderedDict))
+
+
+def tree_events(v):
+    """Generate term tree events for a structure of dicts, lists and scalars"""
+
+    if isinstance(v, dict):
+        yield ('start_map', None)
+
+        for k, e in v.items():
+            yield ('map_key', k)
+            yield from tree_events(e)
+
+        yield ('end_map', None)
+
+    elif isinstance(v, (list, tuple)):
+        yield ('start_array', None)
+
+        for e in v:
+            yield from tree_events(e)
+
+        yield ('end_array', None)
+
+    elif v is None:
+        yield ('null', None)
+
+    else:
+        yield ('string', v)
+
+
+class ZipMetadataSource(Source):
+    """Generate the rows of the metadata file in a ZIP package, without extracting the archive.
 
-                parent_term = last_term[parent]
-                term = parent_term.new_child(term_name, value)
+    The first read of an archive uses the archive's central directory to find the metadata
+    member. The member's offset is memoized, so later reads of the same, unchanged archive seek
+    directly to the member and decompress only that member.
+    """
+
+    # Memoized members, keyed by (path, member name), with the size and mtime of the archive they were
+    # read from. A changed archive replaces its entry, and the least recently used entries are evicted.
+    _members = OrderedDict()
+    _members_lock = threading.Lock()
+    members_cache_size = 64
+
+    def __init__(self, ref, cache=None, working_dir=None, member=None, encoding='utf-8-sig', **kwargs):
+        super().__init__(ref, cache, working_dir, **kwargs)
+
+        from metatab import DEFAULT_METATAB_FILE
+
+        self.url = ref
+        self.member_name = member or DEFAULT_METATAB_FILE
+        self.encoding = encoding
+
+    @property
+    def path(self):
+        return str(self.url)
+
+    def member(self):
+        """Return the ZipInfo for the metadata member, from the memo or the central directory"""
+        import os
+        from zipfile import ZipFile
+
+        st = os.stat(self.path)
+        key = (self.path, self.member_name)
+        stamp = (st.st_size, st.st_mtime_ns)
+
+        with self._members_lock:
+            entry = self._members.get(key)
+
+            if entry is not None and entry[0] == stamp:
+                self._members.move_to_end(key)
+                return entry[1]
+
+        with ZipFile(self.path) as zf:
+            # The package may be in a directory in the archive, so take the
+            # metadata member closest to the root
+            members = [zi for zi in zf.infolist()
+                       if zi.filename == self.member_name or zi.filename.endswith('/' + self.member_name)]
+
+        if not members:
+            raise SourceError("No '{}' in ZIP archive '{}'".format(self.member_name, self.path))
+
+        zi = min(members, key=lambda zi: zi.filename.count('/'))
+
+        with self._members_lock:
+            self._members[key] = (stamp, zi)
+            self._members.move_to_end(key)
+
+            while len(self._members) > self.members_cache_size:
+                self._members.popitem(last=False)
+
+        return zi
+
+    def member_url(self, name):
+        """Return the url of another member of the archive, for a name relative to the metadata member, such as
+        a relative Include in the package's metadata"""
+        import posixpath
+        from rowgenerators import parse_app_url
+
+        member = posixpath.normpath(posixpath.join(posixpath.dirname(self.member().filename), name))
+
+        return parse_app_url('{}#{}'.format(self.path, member))
+
+    def open(self):
+        """Return a binary file for the member's uncompressed data"""
+        import io
+
+        return io.BufferedReader(_ZipMemberReader(self.path, self.member()))
+
+    def __iter__(self):
+        import csv
+        import io
+
+        with io.TextIOWrapper(self.open(), encoding=self.encoding, newline='') as f:
+            yield from csv.reader(f)
+
+
+class _ZipMemberReader(io.RawIOBase):
+    """Read the uncompressed data of one ZIP archive member, starting at its local header"""
+
+    # Local file header, from the ZIP APPNOTE. Fields 10 and 11 are the file name and extra field lengths
+    local_header = struct.Struct('<4s2B4HL2L2H')
+
+    def __init__(self, path, zi):
+        import zipfile
+        import zlib
+
+        super().__init__()
+
+        if zi.flag_bits & 0x1:
+            raise SourceError("Can't read encrypted member '{}' in '{}' ".format(zi.filename, path))
+
+        if zi.compress_type == zipfile.ZIP_DEFLATED:
+            self._decompressor = zlib.decompressobj(-15)
+        elif zi.compress_type == zipfile.ZIP_STORED:
+            self._decompressor = None
+        else:
+            raise SourceError("Unsupported compression type {} for '{}' in '{}' "
+                              .format(zi.compress_type, zi.filename, path))
+
+        self._f = open(path, 'rb')
+        self._f.seek(zi.header_offset)
+
+        fh = self.local_header.unpack(self._f.read(self.local_header.size))
+
+        if fh[0] != b'PK\x03\x04':
+            self._f.close()
+            raise SourceError("Bad local header for '{}' in '{}' ".format(zi.filename, path))
+
+        self._f.seek(fh[10] + fh[11], io.SEEK_CUR)
+
+        self._remaining = zi.compress_size
+        self._buffer = memoryview(b'')
+        self._pos = 0  # Offset of the unread data in the buffer, so reads don't copy the rest of it
+        self._eof = False
+
+    def readable(self):
+        return True
+
+    def _fill(self):
 
-            last_term[term_name] = term
+        chunk = self._f.read(min(self._remaining, 64 * 1024))
+        self._remaining -= len(chunk)
+        self._eof = not chunk or not self._remaining
 
+        if self._decompressor is not None:
+            chunk = self._decompressor.decompress(chunk)
 
+            if self._eof:
+                chunk += self._decompressor.flush()
 
+        self._buffer = memoryview(chunk)
+        self._pos = 0
 
-        yield from doc.rows
+    def readinto(self, b):
+
+        while self._pos == len(self._buffer) and not self._eof:
+            self._fill()
+
+        n = min(len(b), len(self._buffer) - self._pos)
+        b[:n] = self._buffer[self._pos:self._pos + n]
+        self._pos += n
+
+        return n
+
+    def close(self):
+        self._f.close()
+        super().close()
+
+
+class XlsxMetadataSource(Source):
+    """Generate the rows of the metadata worksheet in an Excel package, with the read-only, streaming
+    openpyxl reader, so the rest of the workbook is not loaded"""
+
+    def __init__(self, ref, cache=None, working_dir=None, sheet='meta', **kwargs):
+        super().__init__(ref, cache, working_dir, **kwargs)
+
+        self.url = ref
+        self.sheet = sheet
+
+    @property
+    def path(self):
+        return str(self.url)
+
+    def __iter__(self):
+        from openpyxl import load_workbook
+
+        wb = load_workbook(self.path, read_only=True, data_only=True)
+
+        try:
+            for row in wb[self.sheet].iter_rows(values_only=True):
+                yield ['' if v is None else str(v) for v in row]
+        finally:
+            wb.close()
 
 
 class MetatabRowGenerator(Source):
@@ -117,58 +519,66 @@ class MetatabRowGenerator(Source):
 
 class TextRowGenerator(MetatabRowGenerator):
     """Return lines of text of a line-oriented metatab file, breaking them to be used as Metatab rows.
-    This is the core of the Lines format implementation"""
+    This is the core of the Lines format implementation
+
+    The input is dispatched on its type when the generator is constructed, but lines are only read
+    when the generator is iterated, so files are streamed rather than loaded into memory. The
+    ref may be:
+
+    * A string of Lines text, which has a newline in it or is not the path to an existing file
+    * A string path to a file, or a pathlib path
+    * An open file handle, or any object with a ``read()`` method. Seekable handles are rewound, and others
+      read once, so the generator can be iterated more than once
+    * A Url, with a filesystem path
+
+    """
 
     def __init__(self, ref, cache=None, working_dir=None, path = None, **kwargs):
         super().__init__(ref, cache, working_dir, path, **kwargs)
 
-        while True:
+        self._open_lines = self._line_source(ref)
+        self._path = path or '<none>'
 
-            try:
-                # Pathlib Path
-                with ref.open() as r:
-                    text = r.read()
-                break
-            except:
-                pass
+    @staticmethod
+    def _line_source(ref):
+        """Return a function that returns an iterator of lines for the ref."""
+        from io import StringIO
+        from pathlib import PurePath
+        from os.path import exists
+        from rowgenerators import Url
+
+        if isinstance(ref, str):
+            if '\n' not in ref and '\r' not in ref and exists(ref):
+                return lambda: _file_lines(ref)  # File name
+            else:
+                return lambda: StringIO(ref, newline=None)  # Lines text
 
-            try:
-                # Filehandle
-                text = ref.read()
-                break
-            except:
-                pass
+        elif isinstance(ref, PurePath):
+            return lambda: _file_lines(str(ref))
 
-            try:
-                # Url
-                with ref.inner.fspath.open() as f:
-                    text = f.read()
-                break
-            except:
+        elif isinstance(ref, Url):  # Before the file handles, since Urls also have read()
+            return lambda: _file_lines(str(ref.inner.fspath))
 
-                pass
+        elif hasattr(ref, 'readline') and getattr(ref, 'seekable', lambda: False)():
+            start = ref.tell()
 
-            try:
-                # File name
-                with open(ref) as r:
-                    text = r.read()
-                break
-            except:
-                pass
+            def rewind():
+                ref.seek(start)
+                return ref  # Filehandle, which iterates over lines
 
-            try:
-                text = ref
-                text.splitlines()
-                break
-            except AttributeError:
-                pass
+            return rewind
 
+        elif hasattr(ref, 'read'):
+            text = []  # Read once, so that the generator can be iterated again
 
-            raise SourceError("Can't handle ref of type {}".format(type(ref)))
+            def read():
+                if not text:
+                    text.append(ref.read())
+                return StringIO(text[0], newline=None)
 
-        self._text = text
-        self._text_lines = text.splitlines()
-        self._path = path or '<none>'
+            return read
+
+        raise SourceError("Can't handle ref of type {}".format(type(ref)))
 
     @property
     def path(self):
@@ -181,24 +591,48 @@ class TextRowGenerator(MetatabRowGenerator):
         pass
 
     def __iter__(self):
-        import re
 
-        for row in self._text_lines:
-            if re.match(r'^\s*#', row):  # Skip comments
-                continue
+        for line in self._open_lines():
+            row = parse_line(line)
+
+            if row is not None:
+                yield row
+
+
+def _file_lines(path):
+    """Yield the lines of a file, reading it incrementally"""
+    with open(path) as f:
+        yield from f
+
+
+COMMENT_PATTERN = re.compile(r'^\s*#')
+SECTION_PATTERN = re.compile(r'^=*')
+PIPE_PATTERN = re.compile(r'(?<!\\)\|')
+
+
+def parse_line(row):
+    """Break a line of a Lines format file into a row. Returns None for comments"""
+
+    if COMMENT_PATTERN.match(row):  # Skip comments
+        return None
+
+    # Special handling for ====, which implies a section:
+    #   ==== Schema
+    # is also
+    #   Section: Schema
+
+    if row.startswith('===='):
+        row = SECTION_PATTERN.sub('Section:', row, 1)
 
-            # Special handling for ====, which implies a section:
-            #   ==== Schema
-            # is also
-            #   Section: Schema
+    term, sep, value = row.partition(':')
 
-            if row.startswith('===='):
-                row = re.sub(r'^=*','Section:', row)
+    if not sep:
+        return [term.strip()]
 
-            row = [e.strip() for e in row.split(':', 1)]
+    value = value.strip()
 
-            # Pipe characters seperate columns
-            if len(row) > 1:
-                row = [row[0]] + [ e.replace('\|','|') for e in re.split(r'(?<!\\)\|', row[1]) ]
+    # Pipe characters seperate columns. Most lines don't have any, so skip the split
+    if '|' not in value:
+        return [term.strip(), value]
 
-            yield row
\ No newline at end of file
+    return [term.strip()] + [e.replace('\\|', '|') for e in PIPE_PATTERN.split(value)]
@@ -0,0 +1,427 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+A long-lived metatab server, which keeps declarations, templates and recently opened documents loaded, so
+editors and linters don't pay for starting the interpreter and loading declarations on every command.
+
+The server speaks JSON-RPC 2.0, with one request or response per line, on a Unix socket or on stdin and
+stdout. The methods are:
+
+* run(argv, cwd): Run a metatab command, returning {"exit": ..., "stdout": ..., "stderr": ...}
+* parse(path): Return the document as a dict
+* find(path, term, value=None): Return the values of the terms with a name, and optionally a value
+* convert(path, format): Return the document as 'json', 'yaml', 'line', 'csv' or 'terms'
+* stats(): Return request and cache counts
+* ping(), shutdown()
+
+Run the server with ``metatab --serve``, and commands through it with ``metatab-client``, which takes the same
+arguments as ``metatab``, and runs the command itself if there is no server.
+
+This module only imports the rest of the package when the server starts, so the client starts quickly.
+"""
+
+import json
+import os
+import socket
+import sys
+from collections import OrderedDict
+from time import time
+
+from metatab.exc import ServerError
+
+PARSE_ERROR = -32700
+INVALID_REQUEST = -32600
+METHOD_NOT_FOUND = -32601
+INVALID_PARAMS = -32602
+SERVER_ERROR = -32000
+
+
+def default_socket_path():
+    """Return the server's socket path, from METATAB_SOCKET, or in the user's runtime directory, or a private
+    directory in the temp directory"""
+    from tempfile import gettempdir
+
+    if os.environ.get('METATAB_SOCKET'):
+        return os.environ['METATAB_SOCKET']
+
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'metatab-{}.sock'.format(os.getuid()))
+
+    # The temp directory is shared with other users, who could otherwise create the socket first
+    return os.path.join(private_dir(os.path.join(gettempdir(), 'metatab-{}'.format(os.getuid()))), 'metatab.sock')
+
+
+def private_dir(d):
+    """Create a directory that only the current user can use, or check that an existing one is one"""
+    import stat
+
+    try:
+        os.mkdir(d, 0o700)
+    except FileExistsError:
+        pass
+
+    st = os.lstat(d)
+
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid() or st.st_mode & 0o077:
+        raise ServerError("'{}' must be a directory that only the current user can use".format(d))
+
+    return d
+
+
+def check_owner(path):
+    """Raise ServerError if a socket path is owned by another user, who could be running a server on it.
+    Raises FileNotFoundError if there is no file at the path"""
+
+    if os.lstat(path).st_uid != os.getuid():
+        raise ServerError("'{}' is owned by another user".format(path))
+
+
+class DocumentCache(object):
+    """Recently opened documents, by url and the options they were opened with. Documents are reopened when the
+    modification time of their file, or of a local file they include or declare, changes, and remote documents
+    after remote_ttl seconds. """
+
+    def __init__(self, size=64, remote_ttl=60):
+        self.size = size
+        self.remote_ttl = remote_ttl
+        self.hits = 0
+        self.misses = 0
+
+        self._docs = OrderedDict()
+
+    @staticmethod
+    def _mtime(path):
+
+        try:
+            return os.path.getmtime(path)
+        except OSError:
+            return None
+
+    @classmethod
+    def _mtimes(cls, urls):
+        """Return a dict of the modification times of the local files among urls"""
+
+        # Relative paths are relative to the directory of the command the server is running
+        paths = (os.path.abspath(u.path) for u in urls if u.scheme == 'file')
+
+        return {p: cls._mtime(p) for p in paths}
+
+    def get(self, url, open_doc, options=()):
+        """Return the document for url, calling open_doc() to open it if it is not cached, or has changed.
+        options is a tuple of the options that open_doc() opens the document with, such as tolerant parsing;
+        documents opened with different options are cached separately. """
+
+        key = (os.path.abspath(url.path) if url.scheme == 'file' else str(url), tuple(options))
+
+        try:
+            mtimes, opened, doc = self._docs[key]
+
+            valid = (all(m is not None and self._mtime(p) == m for p, m in mtimes.items()) and
+                     (url.scheme == 'file' or time() - opened < self.remote_ttl))
+
+            if valid:
+                self._docs.move_to_end(key)
+                self.hits += 1
+                return doc
+
+        except KeyError:
+            pass
+
+        self.misses += 1
+
+        mtimes = self._mtimes([url])  # Before opening, so changes made while opening aren't missed
+
+        doc = open_doc()
+
+        mtimes.update(self._mtimes(getattr(doc, 'sources', [])))
+
+        self._docs[key] = (mtimes, time(), doc)
+        self._docs.move_to_end(key)
+
+        while len(self._docs) > self.size:
+            self._docs.popitem(last=False)
+
+        return doc
+
+    def __len__(self):
+        return len(self._docs)
+
+
+class MetatabServer(object):
+    """Answer JSON-RPC requests, with documents and declarations kept loaded between requests"""
+
+    def __init__(self, args=None):
+        """
+        :param args: Parsed metatab command arguments, for the mirror to resolve documents with
+        """
+        from metatab import cli
+
+        self.args = args if args is not None else cli.make_parser([]).parse_args([])
+        self.docs = DocumentCache()
+        self.requests = 0
+        self.running = True
+        self.started = time()
+
+    def warm(self):
+        """Load the common declarations and the default template"""
+        from metatab import cli
+
+        cli.warm_declarations(self.args)
+
+        try:
+            cli.template_csv('metatab')
+        except Exception:
+            pass
+
+    def _args(self, *argv):
+        from metatab import cli
+
+        args = cli.make_parser(argv).parse_args(argv)
+        args.mirror = args.mirror or self.args.mirror
+
+        return args
+
+    def _process(self, path, *argv):
+        from metatab import cli
+
+        return cli.process_file(cli.expand_paths([path])[0], self._args(path, *argv), docs=self.docs)
+
+    def rpc_ping(self):
+        return 'pong'
+
+    def rpc_shutdown(self):
+        self.running = False
+        return 'ok'
+
+    def rpc_stats(self):
+        return {
+            'requests': self.requests,
+            'uptime': time() - self.started,
+            'documents': len(self.docs),
+            'document_hits': self.docs.hits,
+            'document_misses': self.docs.misses
+        }
+
+    def rpc_parse(self, path):
+        return self._process(path, '--json')
+
+    def rpc_convert(self, path, format='json'):
+
+        if format not in ('json', 'yaml', 'line', 'csv', 'terms'):
+            raise ValueError("Unknown format '{}'".format(format))
+
+        return self._process(path, '--' + format)
+
+    def rpc_find(self, path, term, value=None):
+        from metatab import MetatabDoc, parse_app_url
+        from metatab import cli
+
+        args = self._args(path)
+        resolver = cli.get_resolver(args)
+        url = parse_app_url(cli.expand_paths([path])[0], proto='metatab', downloader=resolver.downloader)
+
+        doc = self.docs.get(url, lambda: MetatabDoc(url, cache=cli.cli_cache(), resolver=resolver),
+                            options=(False, False, args.mirror))
+
+        return [t.value for t in doc.find(term, value=value if value is not None else False)]
+
+    def rpc_run(self, argv, cwd=None):
+        """Run a metatab command as if it was run in cwd, capturing its output"""
+        import io
+        from contextlib import redirect_stdout, redirect_stderr
+        from metatab import cli
+
+        if '--serve' in argv:
+            raise ValueError("Can't run --serve through the server")
+
+        out, err = io.StringIO(), io.StringIO()
+        old_cwd = os.getcwd()
+        old_docs = cli.document_cache
+
+        try:
+            if cwd:
+                os.chdir(cwd)
+
+            cli.document_cache = self.docs
+
+            with redirect_stdout(out), redirect_stderr(err):
+                try:
+                    cli.metatab(list(argv))
+                    code = 0
+                except SystemExit as e:
+                    if e.code is None or isinstance(e.code, int):
+                        code = e.code or 0
+                    else:
+                        print(e.code, file=sys.stderr)
+                        code = 1
+        finally:
+            cli.document_cache = old_docs
+            os.chdir(old_cwd)
+
+        return {'exit': code, 'stdout': out.getvalue(), 'stderr': err.getvalue()}
+
+    def handle(self, line):
+        """Handle one request line, returning the response line, or None for a notification"""
+
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return self._response(None, error=(PARSE_ERROR, 'Parse error: {}'.format(e)))
+
+        if not isinstance(request, dict) or not isinstance(request.get('method'), str):
+            return self._response(None, error=(INVALID_REQUEST, 'Invalid request'))
+
+        self.requests += 1
+
+        id_ = request.get('id')
+        params = request.get('params') or {}
+
+        f = getattr(self, 'rpc_' + request['method'], None)
+
+        if f is None:
+            response = self._response(id_, error=(METHOD_NOT_FOUND, "Unknown method '{}'".format(request['method'])))
+        else:
+            from inspect import signature
+
+            args, kwargs = (params, {}) if isinstance(params, list) else ((), params)
+
+            try:
+                signature(f).bind(*args, **kwargs)
+            except TypeError as e:
+                response = self._response(id_, error=(INVALID_PARAMS, str(e)))
+            else:
+                try:
+                    response = self._response(id_, result=f(*args, **kwargs))
+                except Exception as e:
+                    response = self._response(id_, error=(SERVER_ERROR, '{}: {}'.format(type(e).__name__, e)))
+
+        return response if 'id' in request else None
+
+    @staticmethod
+    def _response(id_, result=None, error=None):
+
+        d = {'jsonrpc': '2.0', 'id': id_}
+
+        if error:
+            d['error'] = {'code': error[0], 'message': error[1]}
+        else:
+            d['result'] = result
+
+        return json.dumps(d, default=str)
+
+    def serve_stream(self, rfile, wfile):
+        """Answer requests from lines of rfile, until it ends or the server is shut down"""
+
+        for line in rfile:
+            if not line.strip():
+                continue
+
+            response = self.handle(line)
+
+            if response is not None:
+                wfile.write(response + '\n')
+                wfile.flush()
+
+            if not self.running:
+                break
+
+    def serve_socket(self, path, ready=None):
+        """Answer requests on a Unix socket, one connection at a time, until the server is shut down. Sets the
+        ready event, if there is one, when the socket is listening. """
+
+        if os.path.lexists(path):
+            check_owner(path)
+
+            try:
+                request(path, 'ping')
+            except (OSError, ServerError):
+                os.remove(path)  # Left over from a server that didn't shut down
+            else:
+                raise ServerError("A server is already running on '{}'".format(path))
+
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+
+        try:
+            # Commands run with the server's permissions, so only the user may connect, from the moment it is bound
+            umask = os.umask(0o077)
+            try:
+                sock.bind(path)
+            finally:
+                os.umask(umask)
+
+            sock.listen(16)
+
+            if ready is not None:
+                ready.set()
+
+            while self.running:
+                conn, _ = sock.accept()
+
+                with conn, conn.makefile('r', encoding='utf8') as rfile, \
+                        conn.makefile('w', encoding='utf8') as wfile:
+                    try:
+                        self.serve_stream(rfile, wfile)
+                    except (BrokenPipeError, ConnectionResetError):
+                        pass
+
+        finally:
+            sock.close()
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def serve(socket_path, args=None):
+    """Run the server, on stdin and stdout if socket_path is '-', or a Unix socket"""
+
+    server = MetatabServer(args)
+    server.warm()
+
+    if socket_path == '-':
+        # Commands print to sys.stdout, which run() redirects, so responses go to the original stream
+        server.serve_stream(sys.stdin, sys.__stdout__)
+    else:
+        if socket_path in (None, 'default'):
+            socket_path = default_socket_path()
+
+        server.serve_socket(socket_path)
+
+
+def request(socket_path, method, **params):
+    """Make a request to the server on the Unix socket at socket_path, returning the result"""
+
+    check_owner(socket_path)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.connect(socket_path)
+
+        with sock.makefile('rw', encoding='utf8') as f:
+            f.write(json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': method, 'params': params}) + '\n')
+            f.flush()
+            line = f.readline()
+
+    if not line:
+        raise ServerError("No response from server on '{}'".format(socket_path))
+
+    response = json.loads(line)
+
+    if 'error' in response:
+        raise ServerError(response['error']['message'], response['error']['code'])
+
+    return response['result']
+
+
+def client():
+    """Run a metatab command through the server, or in this process if no server is running"""
+
+    argv = sys.argv[1:]
+
+    try:
+        r = request(default_socket_path(), 'run', argv=argv, cwd=os.getcwd())
+    except (FileNotFoundError, ConnectionRefusedError):
+        from metatab.cli import metatab
+        return metatab(argv)
+
+    sys.stdout.write(r['stdout'])
+    sys.stderr.write(r['stderr'])
+    sys.exit(r['exit'])
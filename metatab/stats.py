@@ -0,0 +1,122 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Instrumentation for parsing documents.
+
+A ParseStats object accumulates the time spent in each phase of parsing a document, and counts of rows and
+terms, per file and per term type. Parsing is only instrumented when a document is opened with
+stats, as in ``MetatabDoc(ref, stats=True)``; otherwise the parser runs without any timing calls.
+
+The phases are:
+
+* rows: Generating rows from the document and its includes and declarations
+* resolve: Resolving Include and Declare terms to urls, and opening row generators for them
+* term_class: Looking up the Term class for each term
+* synonyms: Substituting declared synonyms for term names
+* link: Setting the section, parent, and declared properties of each term, including synonym substitution
+* declarations: Processing the terms of declaration documents
+* load_terms: Adding terms to the document, and copying the declarations to it
+* total: Loading the document, including all of the other phases
+
+"""
+
+from collections import OrderedDict, defaultdict
+from time import perf_counter
+
+
+class ParseStats(object):
+    """Accumulated times and counters for parsing one or more documents"""
+
+    phases = ('rows', 'resolve', 'term_class', 'synonyms', 'link', 'declarations', 'load_terms', 'total')
+
+    def __init__(self):
+        self.times = defaultdict(float)  # Seconds, by phase
+        self.calls = defaultdict(int)  # Number of timings, by phase
+        self.files = OrderedDict()  # Rows and row time, by file or include
+        self.term_types = defaultdict(lambda: [0, 0.0])  # Count and link time, by term name
+
+    def add(self, phase, dt, n=1):
+        self.times[phase] += dt
+        self.calls[phase] += n
+
+    def timed(self, phase, f):
+        """Return a function that calls f, adding its time to a phase"""
+
+        def _timed(*args, **kwargs):
+            t0 = perf_counter()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                self.add(phase, perf_counter() - t0)
+
+        return _timed
+
+    def rows(self, path, row_gen):
+        """Yield the rows of a row generator, adding the time to generate them to the rows phase, and to the
+        row counts for the file"""
+
+        f = self.files.setdefault(path, {'rows': 0, 'time': 0.0})
+
+        t0 = perf_counter()
+        it = iter(row_gen)
+
+        while True:
+            try:
+                row = next(it)
+            except StopIteration:
+                dt = perf_counter() - t0
+                self.add('rows', dt, 0)
+                f['time'] += dt
+                return
+
+            dt = perf_counter() - t0
+            self.add('rows', dt)
+            f['rows'] += 1
+            f['time'] += dt
+
+            yield row
+
+            t0 = perf_counter()
+
+    def term(self, term, dt):
+        """Count a term, and add the time to link it"""
+
+        tt = self.term_types[term.join_lc]
+        tt[0] += 1
+        tt[1] += dt
+
+        self.add('link', dt)
+
+    def as_dict(self):
+
+        return {
+            'phases': OrderedDict((p, {'time': self.times[p], 'calls': self.calls[p]})
+                                  for p in self.phases if p in self.times),
+            'files': self.files,
+            'term_types': OrderedDict((k, {'count': v[0], 'time': v[1]})
+                                      for k, v in sorted(self.term_types.items(), key=lambda e: -e[1][1]))
+        }
+
+    def report(self, n_terms=10):
+        """Return a text report of the phases, files, and the n_terms term types that took the most time"""
+
+        lines = ['{:<32} {:>10} {:>10}'.format('Phase', 'Time (ms)', 'Calls')]
+
+        for p in self.phases:
+            if p in self.times:
+                lines.append('{:<32} {:>10.2f} {:>10}'.format(p, self.times[p] * 1000, self.calls[p]))
+
+        lines.append('')
+        lines.append('{:<32} {:>10} {:>10}'.format('File', 'Time (ms)', 'Rows'))
+
+        for path, f in self.files.items():
+            lines.append('{:<32} {:>10.2f} {:>10}'.format(str(path)[-32:], f['time'] * 1000, f['rows']))
+
+        lines.append('')
+        lines.append('{:<32} {:>10} {:>10}'.format('Term', 'Time (ms)', 'Count'))
+
+        for term, (count, dt) in sorted(self.term_types.items(), key=lambda e: -e[1][1])[:n_terms]:
+            lines.append('{:<32} {:>10.2f} {:>10}'.format(term, dt * 1000, count))
+
+        return '\n'.join(lines)
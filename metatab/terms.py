@@ -15,6 +15,103 @@ from metatab.parser import ROOT_TERM, ELIDED_TERM
 
 EMPTY_SOURCE_HEADER = '_NONE_'  # Marker for a column that is in the destination table but not in the source
 
+# Term attributes that change the dict form of the term, so setting them marks the document as changed
+_DICT_ATTRIBUTES = frozenset(['value', 'term_value_name', 'child_property_type', 'children', 'terms',
+                              'parent_term', 'record_term'])
+
+# Term attributes that hold lists of terms, which are kept as TermLists
+_TERM_LISTS = frozenset(['children', 'terms'])
+
+
+class TermList(list):
+    """A list of terms, for the children and terms lists, that calls on_change() when it is modified, so that
+    editing the lists directly marks the document as changed, as the term methods do """
+
+    __slots__ = ('on_change',)
+
+    def __init__(self, on_change, terms=()):
+        super().__init__(terms)
+        self.on_change = on_change
+
+    def append(self, t):
+        super().append(t)
+        self.on_change()
+
+    def extend(self, terms):
+        super().extend(terms)
+        self.on_change()
+
+    def insert(self, i, t):
+        super().insert(i, t)
+        self.on_change()
+
+    def remove(self, t):
+        super().remove(t)
+        self.on_change()
+
+    def pop(self, i=-1):
+        t = super().pop(i)
+        self.on_change()
+        return t
+
+    def clear(self):
+        super().clear()
+        self.on_change()
+
+    def sort(self, *, key=None, reverse=False):
+        super().sort(key=key, reverse=reverse)
+        self.on_change()
+
+    def reverse(self):
+        super().reverse()
+        self.on_change()
+
+    def __setitem__(self, i, v):
+        super().__setitem__(i, v)
+        self.on_change()
+
+    def __delitem__(self, i):
+        super().__delitem__(i)
+        self.on_change()
+
+    def __iadd__(self, terms):
+        super().__iadd__(terms)
+        self.on_change()
+        return self
+
+    def __imul__(self, n):
+        super().__imul__(n)
+        self.on_change()
+        return self
+
+    def __reduce__(self):
+        # Copies and pickles are plain lists, since the callback would take the whole document with it
+        return list, (list(self),)
+
+
+def copy_dict(v):
+    """Return a copy of a dict from as_dict(), copying the nested dicts and lists, without recursion"""
+    from collections import OrderedDict
+
+    if not isinstance(v, (dict, list)):
+        return v
+
+    root = OrderedDict(v) if isinstance(v, dict) else list(v)
+    stack = [root]
+
+    while stack:
+        c = stack.pop()
+
+        for k, e in (c.items() if isinstance(c, dict) else enumerate(c)):
+            if isinstance(e, dict):
+                c[k] = e = OrderedDict(e)
+                stack.append(e)
+            elif isinstance(e, list):
+                c[k] = e = list(e)
+                stack.append(e)
+
+    return root
+
 
 class Term(object):
     """Term object represent a row in a Metatab file, and handle interpeting the
@@ -95,9 +192,9 @@ class Term(object):
         # Can be forced to list, scalar, dict or other types.
         self.child_property_type = 'any'
         self.valid = None
-        self.options =[] # Set from the options defined in the declaration during parsing.
+        self.options = () # Set from the options defined in the declaration during parsing. A tuple, shared between terms.
 
-        self.children = []  # When terms are linked, hold term's children.
+        self.children = TermList(self._changed)  # When terms are linked, hold term's children.
 
         assert self.file_name is None or isinstance(self.file_name, str), self.file_name
 
@@ -170,6 +267,11 @@ class Term(object):
         child.parent = self
         assert not child.term_is("Datafile.Section")
 
+    def _changed(self):
+        """Mark the term's document as modified, after changing children"""
+        if self.doc is not None:
+            self.doc.changed()
+
     def new_child(self, term, value, **kwargs):
         """Create a new term and add it to this term as a child. Creates grandchildren from the kwargs.
 
@@ -184,7 +286,7 @@ class Term(object):
         c = tc(term, str(value) if value is not None else None,
                parent=self, doc=self.doc, section=self.section).new_children(**kwargs)
 
-        c.term_value_name = self.doc.decl_terms.get(c.join, {}).get('termvaluename', c.term_value_name)
+        c.term_value_name = self.doc.decl_record(c.join_lc).term_value_name or c.term_value_name
 
         assert not c.term_is("*.Section")
         self.children.append(c)
@@ -357,6 +459,9 @@ class Term(object):
     def __setattr__(self, item, value):
         """ """
 
+        if item in _TERM_LISTS and not isinstance(value, TermList):
+            value = TermList(self._changed, value)
+
         if '_Term__initialised' not in self.__dict__:
             # Not initialized yet; set attributes normally.
             return object.__setattr__(self, item, value)
@@ -366,9 +471,13 @@ class Term(object):
             # the value name
             object.__setattr__(self, item, value)
 
+            if item in _DICT_ATTRIBUTES:
+                self._changed()
+
         elif item.lower() == self.term_value_name.lower() or item.lower() == 'value':
             # Set the value name
             object.__setattr__(self, 'value', value)
+            self._changed()
 
         elif item.lower() in [ e.lower() for e in self.property_names]:
             # only allow attribut setting for pre-defined chidren
@@ -540,7 +649,7 @@ class Term(object):
         """Convert the term, and it's children, to a minimal data structure form, which may
         be a scalar for a term with a single value or a dict if it has multiple proerties. """
 
-        return self._convert_to_dict(self, replace_value_names)
+        return self._convert_terms([self], replace_value_names)[0]
 
     @classmethod
     def _convert_to_dict(cls, term, replace_value_names=True):
@@ -550,67 +659,89 @@ class Term(object):
 
         """
 
-        from collections import OrderedDict
-
         if not term:
             return None
 
-        if term.children:
+        return cls._convert_terms([term], replace_value_names)[0]
 
-            d = OrderedDict()
+    @classmethod
+    def _convert_terms(cls, terms, replace_value_names=True):
+        """Convert terms, and their children, to nested dicts, returning a list of the values of the terms.
+
+        Terms with children are converted from the leaves up, by visiting them in reverse pre-order, with their
+        values on a stack. A term's children are converted just before it, so the values of the children that
+        have children of their own are on the top of the stack, with the first child on top. Terminal terms
+        are just their values.
+        """
 
-            for c in term.children:
+        order = []
+        stack = [t for t in reversed(terms) if t.children]
 
-                if c.child_property_type == 'scalar':
-                    d[c.record_term_lc] = cls._convert_to_dict(c, replace_value_names)
+        while stack:
+            t = stack.pop()
+            order.append(t)
+            stack.extend(c for c in reversed(t.children) if c.children)
 
-                elif c.child_property_type == 'sequence':
-                    try:
-                        d[c.record_term_lc].append(cls._convert_to_dict(c, replace_value_names))
-                    except (KeyError, AttributeError):
-                        # The c.term property doesn't exist, so add a list
-                        d[c.record_term_lc] = [cls._convert_to_dict(c, replace_value_names)]
+        values = []
 
-                elif c.child_property_type == 'sconcat': # Concat with a space
+        for t in reversed(order):
+            d = cls._fold_children(t.children, [values.pop() if c.children else c.value for c in t.children])
 
-                    if c.record_term_lc in d:
-                        s = d[c.record_term_lc] + ' '
-                    else:
-                        s = ''
+            if t.value:
+                if replace_value_names:
+                    d[t.term_value_name.lower()] = t.value
+                else:
+                    d['@value'] = t.value
 
-                    d[c.record_term_lc] =s + (cls._convert_to_dict(c, replace_value_names) or '')
+            values.append(d)
 
-                elif c.child_property_type == 'bconcat':  # Concat with a blank
+        return [values.pop() if t.children else t.value for t in terms]
 
-                    d[c.record_term_lc] = d.get(c.record_term_lc, '') +  (cls._convert_to_dict(c,
-                                                                                               replace_value_names)
-                                                                          or '')
+    @staticmethod
+    def _fold_children(children, values, d=None):
+        """Add the dict values of child terms to a dict, by the term names, combining the values of terms with
+        the same name according to the child_property_type of the terms"""
+        from collections import OrderedDict
 
-                else:
-                    try:
-                        d[c.record_term_lc].append(cls._convert_to_dict(c, replace_value_names))
-                    except KeyError:
-                        # The c.term property doesn't exist, so add a scalar or a map
-                        d[c.record_term_lc] = cls._convert_to_dict(c, replace_value_names)
-                    except AttributeError as e:
-                        # d[c.term] exists, but is a scalar, so convert it to a list
+        if d is None:
+            d = OrderedDict()
 
-                        d[c.record_term_lc] = [d[c.record_term]] + [cls._convert_to_dict(c, replace_value_names)]
+        for c, v in zip(children, values):
+            k = c.record_term_lc
+            cpt = c.child_property_type
 
-            if term.value:
-                if replace_value_names:
-                    d[term.term_value_name.lower()] = term.value
+            if cpt == 'scalar':
+                d[k] = v
+
+            elif cpt == 'sequence':
+                e = d.get(k)
+                if isinstance(e, list):
+                    e.append(v)
                 else:
-                    d['@value'] = term.value
+                    d[k] = [v]
 
-            return d
+            elif cpt == 'sconcat':  # Concat with a space
+                d[k] = (d[k] + ' ' if k in d else '') + (v or '')
 
-        else:
-            return term.value
+            elif cpt == 'bconcat':  # Concat with a blank
+                d[k] = d.get(k, '') + (v or '')
 
-    @property
-    def rows(self):
-        """Yield rows for the term, for writing terms to a CSV file. """
+            elif k not in d:
+                # Add a scalar or a map
+                d[k] = v
+
+            else:
+                # Already have a value, so extend it, or convert it to a list
+                e = d[k]
+                if isinstance(e, list):
+                    e.append(v)
+                else:
+                    d[k] = [e, v]
+
+        return d
+
+    def _row(self):
+        """Return the row for this term alone, with its terminal children as properties"""
 
         # Translate the term value name so it can be assigned to a parameter.
         tvm = self.section.doc.decl_terms.get(self.qualified_term, {}).get('termvaluename', '@value')
@@ -628,23 +759,33 @@ class Term(object):
                     # a property name by the section -- the "Section" term has a blank column.
                     properties[c.record_term_lc] = c.value
 
-        yield (self.qualified_term, properties)
+        return (self.qualified_term, properties)
 
-        # The non-terminal children have to get yielded normally -- they can't be arg-children
-        for c in self.children:
-            if not c.is_terminal:
-                for row in c.rows:
-                    yield row
+    @property
+    def rows(self):
+        """Yield rows for the term, for writing terms to a CSV file. """
+
+        # The non-terminal children have to get yielded as rows of their own -- they can't be arg-children.
+        # Walk them in pre-order with a stack, pushed in reverse, rather than recursing.
+        stack = [self]
+
+        while stack:
+            t = stack.pop()
+
+            yield t._row()
+
+            stack.extend(c for c in reversed(t.children) if not c.is_terminal)
 
     @property
     def descendents(self):
-        """Iterate over all descendent terms"""
+        """Iterate over all descendent terms, in pre-order"""
 
-        for c in self.children:
-            yield c
+        stack = self.children[::-1]
 
-            for d in c.descendents:
-                yield d
+        while stack:
+            c = stack.pop()
+            yield c
+            stack.extend(reversed(c.children))
 
     def __iter__(self):
         raise NotImplementedError("Can't iterate a term. Did you expect a Section or a Resource?")
@@ -964,14 +1105,30 @@ class SectionTerm(Term):
     def as_lines(self):
         return '\n'.join( '{}: {}'.format(t,v if v is not None else '') for t, v  in self.lines )
 
-    def as_dict(self, replace_value_names=True):
-        """Return the whole section as a dict"""
-        old_children = self.children
-        self.children = self.terms
+    def as_dict(self, replace_value_names=True, copy=True):
+        """Return the whole section as a dict. The dict is cached in the document until the document changes.
+
+        :param copy: If False, return the cached dict, which must not be modified, rather than a copy of it.
+        """
+
+        if self.doc is None:
+            return self._build_dict(replace_value_names)
+
+        return self.doc.cached_dict(self, replace_value_names, lambda: self._build_dict(replace_value_names), copy)
 
-        d = super(SectionTerm, self).as_dict(replace_value_names)
+    def _build_dict(self, replace_value_names=True):
+        """Convert the section's terms to a dict, as for a term with the terms as children"""
 
-        self.children = old_children
+        if not self.terms:
+            return self.value
+
+        d = self._fold_children(self.terms, self._convert_terms(self.terms, replace_value_names))
+
+        if self.value:
+            if replace_value_names:
+                d[self.term_value_name.lower()] = self.value
+            else:
+                d['@value'] = self.value
 
         return d
 
@@ -981,8 +1138,8 @@ class RootSectionTerm(SectionTerm):
     def __init__(self, file_name=None, file_type=None, doc=None):
         super().__init__('Root.Root', 'Root', [], 0, 0, file_name, file_type, None, doc, None)
 
-    def as_dict(self, replace_value_names=True):
-        d = super(RootSectionTerm, self).as_dict(replace_value_names)
+    def _build_dict(self, replace_value_names=True):
+        d = super(RootSectionTerm, self)._build_dict(replace_value_names)
 
         if replace_value_names and '@value' in d:
             del d['@value']
@@ -9,4 +9,94 @@
 def test_data(*paths):
     from os.path import dirname, join, abspath
 
-    return abspath(join(dirname(abspath(__file__)), 'test-data', *paths))
\ No newline at end of file
+    return abspath(join(dirname(abspath(__file__)), 'test-data', *paths))
+
+
+class FileServer(object):
+    """A local HTTP server that stands in for a remote host, serving files from a dict of path to bytes.
+
+    Responses have an ETag, and conditional requests for unchanged files get a 304. The `requests` list records
+    (method, path, status) for each request, and `fail` is a number of requests to answer with a 503 before
+    serving normally. Use it as a context manager:
+
+        with FileServer({'/metadata.csv': b'...'}) as server:
+            url = server.url('/metadata.csv')
+    """
+
+    def __init__(self, files=None):
+        self.files = dict(files or {})
+        self.requests = []
+        self.fail = 0
+        self.connections = 0
+        self._server = None
+
+    def url(self, path):
+        return 'http://127.0.0.1:{}{}'.format(self._server.server_port, path)
+
+    def __enter__(self):
+        import threading
+        from hashlib import md5
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # For keep-alive
+
+            def setup(self):
+                import socket
+                super().setup()
+                # Headers and body are written separately, so don't wait to coalesce them
+                self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                server.connections += 1
+
+            def respond(self, send_body):
+
+                body = server.files.get(self.path, b'')
+
+                if server.fail > 0:
+                    server.fail -= 1
+                    status = 503
+                elif self.path not in server.files:
+                    status = 404
+                else:
+                    etag = '"{}"'.format(md5(body).hexdigest())
+
+                    if self.headers.get('If-None-Match') == etag:
+                        status = 304
+                    else:
+                        status = 200
+
+                server.requests.append((self.command, self.path, status))
+
+                self.send_response(status)
+
+                if status in (200, 304):
+                    self.send_header('ETag', etag)
+
+                if status != 304:
+                    self.send_header('Content-Length', str(len(body) if status == 200 else 0))
+
+                self.end_headers()
+
+                if status == 200 and send_body:
+                    self.wfile.write(body)
+
+            def do_GET(self):
+                self.respond(True)
+
+            def do_HEAD(self):
+                self.respond(False)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._server.daemon_threads = True
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._server.shutdown()
+        self._server.server_close()
@@ -0,0 +1,401 @@
+from __future__ import print_function
+
+import unittest
+from os import environ
+from os.path import getsize, join
+from tempfile import TemporaryDirectory
+from time import time
+
+from metatab.rowgen import TextRowGenerator
+
+# Benchmarks are slow and use a lot of disk, so they only run when requested, with:
+#
+#   METATAB_BENCHMARK=1 python -m unittest metatab.test.test_benchmarks
+
+benchmark = unittest.skipUnless(environ.get('METATAB_BENCHMARK'), 'Set METATAB_BENCHMARK to run benchmarks')
+
+
+def report(name, n, size, dt, peak=None):
+    print("{}: {} rows, {:.1f}MB in {:.2f}s; {:.1f}MB/s{}".format(
+        name, n, size / 1e6, dt, size / 1e6 / dt,
+        '; peak {:.1f}MB'.format(peak / 1e6) if peak is not None else ''))
+
+
+class TestBenchmarks(unittest.TestCase):
+
+    def write_lines_file(self, path, size):
+        """Write a Lines format file of about `size` bytes"""
+
+        block = '\n'.join([
+            '# Comment line',
+            '==== Schema|DataType|Description',
+            'Table: table_{n}',
+            'Table.Column: id|int|Row id',
+            'Table.Column: name|str|Name with an escaped \\| pipe',
+            '    .Description: A description for the column',
+            'Root.Note: Notes have a value, but no pipe characters',
+            ''
+        ])
+
+        with open(path, 'w') as f:
+            n = 0
+            while f.tell() < size:
+                f.write(block.format(n=n))
+                n += 1
+
+    @benchmark
+    def test_text_row_generator(self):
+        import tracemalloc
+
+        with TemporaryDirectory() as d:
+            path = join(d, 'metadata.txt')
+            self.write_lines_file(path, 100 * 1024 * 1024)
+            size = getsize(path)
+
+            t0 = time()
+            n = sum(1 for _ in TextRowGenerator(path))
+            dt = time() - t0
+
+            # Tracing is slow, so measure memory in a separate pass
+            tracemalloc.start()
+            sum(1 for _ in TextRowGenerator(path))
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+
+            report('TextRowGenerator, 100MB file', n, size, dt, peak)
+
+            # Streaming, so memory should not grow with the size of the file
+            self.assertLess(peak, 10 * 1024 * 1024)
+
+    @benchmark
+    def test_json_source(self):
+        """Compare loading a schema from JSON with loading the same schema from CSV"""
+        import csv
+        import json
+        from metatab import MetatabDoc
+        from metatab.rowgen import JsonMetatabSource
+
+        n_tables, n_columns = 200, 100
+
+        with TemporaryDirectory() as d:
+            csv_path = join(d, 'metadata.csv')
+
+            with open(csv_path, 'w') as f:
+                w = csv.writer(f)
+                w.writerow(['Declare', 'metatab-latest'])
+                w.writerow(['Section', 'Schema', 'DataType', 'Description'])
+                for i in range(n_tables):
+                    w.writerow(['Table', 'table_{}'.format(i)])
+                    for j in range(n_columns):
+                        w.writerow(['Table.Column', 'col_{}'.format(j), 'integer', 'Column {}'.format(j)])
+
+            json_path = join(d, 'metadata.json')
+
+            with open(json_path, 'w') as f:
+                json.dump(MetatabDoc(csv_path).as_dict(), f)
+
+            t0 = time()
+            n = sum(1 for _ in csv.reader(open(csv_path)))
+            report('CSV rows', n, getsize(csv_path), time() - t0)
+
+            t0 = time()
+            n = sum(1 for _ in JsonMetatabSource(json_path))
+            report('JSON rows', n, getsize(json_path), time() - t0)
+
+            t0 = time()
+            n = len(list(MetatabDoc(csv_path).all_terms))
+            report('CSV document', n, getsize(csv_path), time() - t0)
+
+            t0 = time()
+            n = len(list(MetatabDoc(JsonMetatabSource(json_path)).all_terms))
+            report('JSON document', n, getsize(json_path), time() - t0)
+
+    @benchmark
+    def test_remote_includes(self):
+        """Fetch 1,000 includes from a local stand-in server, first with a new connection for each, as a plain
+        requests.get does, then through the pooled HttpDownloader, and then revalidating the cached copies"""
+        import requests
+        from fs.osfs import OSFS
+        from metatab.resolver import HttpDownloader
+        from metatab.test.core import FileServer
+
+        n = 1000
+        files = {'/include-{}.csv'.format(i): 'Root.Note,Include {}\n'.format(i).encode('utf8') * 20
+                 for i in range(n)}
+        size = sum(len(b) for b in files.values())
+
+        with TemporaryDirectory() as d, FileServer(files) as server:
+            urls = [server.url(p) for p in files]
+
+            t0 = time()
+            for url in urls:
+                requests.get(url).content
+            report('Unpooled includes', n, size, time() - t0)
+
+            dl = HttpDownloader(OSFS(d), max_age=0)
+            connections = server.connections
+
+            t0 = time()
+            for url in urls:
+                dl.fetch(url)
+            report('Pooled includes', n, size, time() - t0)
+
+            t0 = time()
+            for url in urls:
+                dl.fetch(url)
+            report('Revalidated includes', n, size, time() - t0)
+
+            self.assertEqual(1, server.connections - connections)
+
+            dl.max_age = 60
+            t0 = time()
+            for url in urls:
+                dl.fetch(url)
+            report('Fresh includes', n, size, time() - t0)
+
+    @benchmark
+    def test_import_time(self):
+        """Measure importing the package and the CLI with -X importtime. Neither should import rowgenerators,
+        which is most of the import time of a command that parses a document"""
+        import subprocess
+        import sys
+
+        for module in ('metatab', 'metatab.cli', 'metatab.doc'):
+            r = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+                                'import sys, {}; print("rowgenerators" in sys.modules)'.format(module)],
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+            # Lines are: 'import time: self [us] | cumulative | imported package'
+            times = {line.split('|')[2].strip(): int(line.split('|')[1])
+                     for line in r.stderr.splitlines() if line.startswith('import time:') and line.count('|') == 2
+                     and not line.split('|')[1].strip().startswith('cumulative')}
+
+            print("import {}: {:.1f}ms".format(module, times[module] / 1000))
+
+            if module != 'metatab.doc':
+                self.assertEqual('False', r.stdout.strip())
+                self.assertLess(times[module], 100 * 1000)
+
+    @benchmark
+    def test_synthetic_suite(self):
+        """Run the benchmark suite on the same synthetic document, in CSV and Lines formats"""
+        import re
+        from metatab import MetatabDoc, parse_app_url
+        from metatab.benchmark import write_synthetic_doc, run_benchmarks
+
+        params = dict(sections=50, terms_per_section=50, schema_width=50, tables=5, include_depth=3)
+
+        results = {}
+        lines = {}
+
+        for format in ('csv', 'lines'):
+            with TemporaryDirectory() as d:
+                path = write_synthetic_doc(d, format=format, **params)
+                results[format] = run_benchmarks(path, repeat=1)
+                lines[format] = MetatabDoc(parse_app_url(path, proto='metatab')).as_lines()
+
+            for name, r in results[format].items():
+                print("{} {}: {:.3f}s; peak {:.1f}MB".format(format, name, r['time'], r['peak'] / 1e6))
+
+        self.assertEqual(list(results['csv']), list(results['lines']))
+
+        # The documents are the same, except for the extensions of the included files
+        self.assertEqual(re.sub(r'(include-\d+)\.csv', r'\1.txt', lines['csv']), lines['lines'])
+
+    @benchmark
+    def test_valueset_declaration(self):
+        """Parse a declaration with 1,000 declared terms, each in a value set, and 10,000 value set values"""
+        import csv
+        from metatab import MetatabDoc
+
+        n_terms, n_values = 1000, 10000
+
+        with TemporaryDirectory() as d:
+            path = join(d, 'valuesets.csv')
+
+            with open(path, 'w') as f:
+                w = csv.writer(f)
+                w.writerow(['Section', 'DeclaredSections'])
+                w.writerow(['DeclareSection', 'Root'])
+                w.writerow(['Section', 'DeclaredTerms', 'TermValueName', 'ValueSetName', 'Section'])
+                for i in range(n_terms):
+                    w.writerow(['DeclareTerm', 'Term{}'.format(i), 'value', 'set{}'.format(i % 10), 'Root'])
+                w.writerow(['Section', 'ValueSets', 'DisplayValue'])
+                for i in range(10):
+                    w.writerow(['DeclareValueSet', 'set{}'.format(i)])
+                    for j in range(n_values // 10):
+                        w.writerow(['DeclareValueSet.Value', 'v{}'.format(j), 'Value {}'.format(j)])
+
+            t0 = time()
+            doc = MetatabDoc(TextRowGenerator('Declare: ' + path))
+            report('Value set declaration', n_terms + n_values, getsize(path), time() - t0)
+
+            self.assertEqual(n_terms, len([k for k in doc.decl_terms if k.startswith('root.term')]))
+
+    @benchmark
+    def test_validate(self):
+        """Validate a document with a schema of 100 tables of 200 columns each, against a declaration of the
+        synthetic terms, with a rule for every column property"""
+        from metatab import MetatabDoc
+        from metatab.benchmark import synthetic_rows
+        from metatab.rowgen import MetatabRowGenerator
+        from metatab.validate import Validator
+
+        rows = [r for r in synthetic_rows(sections=10, terms_per_section=100, schema_width=200, tables=100)
+                if r[:1] != ['Declare']]
+
+        doc = MetatabDoc(MetatabRowGenerator(rows, path='synthetic'))
+
+        terms = {t: {'term': t, 'childpropertytype': 'scalar'}
+                 for t in ('root.title', 'root.name', 'root.identifier', 'root.version', 'root.description')}
+        terms.update({t: {'term': t} for t in ('root.item', 'item.description', 'item.note', 'root.datafile',
+                                               'root.table', 'table.column')})
+        terms['column.datatype'] = {'term': 'column.datatype', 'valuesetname': 'DataTypes',
+                                    'values': {'integer': 'Integer', 'number': 'Number', 'string': 'String'}}
+        terms['column.description'] = {'term': 'column.description', 'childpropertytype': 'scalar'}
+
+        sections = {'root': {'args': [], 'terms': ['Root.Title', 'Root.Name']},
+                    'resources': {'args': ['Name', 'Schema'], 'terms': ['Root.Datafile']},
+                    'schema': {'args': ['DataType', 'Description'], 'terms': ['Root.Table', 'Table.Column']}}
+
+        validator = Validator(terms, sections)
+        n = sum(1 for _ in doc.all_terms)
+
+        t0 = time()
+        findings = validator.validate(doc)
+        dt = time() - t0
+
+        print("Validate: {} terms in {:.2f}s; {:.0f} terms/s; {} findings".format(n, dt, n / dt, len(findings)))
+
+        self.assertFalse([f for f in findings if f.code in ('value_set', 'multiple_values')])
+
+    @benchmark
+    def test_traversal(self):
+        """Traverse a deep tree, of 10-level chains of terms, and a wide tree, of one table with 100,000 columns,
+        with all_terms, flat_terms and rows"""
+        from metatab import MetatabDoc
+
+        def deep(doc):
+            for i in range(10000):
+                t = doc['Schema'].new_term('Root.Table', 'table_{}'.format(i))
+                for j, name in enumerate(['Column', 'Property'] + ['Level{}'.format(k) for k in range(2, 9)]):
+                    t = t.new_child(name, '{}_{}'.format(name, j))
+
+        def wide(doc):
+            t = doc['Schema'].new_term('Root.Table', 'table')
+            for i in range(100000):
+                t.new_child('Column', 'column_{}'.format(i), datatype='integer')
+
+        for name, build in (('deep', deep), ('wide', wide)):
+            doc = MetatabDoc(TextRowGenerator('Title: Traversal\nSection: Schema|DataType\n'))
+            build(doc)
+
+            t0 = time()
+            n = sum(1 for _ in doc.all_terms)
+            dt_all = time() - t0
+
+            t0 = time()
+            self.assertEqual(n, len(doc.flat_terms))
+            dt_flat = time() - t0
+
+            t0 = time()
+            doc.flat_terms
+            dt_cached = time() - t0
+
+            t0 = time()
+            n_rows = sum(1 for _ in doc.rows)
+            dt_rows = time() - t0
+
+            print("Traversal, {}: {} terms; all_terms {:.3f}s, flat_terms {:.3f}s, cached {:.6f}s; "
+                  "{} rows in {:.3f}s".format(name, n, dt_all, dt_flat, dt_cached, n_rows, dt_rows))
+
+    @benchmark
+    def test_as_dict(self):
+        """Convert a document with a schema of 100 tables of 200 columns each to a dict, once after a change,
+        and repeatedly, as copies and from the cache"""
+        from metatab import MetatabDoc
+        from metatab.benchmark import synthetic_rows
+        from metatab.rowgen import MetatabRowGenerator
+
+        rows = [r for r in synthetic_rows(sections=10, terms_per_section=100, schema_width=200, tables=100)
+                if r[:1] != ['Declare']]
+
+        doc = MetatabDoc(MetatabRowGenerator(rows, path='synthetic'))
+        n = len(doc.flat_terms)
+
+        t0 = time()
+        d = doc.as_dict()
+        dt_first = time() - t0
+
+        doc.as_dict()  # Cached from the second request
+
+        t0 = time()
+        for i in range(10):
+            d2 = doc.as_dict()
+        dt_copy = (time() - t0) / 10
+
+        self.assertEqual(d, d2)
+
+        t0 = time()
+        for i in range(1000):
+            doc.as_dict(copy=False)
+        dt_cached = (time() - t0) / 1000
+
+        print("as_dict: {} terms; first {:.3f}s, copies {:.3f}s, cached {:.6f}s".format(
+            n, dt_first, dt_copy, dt_cached))
+
+    @benchmark
+    def test_emit(self):
+        """Write a document with a schema of 100 tables of 200 columns each as JSON, JSON Lines and YAML, with the
+        streaming writers, and by converting the whole document"""
+        import io
+        import json
+        import tracemalloc
+        import yaml
+        from metatab import MetatabDoc
+        from metatab.benchmark import synthetic_rows
+        from metatab.emit import write_json, write_jsonl, write_yaml
+        from metatab.rowgen import MetatabRowGenerator
+
+        rows = [r for r in synthetic_rows(sections=10, terms_per_section=100, schema_width=200, tables=100)
+                if r[:1] != ['Declare']]
+
+        doc = MetatabDoc(MetatabRowGenerator(rows, path='synthetic'))
+
+        writers = [
+            ('json.dumps', lambda f: f.write(json.dumps(doc.as_dict(), indent=4))),
+            ('write_json', lambda f: write_json(doc, f)),
+            ('write_jsonl', lambda f: write_jsonl(doc, f)),
+            ('write_jsonl fast', lambda f: write_jsonl(doc, f, fast=True)),
+            ('yaml.safe_dump', lambda f: f.write(yaml.safe_dump(json.loads(json.dumps(doc.as_dict())),
+                                                                default_flow_style=False, indent=4,
+                                                                sort_keys=False))),
+            ('write_yaml', lambda f: write_yaml(doc, f)),
+        ]
+
+        with TemporaryDirectory() as d:
+            for name, write in writers:
+                path = join(d, 'out')
+
+                doc.changed()  # Don't use the cached dicts
+
+                with open(path, 'w') as f:
+                    t0 = time()
+                    write(f)
+                    dt = time() - t0
+
+                with open(path, 'w') as f:
+                    tracemalloc.start()
+                    write(f)
+                    peak = tracemalloc.get_traced_memory()[1]
+                    tracemalloc.stop()
+
+                report(name, len(doc.flat_terms), getsize(path), dt, peak)
+
+            s = io.StringIO()
+            write_json(doc, s)
+            self.assertEqual(doc.as_dict(), json.loads(s.getvalue()))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,6 +1,7 @@
 from __future__ import print_function
 
 import json
+import os
 import unittest
 from os.path import exists
 
@@ -9,10 +10,20 @@ from rowgenerators import parse_app_url
 from metatab import IncludeError, MetatabDoc, WebResolver, TermParser
 from metatab.rowgen import TextRowGenerator
 from metatab.terms import Term
-from metatab.test.core import test_data
+from metatab.test.core import test_data, FileServer
 from metatab.util import flatten
 
 
+def fetch_all(cache_dir, urls):
+    """Fetch urls into a shared cache, in a worker process of test_concurrent_fetch"""
+    from fs.osfs import OSFS
+    from metatab.resolver import HttpDownloader
+
+    dl = HttpDownloader(OSFS(cache_dir))
+
+    return [dl.cache.readbytes(dl.fetch(url)[0]) for url in urls]
+
+
 class TestParser(unittest.TestCase):
 
     def setUp(self):
@@ -45,6 +56,18 @@ class TestParser(unittest.TestCase):
 
         self.assertEqual(0, errors)
 
+    def test_package_exports(self):
+        import metatab
+
+        ns = {}
+        exec('from metatab import *', ns)
+
+        for name in metatab.__all__:
+            self.assertIs(getattr(metatab, name), ns[name])
+
+        self.assertIs(TermParser, ns['TermParser'])
+        self.assertIsInstance(metatab.__version__, str)
+
     def test_new_parser(self):
 
         tp = MetatabDoc(test_data('short.csv'))
@@ -143,6 +166,397 @@ class TestParser(unittest.TestCase):
 
         print(type(rt))
 
+    def test_text_row_generator(self):
+        from pathlib import Path
+        from textwrap import dedent
+
+        text = dedent("""
+            # A comment
+            Root.Name: foobar
+            ==== Schema|DataType
+            Table.Column: id | int
+            Table.Column: pipe\\|column|str
+            NoValue
+            """)
+
+        rows = [
+            [''],
+            ['Root.Name', 'foobar'],
+            ['Section', 'Schema', 'DataType'],
+            ['Table.Column', 'id ', ' int'],
+            ['Table.Column', 'pipe|column', 'str'],
+            ['NoValue'],
+        ]
+
+        self.assertEqual(rows, list(TextRowGenerator(text)))
+
+        path = test_data('line/line-oriented-doc.txt')
+
+        with open(path) as f:
+            text_rows = list(TextRowGenerator(f.read()))
+
+        self.assertEqual(text_rows, list(TextRowGenerator(path)))
+        self.assertEqual(text_rows, list(TextRowGenerator(Path(path))))
+
+        self.assertEqual(text_rows, list(TextRowGenerator(parse_app_url(path))))
+
+        # Handles can be iterated more than once
+        with open(path) as f:
+            g = TextRowGenerator(f)
+            self.assertEqual(text_rows, list(g))
+            self.assertEqual(text_rows, list(g))
+
+        class Reader(object):
+            def __init__(self, text):
+                self.text = text
+
+            def read(self):
+                text, self.text = self.text, ''
+                return text
+
+        with open(path) as f:
+            g = TextRowGenerator(Reader(f.read()))
+            self.assertEqual(text_rows, list(g))
+            self.assertEqual(text_rows, list(g))
+
+    def test_synthetic_doc(self):
+        import csv
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from metatab.benchmark import write_synthetic_doc
+
+        with TemporaryDirectory() as d:
+            csv_path = write_synthetic_doc(d, sections=3, terms_per_section=4, schema_width=5, include_depth=2)
+            lines_path = write_synthetic_doc(d, sections=3, terms_per_section=4, schema_width=5, include_depth=2,
+                                             format='lines')
+
+            for name in ('metadata', 'include-1', 'include-2'):
+                # The same, except for blank lines, and the file extensions of includes
+                with open(join(d, name + '.csv')) as f:
+                    csv_rows = [row for row in csv.reader(f) if row and row[0] != 'Include']
+
+                lines_rows = [row for row in TextRowGenerator(join(d, name + '.txt'))
+                              if row != [''] and row[0] != 'Include']
+
+                self.assertEqual(csv_rows, lines_rows)
+
+            self.assertIn(['Include', 'include-1.csv'], list(csv.reader(open(csv_path))))
+            self.assertIn(['Include', 'include-2.txt'], list(TextRowGenerator(join(d, 'include-1.txt'))))
+            self.assertNotIn(['Include', 'include-3.txt'], list(TextRowGenerator(join(d, 'include-2.txt'))))
+
+            # Three sections, plus Resources and Schema
+            self.assertEqual(5, sum(1 for row in TextRowGenerator(lines_path) if row[0] == 'Section'))
+            self.assertEqual(2 * 5, sum(1 for row in TextRowGenerator(lines_path) if row[0] == 'Table.Column'))
+
+    def test_parse_stats(self):
+        from metatab.stats import ParseStats
+
+        text = 'Title: Stats\nSection: Schema|DataType\nTable: t\nTable.Column: a|int\nTable.Column: b|str\n'
+
+        doc = MetatabDoc(TextRowGenerator(text))
+        self.assertIsNone(doc.stats)
+        self.assertNotIn('get_term_class', vars(doc._term_parser))
+
+        doc = MetatabDoc(TextRowGenerator(text), stats=True)
+
+        stats = doc.stats.as_dict()
+
+        self.assertEqual(5, stats['phases']['rows']['calls'])
+        self.assertEqual(5, stats['files']['TextRowGenerator']['rows'])
+        self.assertEqual(2, stats['term_types']['table.column']['count'])
+        self.assertEqual(2, stats['term_types']['column.datatype']['count'])
+        self.assertGreater(stats['phases']['total']['time'], stats['phases']['link']['time'])
+
+        for phase in ('term_class', 'synonyms', 'link', 'load_terms'):
+            self.assertIn(phase, stats['phases'])
+
+        self.assertIn('table.column', doc.stats.report())
+
+        # Stats accumulate across documents
+        stats = ParseStats()
+        MetatabDoc(TextRowGenerator(text), stats=stats)
+        MetatabDoc(TextRowGenerator(text), stats=stats)
+        self.assertEqual(4, stats.term_types['table.column'][0])
+
+    def test_profile(self):
+        import pstats
+        from os.path import exists, join
+        from tempfile import TemporaryDirectory
+        from metatab.cli import metatab
+        from metatab.profiling import profiled
+
+        text = 'Title: Profile\nSection: Schema|DataType\n' + \
+               ''.join('Table: t{}\n'.format(i) + 'Table.Column: c|int\n' * 50 for i in range(20))
+
+        with TemporaryDirectory() as d:
+            prefix = join(d, 'profile')
+
+            with profiled(prefix, interval=0.0005):
+                MetatabDoc(TextRowGenerator(text))
+
+            functions = [f[2] for f in pstats.Stats(prefix + '.pstats').stats]
+            self.assertIn('generate_terms', functions)
+
+            with open(prefix + '.collapsed') as f:
+                stacks = [line.rsplit(' ', 1)[0].split(';') for line in f]
+
+            self.assertTrue(stacks)
+            self.assertIn(['[doc TextRowGenerator]', '[file TextRowGenerator]', '[section Schema]'],
+                          [[e for e in s if e.startswith('[')] for s in stacks])
+
+            # The files are written when the command exits
+            with self.assertRaises(SystemExit):
+                metatab(['--profile', join(d, 'cli'), join(d, 'nonexistent.csv')])
+
+            self.assertTrue(exists(join(d, 'cli.pstats')))
+            self.assertTrue(exists(join(d, 'cli.collapsed')))
+
+    def test_new_metatab_file(self):
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from metatab.cli import new_metatab_file
+
+        with TemporaryDirectory() as d:
+            paths = [join(d, 'new-{}.csv'.format(i)) for i in range(3)]
+
+            for path in paths:
+                self.assertTrue(new_metatab_file(path, None))
+
+            self.assertFalse(new_metatab_file(paths[0], None))
+
+            # Writing a file doesn't change the cached template, so the files don't share an identifier
+            contents = set()
+            for path in paths:
+                with open(path) as f:
+                    contents.add(f.read())
+
+                self.assertIsNone(MetatabDoc(path).find_first_value('Root.Identifier'))
+
+            self.assertEqual(1, len(contents))
+
+    def test_batch(self):
+        import io
+        from argparse import Namespace
+        from contextlib import redirect_stdout
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from unittest.mock import patch
+        from metatab import cli
+
+        with TemporaryDirectory() as d:
+            paths = []
+            for i in range(6):
+                paths.append(join(d, 'doc-{}.csv'.format(i)))
+                with open(paths[-1], 'w') as f:
+                    f.write('Declare,metatab-latest\nRoot.Title,Document {}\n'.format(i))
+
+            paths.insert(3, join(d, 'missing.csv'))
+
+            file_list = join(d, 'files.txt')
+            with open(file_list, 'w') as f:
+                f.write('\n'.join(paths) + '\n\n')
+
+            def run(*argv):
+                out = io.StringIO()
+                with redirect_stdout(out), self.assertRaises(SystemExit) as cm:
+                    cli.metatab(list(argv))
+                return cm.exception.code, [json.loads(l) for l in out.getvalue().splitlines()]
+
+            # One record per file, in order, with an error for the file that failed, which sets the exit status
+            code, records = run('-F', file_list, '--jsonl', '-f', 'Root.Title')
+            self.assertEqual(1, code)
+            self.assertEqual(paths, [r['file'] for r in records])
+            self.assertIn('error', records[3])
+            self.assertEqual(['Document {}'.format(i) for i in range(6)],
+                             [r['output'] for r in records if 'output' in r])
+
+            # The same records from a pool of processes
+            self.assertEqual((code, records), run('-F', file_list, '--jsonl', '-f', 'Root.Title', '-J', '3'))
+
+            code, records = run('--jsonl', '-f', 'Root.Title', join(d, 'doc-*.csv'))
+            self.assertEqual(0, code)
+            self.assertEqual(6, len(records))
+
+        # Workers only load the declarations if they didn't inherit them from the parent process
+        args = Namespace(mirror=None)
+        with patch.object(cli, '_warmed', {None}), patch.object(cli, 'warm_declarations') as warm:
+            cli.init_worker(args)
+            self.assertFalse(warm.called)
+
+        with patch.object(cli, '_warmed', set()), patch.object(cli, 'warm_declarations') as warm:
+            cli.init_worker(args)
+            warm.assert_called_once_with(args)
+
+    def test_declaration_rows_cache(self):
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from collections import OrderedDict
+        from unittest.mock import patch, MagicMock
+
+        with TemporaryDirectory() as d, \
+                patch.object(TermParser, '_declaration_rows', OrderedDict()) as cache, \
+                patch.object(TermParser, 'declaration_cache_size', 2):
+
+            tp = TermParser(TextRowGenerator('Title: Cache'), doc=MetatabDoc())
+
+            urls = []
+            for i in range(3):
+                urls.append(parse_app_url(join(d, 'decl-{}.csv'.format(i))))
+                with open(urls[-1].path, 'w') as f:
+                    f.write('Section,Section{}\n'.format(i))
+
+            for url in urls:
+                list(tp.declaration_rows(url))
+
+            # Bounded, keeping the most recently used
+            self.assertEqual([str(u) for u in urls[1:]], list(cache))
+
+            # Remote declarations are loaded again after remote_declaration_ttl
+            remote = MagicMock(scheme='http')
+            remote.__str__.return_value = 'http://example.com/decl.csv'
+            cache[str(remote)] = (None, 0, [['Section', 'Old']])
+
+            with patch('metatab.parser.get_generator', return_value=[['Section', 'New']]):
+                self.assertEqual([['Section', 'New']], list(tp.declaration_rows(remote)))
+
+    def test_yaml(self):
+        from metatab.rowgen import YamlMetatabSource
+
+        yaml_doc = MetatabDoc(YamlMetatabSource(parse_app_url(test_data('yaml/yaml-example-1.yaml'))))
+        csv_doc = MetatabDoc(test_data('yaml/yaml-example-1.csv'))
+
+        self.compare_dict(csv_doc.as_dict(), yaml_doc.as_dict())
+
+    def test_json(self):
+        """Load the as_dict() outputs in the JSON test files back into documents"""
+        from pathlib import Path
+        from metatab.rowgen import JsonMetatabSource
+
+        # Not example1-web, which loads its declaration from assets.metatab.org
+        for fn in ['example1', 'example2', 'include1', 'include2', 'include3',
+                   'children', 'children2', 'issue1']:
+
+            json_path = test_data('json', fn + '.json')
+
+            with open(json_path) as f:
+                d = json.load(f)
+
+            # The included terms are already in the JSON, so include terms are not loaded
+            d.pop('include', None)
+
+            # A Url, which has a read() method, so it must not be taken for a file handle
+            doc = MetatabDoc(JsonMetatabSource(parse_app_url(json_path)))
+            self.compare_dict(d, doc.as_dict())
+
+            for ref in (json_path, Path(json_path)):
+                doc = MetatabDoc(JsonMetatabSource(ref))
+                self.compare_dict(d, doc.as_dict())
+
+            with open(json_path, 'rb') as f:
+                doc = MetatabDoc(JsonMetatabSource(f))
+                self.compare_dict(d, doc.as_dict())
+
+            doc = MetatabDoc(JsonMetatabSource(d))
+            self.compare_dict(d, doc.as_dict())
+
+    def test_emit(self):
+        import io
+        import yaml
+        from collections import OrderedDict
+        from metatab.emit import events, write_json, write_jsonl, write_yaml
+        from metatab.rowgen import tree_events
+
+        doc = MetatabDoc(TextRowGenerator('Title: Emit\nNote: a\nNote: b\nUnicode: café\n'
+                                          'Section: Schema|DataType\nTable: t1\nTable.Column: a|int\n'
+                                          'Table.Column: b|str\nTable: t2\n'))
+
+        for o in [doc, doc['Schema'], doc.find_first('Root.Table')]:
+            for rvn in (True, False):
+                self.assertEqual(list(tree_events(o.as_dict(rvn))), list(events(o, rvn)))
+
+                s = io.StringIO()
+                write_json(o, s, replace_value_names=rvn)
+                self.assertEqual(json.dumps(o.as_dict(rvn), indent=4), s.getvalue())
+
+                s = io.StringIO()
+                write_yaml(o, s, replace_value_names=rvn)
+                self.assertEqual(o.as_dict(rvn), yaml.safe_load(s.getvalue()))
+
+        for fast in (False, True):
+            s = io.StringIO()
+            write_jsonl([doc, doc['Schema']], s, fast=fast)
+
+            lines = s.getvalue().splitlines()
+            self.assertEqual([doc.as_dict(), doc['Schema'].as_dict()],
+                             [json.loads(l, object_pairs_hook=OrderedDict) for l in lines])
+
+    def test_package_archives(self):
+        import csv
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from zipfile import ZipFile, ZIP_DEFLATED
+        from metatab.rowgen import ZipMetadataSource, XlsxMetadataSource
+
+        metadata_path = test_data('packages/example.com-test_package/metadata.csv')
+
+        with open(metadata_path, encoding='utf-8-sig') as f:
+            rows = list(csv.reader(f))
+
+        with TemporaryDirectory() as d:
+            zip_path = join(d, 'example.com-test_package.zip')
+
+            with ZipFile(zip_path, 'w', compression=ZIP_DEFLATED) as zf:
+                zf.writestr('example.com-test_package/data/data.csv', 'a,b,c\n' * 10000)
+                zf.write(metadata_path, 'example.com-test_package/metadata.csv')
+
+            self.assertEqual(rows, list(ZipMetadataSource(zip_path)))
+
+            # The second read uses the memoized member
+            self.assertIn(zip_path, [k[0] for k in ZipMetadataSource._members])
+            self.assertEqual(rows, list(ZipMetadataSource(zip_path)))
+
+            # Rewriting the archive replaces its entry, with the member at its new offset
+            with ZipFile(zip_path, 'w', compression=ZIP_DEFLATED) as zf:
+                zf.writestr('example.com-test_package/data/data.csv', 'a,b,c\n' * 20000)
+                zf.write(metadata_path, 'example.com-test_package/metadata.csv')
+
+            os.utime(zip_path, ns=(0, 0))
+            self.assertEqual(rows, list(ZipMetadataSource(zip_path)))
+            self.assertEqual(1, [k[0] for k in ZipMetadataSource._members].count(zip_path))
+
+            # Relative includes in a package are read from the same archive
+            inc_path = join(d, 'example.com-include_package.zip')
+
+            with ZipFile(inc_path, 'w', compression=ZIP_DEFLATED) as zf:
+                zf.writestr('example.com-include_package/metadata.csv',
+                            'Declare,metatab-latest\nTitle,Included\nInclude,parts/description.csv\n')
+                zf.writestr('example.com-include_package/parts/description.csv',
+                            'Root.Description,From the include\nInclude,../keywords.csv\n')
+                zf.writestr('example.com-include_package/keywords.csv', 'Root.Keyword,nested\n')
+
+            doc = parse_app_url(inc_path, proto='metatab').doc
+
+            self.assertEqual(d, doc.doc_dir)
+            self.assertEqual(os.path.getmtime(inc_path), doc.mtime)
+            self.assertEqual('From the include', doc.find_first_value('Root.Description'))
+            self.assertEqual('nested', doc.find_first_value('Root.Keyword'))
+
+            try:
+                from openpyxl import Workbook
+            except ImportError:
+                return
+
+            xlsx_path = join(d, 'example.com-test_package.xlsx')
+
+            wb = Workbook()
+            wb.active.title = 'meta'
+            for row in rows:
+                wb.active.append(row)
+            wb.save(xlsx_path)
+
+            self.assertEqual([r[0] for r in rows if r and r[0]],
+                             [r[0] for r in XlsxMetadataSource(xlsx_path) if r and r[0]])
+
     def test_line_doc_parts(self):
 
         doc = MetatabDoc(TextRowGenerator("Declare: metatab-latest"))
@@ -220,6 +634,69 @@ class TestParser(unittest.TestCase):
 
         self.assertTrue('bad_declare.csv' in e[0]['error'])
 
+    def test_tolerant(self):
+
+        text = ('Title: Tolerant\n'
+                'Include: doesntexist.csv\n'
+                'Orphan.Child: a\n'
+                '.Grandchild: b\n'
+                'Section: Contacts|Email\n'
+                'Creator: Bob|bob@example.com\n'
+                'Missing.Thing: x|y\n'
+                'Wrangler: Alice\n')
+
+        with self.assertRaises(IncludeError):
+            MetatabDoc(TextRowGenerator(text))
+
+        doc = MetatabDoc(TextRowGenerator(text), tolerant=True)
+
+        self.assertEqual([(2, 'root.include', 'IncludeError'), (3, 'orphan.child', 'ParserError'),
+                          (7, 'missing.thing', 'ParserError')],
+                         [(e['row'], e['term'], e['type']) for e in doc.errors])
+
+        # The children of the orphaned terms are skipped with them
+        self.assertEqual(['Tolerant', 'doesntexist.csv', 'Bob', 'Alice'], [t.value for t in doc.terms])
+        self.assertEqual('bob@example.com', doc.find_first('Root.Creator').get_value('Email'))
+
+        summary = doc.error_summary()
+        self.assertEqual(3, summary['errors'])
+        self.assertEqual({'IncludeError': 1, 'ParserError': 2}, dict(summary['types']))
+
+    def test_validate(self):
+        from metatab.validate import Validator
+
+        terms = {
+            'root.title': {'term': 'Root.Title', 'options': 'required', 'childpropertytype': 'scalar'},
+            'root.name': {'term': 'Root.Name', 'options': 'required'},
+            'root.format': {'term': 'Root.Format', 'valuesetname': 'Formats', 'values': {'CSV': 'CSV'}},
+            'root.creator': {'term': 'Root.Creator'},
+            'creator.email': {'term': 'Creator.Email', 'childpropertytype': 'scalar'},
+        }
+
+        sections = {
+            'root': {'args': [], 'terms': ['Root.Title', 'Root.Name', 'Root.Format']},
+            'contacts': {'args': ['Email', 'Tel'], 'terms': ['Root.Creator', 'Creator.Email']}
+        }
+
+        doc = MetatabDoc(TextRowGenerator('Title: One\nTitle: Two\nFormat: csv\nFormat: xls\nCreator: Bob\n'
+                                          'Section: Contacts|Email|Tel\n'
+                                          'Creator: Alice|a@example.com|555-1212\n.Email: b@example.com\n'
+                                          'Wrangler: Carol\nSection: Other\n'))
+
+        findings = Validator(terms, sections).validate(doc)
+
+        self.assertEqual([
+            ('multiple_values', 'root.title', 2),
+            ('value_set', 'root.format', 4),
+            ('wrong_section', 'root.creator', 5),
+            ('multiple_values', 'creator.email', 8),
+            ('undeclared_term', 'root.wrangler', 9),
+            ('undeclared_section', 'root.section', 10),
+            ('required', 'root.name', None)
+        ], [(f.code, f.term, f.row) for f in findings])
+
+        self.assertEqual('error', findings[0].as_dict()['severity'])
+
     def test_headers(self):
         d1 = MetatabDoc(test_data('example1-headers.csv')).root.as_dict()
         d2 = MetatabDoc(test_data('example1.csv')).root.as_dict()
@@ -244,6 +721,134 @@ class TestParser(unittest.TestCase):
 
         self.assertEquals(['example1', 'example2'], [t.name for t in doc.find('root.datafile')])
 
+    def test_super_term_index(self):
+        from metatab.parser import SuperTermIndex
+
+        idx = SuperTermIndex()
+        idx.add('Root.Datafile', 'Root.Resource')
+        idx.add('root.homepage', 'root.resource')
+        idx.add('root.sql', 'root.datafile')
+
+        self.assertEqual({'root.datafile', 'root.homepage'}, idx.derived_terms['root.resource'])
+        self.assertEqual(['root.datafile', 'root.homepage', 'Root.Resource'], idx.expand('Root.Resource'))
+
+        # Redeclaring a term moves it
+        idx.add('root.sql', 'root.resource')
+        self.assertEqual('root.resource', idx.super_terms['root.sql'])
+        self.assertNotIn('root.datafile', idx.derived_terms)
+
+        idx.remove('root.sql')
+        idx.remove('root.sql')
+        self.assertNotIn('root.sql', idx.super_terms)
+
+        doc = MetatabDoc(TextRowGenerator('Datafile: a\nHomepage: b\nNote: c\nResource: d\n'))
+        doc.super_index.update(idx)
+
+        self.assertIs(doc.super_terms, doc.super_index.super_terms)
+        self.assertEqual(['a', 'b', 'd'], [t.value for t in doc.find('Root.Resource')])
+        self.assertEqual(['a', 'b', 'd', 'c'], [t.value for t in doc.find(['Root.Resource', 'Root.Note'])])
+        self.assertEqual(['a', 'b', 'd'], [t.value for t in doc.find(['Root.Resource', 'Root.Datafile'])])
+        self.assertEqual(['a'], [t.value for t in doc.find('Root.Datafile')])
+
+    def test_declared_term_indexes(self):
+        tp = MetatabDoc(TextRowGenerator('Title: Indexes'))._term_parser
+
+        tp.set_declared_term('root.format', {'term': 'Format', 'valuesetname': 'Formats', 'values': {},
+                                             'synonym': 'Root.Type'})
+
+        self.assertEqual('Root.Type', tp.synonyms['root.format'])
+        self.assertIn('root.format', tp._valueset_terms['formats'])
+
+        # Redeclaring the term replaces the index entries
+        tp.set_declared_term('root.format', {'term': 'Format', 'valuesetname': 'Types', 'values': {}})
+
+        self.assertNotIn('root.format', tp.synonyms)
+        self.assertNotIn('root.format', tp._valueset_terms['formats'])
+        self.assertIn('root.format', tp._valueset_terms['types'])
+
+    def test_term_records(self):
+        from metatab.parser import UNDECLARED_TERM
+
+        tp = MetatabDoc(TextRowGenerator('Title: Records'))._term_parser
+
+        tp.set_declared_term('root.format', {'term': 'Format', 'options': 'a,b', 'childpropertytype': 'sequence'})
+        tp.set_declared_term('root.type', {'term': 'Type', 'options': 'a,b', 'termvaluename': 'name'})
+
+        dt = tp.term_record('root.format')
+        self.assertEqual((True, 'sequence', None, ('a', 'b')), dt)
+        self.assertIs(dt, tp.term_record('root.format'))
+        self.assertIs(dt.options, tp.term_record('root.type').options)
+        self.assertIs(UNDECLARED_TERM, tp.term_record('root.undeclared'))
+
+        # Parsed and constructed terms both have tuple options
+        self.assertEqual(tuple, type(Term('Root.Title', 'x').options))
+        self.assertEqual(tuple, type(MetatabDoc(TextRowGenerator('Title: Records')).find_first('Root.Title').options))
+
+        # Redeclaring the term replaces the record
+        tp.set_declared_term('root.format', {'term': 'Format'})
+        self.assertEqual((True, 'any', None, ('',)), tp.term_record('root.format'))
+
+    def test_compiled_declaration(self):
+        from tempfile import TemporaryDirectory
+        from metatab.compiledecl import module_source
+        from metatab.doc import get_declaration
+
+        doc = MetatabDoc(TextRowGenerator('Title: Compiled'))
+        doc.decl_terms.update({
+            'root.contact': {'term': 'Root.Contact', 'section': 'Contacts', 'values': {}},
+            'root.creator': {'term': 'Root.Creator', 'section': 'Contacts', 'inheritsfrom': 'Root.Contact',
+                             'termvaluename': 'name', 'values': {}},
+            'root.format': {'term': 'Format', 'valuesetname': 'Formats', 'values': {'csv': 'CSV'},
+                            'synonym': 'Root.Type'}
+        })
+        doc.decl_sections['contacts'] = {'args': ['Email'], 'terms': ['Root.Contact', 'Root.Creator']}
+        doc.super_index.add('root.creator', 'root.contact')
+
+        with TemporaryDirectory() as d:
+            path = os.path.join(d, 'compiled_decl.py')
+
+            with open(path, 'w') as f:
+                f.write(module_source(doc, 'test'))
+
+            doc = MetatabDoc(TextRowGenerator('Creator: Bob\n'), decl='py:' + path)
+
+            self.assertEqual('name', doc.decl_terms['root.creator']['termvaluename'])
+            self.assertEqual(('Email',), doc.decl_sections['contacts']['args'])
+            self.assertEqual('root.contact', doc.super_terms['root.creator'])
+            self.assertEqual('name', doc.find_first('Root.Creator').term_value_name)
+
+            # The document declares the declaration the module was compiled from
+            self.assertEqual(['test'], [t.value for t in doc.find('Root.Declare')])
+            self.assertEqual(['Declare', 'test'], doc.as_csv().splitlines()[0].split(','))
+
+            with self.assertRaises(TypeError):
+                doc.decl_terms['root.format']['values']['tsv'] = 'TSV'
+
+            d = get_declaration('py:' + path)
+            self.assertEqual('contacts', d['term_sections']['root.creator'])
+            self.assertEqual(('root.contact',), d['super_terms']['root.creator'])
+
+    def test_inherited_terms(self):
+        doc = MetatabDoc(TextRowGenerator('Section: Declare|Section|InheritsFrom\n'
+                                          'DeclareSection: Contacts\n'
+                                          'DeclareTerm: Root.Agent|Contacts|\n'
+                                          'DeclareTerm: Root.Contact|Contacts|Root.Agent\n'
+                                          'DeclareTerm: Contact.Name|Contacts|\n'
+                                          'DeclareTerm: Agent.Email|Contacts|\n'
+                                          'DeclareTerm: Root.Wrangler|Contacts|Root.Contact\n'))
+        tp = doc._term_parser
+
+        for t in doc['Declare']:
+            tp.manage_declare_terms(t)
+
+        # Email is inherited through Contact, although Contact was declared before Agent.Email
+        self.assertEqual(['Root.Agent', 'Root.Contact', 'Contact.Name', 'Agent.Email', 'Root.Wrangler',
+                          'Wrangler.Name', 'Wrangler.Email'], tp.declare_dict['sections']['contacts']['terms'])
+        self.assertEqual('', tp.declared_terms['wrangler.email']['inheritsfrom'])
+
+        self.assertEqual(('root.contact', 'root.agent'), doc.super_index.ancestors('Root.Wrangler'))
+        self.assertEqual({'root.contact', 'root.wrangler'}, doc.super_index.descendants('root.agent'))
+
     def test_sections(self):
 
         doc = MetatabDoc(test_data('example1.csv'))
@@ -363,6 +968,79 @@ class TestParser(unittest.TestCase):
 
         self.assertEquals(146, (len(list(doc.all_terms))))
 
+    def test_flat_terms(self):
+
+        doc = MetatabDoc(TextRowGenerator('Title: Flat\nSection: Schema|DataType\n'
+                                          'Table: t1\nTable.Column: a|int\nTable.Column: b|str\nTable: t2\n'))
+
+        flat = doc.flat_terms
+        self.assertEqual(list(doc.all_terms), list(flat))
+        self.assertEqual(['root.title', 'root.section', 'root.table', 'table.column', 'column.datatype',
+                          'table.column', 'column.datatype', 'root.table'], [t.join_lc for t in flat])
+        self.assertIs(flat, doc.flat_terms)
+
+        # Changes invalidate the view
+        t2 = doc.find_first('Root.Table', value='t2')
+        c = t2.new_child('Column', 'c')
+        self.assertIsNot(flat, doc.flat_terms)
+        self.assertIs(c, doc.flat_terms[-1])
+
+        t2.remove_child(c)
+        self.assertEqual(list(flat), list(doc.flat_terms))
+
+        # Deeper than the recursion limit
+        import sys
+        n = sys.getrecursionlimit() + 100
+        t = chain = doc['Root'].new_term('Root.Chain', 0)
+        for i in range(n):
+            t = t.new_child('Chain', i + 1)
+
+        self.assertEqual(n, len(list(chain.descendents)))
+        self.assertEqual(len(flat) + n + 1, len(doc.flat_terms))
+        self.assertEqual(n, len(list(chain.rows)))  # The last, terminal, term is a property of its parent's row
+
+    def test_dict_cache(self):
+
+        doc = MetatabDoc(TextRowGenerator('Title: Cached\nNote: a\nNote: b\nSection: Schema|DataType\n'
+                                          'Table: t1\nTable.Column: a|int\n'))
+
+        d = doc.as_dict()
+        self.assertEqual(['a', 'b'], d['note'])
+        self.assertEqual({'@value': 't1', 'column': {'@value': 'a', 'datatype': 'int'}}, d['table'])
+
+        # Cached from the second request; copies can be modified
+        self.assertEqual(d, doc.as_dict())
+        cached = doc.as_dict(copy=False)
+        self.assertIs(cached, doc.as_dict(copy=False))
+        doc.as_dict()['note'].append('c')
+        self.assertEqual(['a', 'b'], doc.as_dict()['note'])
+
+        schema = doc['Schema'].as_dict(copy=False)
+        self.assertIs(schema, doc['Schema'].as_dict(copy=False))
+        self.assertEqual(schema, doc['Schema'].as_dict())
+
+        # Changes invalidate the cache
+        doc.find_first('Root.Title').value = 'Changed'
+        self.assertEqual('Changed', doc.as_dict(copy=False)['title'])
+        self.assertIsNot(schema, doc['Schema'].as_dict(copy=False))
+
+        doc.find_first('Root.Table').new_child('Column', 'b', datatype='str')
+        self.assertEqual(['a', 'b'], [c['@value'] for c in doc.as_dict()['table']['column']])
+
+        # ... and so do direct edits to the children and terms lists
+        flat = doc.flat_terms
+        doc.as_dict(copy=False)
+        doc.find_first('Root.Table').children.pop()
+        self.assertEqual('a', doc.as_dict(copy=False)['table']['column']['@value'])
+        self.assertEqual(len(flat) - 2, len(doc.flat_terms))
+
+        doc['Root'].terms.remove(doc.find_first('Root.Title'))
+        self.assertNotIn('title', doc.as_dict(copy=False))
+
+        # Copies of the lists are plain lists
+        import copy
+        self.assertIs(list, type(copy.copy(doc['Schema'].terms)))
+
     def test_versions(self):
 
         doc = MetatabDoc(test_data('example1.csv'))
@@ -465,6 +1143,367 @@ class TestParser(unittest.TestCase):
         print(u.get_resource())
         print(u.get_resource().get_target())
 
+    def test_http_downloader(self):
+        from tempfile import TemporaryDirectory
+        from fs.osfs import OSFS
+        from metatab.resolver import HttpDownloader
+
+        files = {'/decl.csv': b'Declare,metatab-latest\n',
+                 '/include.csv': b'Root.Note,Included\n'}
+
+        with TemporaryDirectory() as d:
+            with FileServer(files) as server:
+                dl = HttpDownloader(OSFS(d), backoff_factor=0, max_age=0)
+                url = server.url('/include.csv')
+
+                cache_path, t = dl.fetch(url)
+                self.assertIsNotNone(t)
+                self.assertEqual(files['/include.csv'], dl.cache.readbytes(cache_path))
+
+                # Revalidated with a conditional request, not downloaded again
+                self.assertEqual((cache_path, None), dl.fetch(url))
+                self.assertEqual(304, server.requests[-1][2])
+
+                server.files['/include.csv'] = b'Root.Note,Changed\n'
+                self.assertIsNotNone(dl.fetch(url)[1])
+                self.assertEqual(b'Root.Note,Changed\n', dl.cache.readbytes(cache_path))
+
+                # All over one kept-alive connection
+                self.assertEqual(1, server.connections)
+
+                # Retries 5xx responses
+                server.fail = 2
+                dl.clean = True
+                dl.fetch(server.url('/decl.csv'))
+                self.assertEqual([503, 503, 200], [r[2] for r in server.requests[-3:]])
+
+                with self.assertRaises(Exception):
+                    dl.fetch(server.url('/missing.csv'))
+
+                # Files fetched within max_age seconds are used without a request
+                dl.clean = False
+                dl.max_age = 60
+                n_requests = len(server.requests)
+                self.assertEqual((cache_path, None), dl.fetch(url))
+                self.assertEqual(n_requests, len(server.requests))
+
+                # When the server fails, the stale file is used
+                dl.max_age = 0
+                server.fail = 10
+                self.assertEqual((cache_path, None), dl.fetch(url))
+                self.assertEqual(b'Root.Note,Changed\n', dl.cache.readbytes(cache_path))
+                server.fail = 0
+
+            # ... and when the host is unreachable
+            self.assertEqual((cache_path, None), dl.fetch(url))
+
+    def test_mirror(self):
+        import shutil
+        from concurrent.futures import ThreadPoolExecutor
+        from os.path import basename, join
+        from tempfile import TemporaryDirectory
+        from unittest.mock import patch
+        from fs.osfs import OSFS
+        from rowgenerators import Url
+        from rowgenerators.exceptions import DownloadError
+        from metatab import MirrorResolver
+        from metatab.parser import METATAB_ASSETS_URL
+        from metatab.resolver import SnapshotDownloader, MirrorDownloader, mirror_dir
+
+        files = {'/doc/metadata.csv': b'Root.Note,Remote\nInclude,include.csv\n',
+                 '/doc/include.csv': b'Root.Note,Included\n'}
+
+        with TemporaryDirectory() as d:
+            mirror = join(d, 'mirror')
+
+            with FileServer(files) as server:
+                urls = [server.url(p) for p in sorted(files)]
+
+                dl = SnapshotDownloader(mirror)
+                for url in urls:
+                    dl.download(Url(url))
+                dl.write_manifest()
+
+            # The server is gone, so these come from the mirror, as a directory and as an archive
+            archive = shutil.make_archive(join(d, 'mirror'), 'zip', mirror)
+
+            # Archives are extracted into the download cache
+            extract_cache = OSFS(join(d, 'cache'), create=True)
+
+            for m in (mirror, archive):
+                with patch('metatab.util.get_cache', lambda: extract_cache):
+                    mdl = MirrorDownloader(m)
+
+                for url, path in zip(urls, sorted(files)):
+                    with open(mdl.download(Url(url)).sys_path, 'rb') as f:
+                        self.assertEqual(files[path], f.read())
+
+                with self.assertRaises(DownloadError):
+                    mdl.download(Url(server.url('/doc/missing.csv')))
+
+            # Concurrent extractions of the same archive end with one complete directory, and no temporary ones
+            with patch('metatab.util.get_cache', lambda: extract_cache), ThreadPoolExecutor(4) as pool:
+                extract_cache.removetree('mirrors')
+                dirs = list(pool.map(mirror_dir, [archive] * 8))
+
+            self.assertEqual(1, len(set(dirs)))
+            self.assertEqual([basename(dirs[0])],
+                             [n for n in extract_cache.listdir('mirrors') if not n.endswith('.lock')])
+
+            dl = SnapshotDownloader(mirror)
+            dl.manifest[METATAB_ASSETS_URL + 'example.csv'] = dl.manifest[urls[0]]
+            dl.write_manifest()
+
+            resolver = MirrorResolver(mirror)
+            self.assertEqual(METATAB_ASSETS_URL + 'example.csv', resolver.find_decl_doc('example'))
+
+            with self.assertRaises(IncludeError):
+                resolver.find_decl_doc('missing')
+
+    def test_cache_manager(self):
+        from tempfile import TemporaryDirectory
+        from time import time
+        from fs.osfs import OSFS
+        from metatab.cache import CacheManager, DAY
+        from metatab.resolver import HttpDownloader
+
+        files = {'/include-{}.csv'.format(i): b'Root.Note,Include\n' * (i + 1) for i in range(4)}
+
+        with TemporaryDirectory() as d, FileServer(files) as server:
+            cache = OSFS(d)
+            cache.makedirs('assets.metatab.org')
+            cache.writebytes('assets.metatab.org/old-decl.csv', b'Declare,metatab-latest\n')
+
+            dl = HttpDownloader(cache)
+            urls = [server.url(p) for p in sorted(files)]
+
+            for url in urls + urls[:2] + urls[:1]:
+                dl.fetch(url)
+
+            cm = CacheManager(cache, ttls={'include': 60 * DAY})
+
+            r = cm.report()
+            self.assertEqual(5, r['entries'])
+            self.assertEqual({'declaration': 1, 'include': 4}, {k: v['entries'] for k, v in r['classes'].items()})
+            self.assertEqual({'hits': 3, 'misses': 4, 'evictions': 0}, r['counters'])
+
+            # Declarations expire after 30 days
+            self.assertEqual(['assets.metatab.org/old-decl.csv'],
+                             [e.path for e in cm.prune(now=time() + 31 * DAY, dry_run=True)])
+
+            # The least frequently used entries go first, with ties broken by the least recently used
+            cm.max_entries = 3
+            cm.policy = 'lfu'
+            evicted = [e.path for e in cm.prune()]
+            self.assertEqual('assets.metatab.org/old-decl.csv', evicted[0])
+            self.assertTrue(evicted[1].endswith('/include-2.csv'))
+            self.assertFalse(cache.exists(evicted[1] + '.validators'))
+
+            # Lock files are kept, since other processes may be waiting on them, but aren't listed as entries
+            self.assertTrue(cache.exists(evicted[1] + '.lock'))
+            self.assertNotIn(evicted[1], [e.path for e in cm.entries()])
+
+            cm.max_entries = None
+            cm.max_bytes = cm.report()['bytes'] - 1
+            self.assertEqual(1, len(cm.prune()))
+            self.assertEqual(3, cm.counters['evictions'])
+
+    def test_concurrent_fetch(self):
+        from multiprocessing import get_context
+        from os import walk
+        from tempfile import TemporaryDirectory
+
+        n_procs = 8
+
+        files = {'/include-{}.csv'.format(i): 'Root.Note,Include {}\n'.format(i).encode('utf8') * 10000
+                 for i in range(20)}
+
+        with TemporaryDirectory() as d, FileServer(files) as server:
+            urls = [server.url(p) for p in sorted(files)]
+            expected = [files[p] for p in sorted(files)]
+
+            with get_context('spawn').Pool(n_procs) as pool:
+                results = pool.starmap(fetch_all, [(d, urls)] * n_procs)
+
+            # Every process got complete files ...
+            for r in results:
+                self.assertEqual(expected, r)
+
+            # ... but each url was only downloaded once; the other processes waited for it, or revalidated it
+            self.assertEqual(len(urls), sum(1 for r in server.requests if r[2] == 200))
+
+            self.assertFalse([f for _, _, fns in walk(d) for f in fns if '.tmp-' in f])
+
+    def test_threaded_fetch(self):
+        from concurrent.futures import ThreadPoolExecutor
+        from tempfile import TemporaryDirectory
+        from fs.osfs import OSFS
+        from metatab.cache import get_cache_manager
+        from metatab.resolver import HttpDownloader
+
+        files = {'/include-{}.csv'.format(i): 'Root.Note,Include {}\n'.format(i).encode('utf8') for i in range(20)}
+
+        with TemporaryDirectory() as d, FileServer(files) as server:
+            dl = HttpDownloader(OSFS(d))
+            urls = [server.url(p) for p in sorted(files)]
+
+            # The cache manager's connection is opened in this thread, and used from the others
+            dl.fetch(urls[0])
+
+            with ThreadPoolExecutor(8) as pool:
+                results = list(pool.map(lambda url: dl.cache.readbytes(dl.fetch(url)[0]), urls * 3))
+
+            self.assertEqual([files[p] for p in sorted(files)] * 3, results)
+
+            counters = get_cache_manager(dl.cache).counters
+            self.assertEqual(len(urls) * 3 + 1, counters['hits'] + counters['misses'])
+            self.assertEqual(len(urls), counters['misses'])
+
+    def test_server(self):
+        import io
+        import threading
+        from collections import namedtuple
+        from os.path import join
+        from tempfile import TemporaryDirectory
+        from metatab.exc import ServerError
+        from metatab.server import MetatabServer, DocumentCache, request, private_dir
+
+        # Documents are reopened when their files change
+        with TemporaryDirectory() as d:
+            path = join(d, 'metadata.csv')
+            with open(path, 'w') as f:
+                f.write('Root.Title,One\n')
+
+            include_path = join(d, 'include.csv')
+            with open(include_path, 'w') as f:
+                f.write('Root.Note,One\n')
+
+            Url = namedtuple('Url', 'scheme path')
+            Doc = namedtuple('Doc', 'text sources')
+
+            url = Url('file', path)
+            docs = DocumentCache()
+            opened = []
+
+            def open_doc():
+                opened.append(Doc(open(path).read(), [Url('file', include_path)]))
+                return opened[-1]
+
+            self.assertEqual('Root.Title,One\n', docs.get(url, open_doc).text)
+            self.assertEqual('Root.Title,One\n', docs.get(url, open_doc).text)
+
+            with open(path, 'w') as f:
+                f.write('Root.Title,Two\n')
+            os.utime(path, (0, 0))
+
+            self.assertEqual('Root.Title,Two\n', docs.get(url, open_doc).text)
+            self.assertEqual(2, len(opened))
+
+            # ... and when the files they include change
+            os.utime(include_path, (0, 0))
+            docs.get(url, open_doc)
+            docs.get(url, open_doc)
+            self.assertEqual(3, len(opened))
+
+            # Documents opened with different options are cached separately
+            self.assertIsNot(docs.get(url, open_doc), docs.get(url, open_doc, options=(True,)))
+            self.assertEqual(4, len(opened))
+
+        server = MetatabServer()
+
+        # Over stdio
+        rfile = io.StringIO('\n'.join([
+            json.dumps({'jsonrpc': '2.0', 'id': 1, 'method': 'ping'}),
+            'not json',
+            json.dumps({'jsonrpc': '2.0', 'id': 2, 'method': 'nothing'}),
+            json.dumps({'jsonrpc': '2.0', 'id': 3, 'method': 'find', 'params': {'bad': 1}}),
+            json.dumps({'jsonrpc': '2.0', 'method': 'ping'}),  # A notification, with no response
+            json.dumps({'jsonrpc': '2.0', 'id': 4, 'method': 'run', 'params': [['--help']]}),
+        ]))
+        wfile = io.StringIO()
+        server.serve_stream(rfile, wfile)
+
+        responses = [json.loads(l) for l in wfile.getvalue().splitlines()]
+        self.assertEqual([1, None, 2, 3, 4], [r['id'] for r in responses])
+        self.assertEqual('pong', responses[0]['result'])
+        self.assertEqual([-32700, -32601, -32602], [r['error']['code'] for r in responses[1:4]])
+        self.assertEqual(0, responses[4]['result']['exit'])
+        self.assertIn('usage: metatab', responses[4]['result']['stdout'])
+
+        # Over a Unix socket
+        with TemporaryDirectory() as d:
+            path = join(d, 'metatab.sock')
+            ready = threading.Event()
+            t = threading.Thread(target=server.serve_socket, args=(path,), kwargs={'ready': ready}, daemon=True)
+            t.start()
+            ready.wait(10)
+
+            self.assertEqual('pong', request(path, 'ping'))
+            self.assertEqual(0, os.stat(path).st_mode & 0o077)
+            self.assertEqual(1, request(path, 'run', argv=['nonexistent.csv'], cwd=d)['exit'])
+
+            with self.assertRaises(ServerError):
+                request(path, 'convert', path='nonexistent.csv', format='xml')
+
+            self.assertEqual('ok', request(path, 'shutdown'))
+            t.join(10)
+            self.assertFalse(t.is_alive())
+
+            # Directories that other users can use aren't used for sockets
+            private = join(d, 'private')
+            self.assertEqual(private, private_dir(private))
+            self.assertEqual(0, os.stat(private).st_mode & 0o077)
+            os.chmod(private, 0o755)
+            with self.assertRaises(ServerError):
+                private_dir(private)
+
+            # Nor are paths that another user created first
+            if os.getuid() == 0:
+                with open(path, 'w'):
+                    pass
+                os.chown(path, 12345, -1)
+
+                with self.assertRaises(ServerError):
+                    server.serve_socket(path)
+
+                with self.assertRaises(ServerError):
+                    request(path, 'ping')
+
+    def test_url_resolution_cache(self):
+        from os import remove
+        from shutil import copy
+        from tempfile import TemporaryDirectory
+        from os.path import join
+        from rowgenerators.appurl.web.download import Downloader
+        from metatab.appurl import MetatabUrl
+
+        with TemporaryDirectory() as d:
+            path = join(d, 'metadata.csv')
+            copy(test_data('example1.csv'), path)
+
+            u = MetatabUrl(path, downloader=Downloader.get_instance())
+            r = u.get_resource()
+            cached = u._resource_memo[1]
+
+            # Memoized on the instance, and shared with other urls for the same file
+            u.get_resource()
+            self.assertIs(cached, u._resource_memo[1])
+
+            u2 = MetatabUrl(path, downloader=Downloader.get_instance())
+            u2.get_resource()
+            self.assertIs(cached, u2._resource_memo[1])
+
+            # Callers get copies, so changing one doesn't change the cached url
+            self.assertEqual(str(r), str(u.get_resource()))
+            self.assertIsNot(cached, r)
+            r.path = join(d, 'other.csv')
+            self.assertEqual(path, u.get_resource().path)
+
+            # Removing the file invalidates the entry
+            remove(path)
+            u.get_resource()
+            self.assertIsNot(cached, u._resource_memo[1])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -14,7 +14,14 @@ from os.path import join, basename, dirname, isdir, abspath
 #from rowgenerators import reparse_url, parse_url_to_dict, unparse_url_dict, Url
 
 from metatab import DEFAULT_METATAB_FILE
-from rowgenerators import get_cache
+
+
+def get_cache(*args, **kwargs):
+    """Return the file cache. Wraps rowgenerators.get_cache(), which is imported on the first call, since
+    importing rowgenerators is slow"""
+    from rowgenerators import get_cache
+
+    return get_cache(*args, **kwargs)
 
 
 def declaration_path(name):
@@ -55,13 +62,13 @@ def flatten(d, sep='.'):
     """Flatten a data structure into tuples"""
 
     def _flatten(e, parent_key='', sep='.'):
-        import collections
+        from collections.abc import MutableMapping, MutableSequence
 
         prefix = parent_key + sep if parent_key else ''
 
-        if isinstance(e, collections.MutableMapping):
+        if isinstance(e, MutableMapping):
             return tuple((prefix + k2, v2) for k, v in e.items() for k2, v2 in _flatten(v, k, sep))
-        elif isinstance(e, collections.MutableSequence):
+        elif isinstance(e, MutableSequence):
             return tuple((prefix + k2, v2) for i, v in enumerate(e) for k2, v2 in _flatten(v, str(i), sep))
         else:
             return (parent_key, (e,)),
@@ -113,13 +120,22 @@ def make_metatab_file(template='metatab'):
 
 
 
-import mimetypes
+def __getattr__(name):
+    # mime_map is built on first access, because mimetypes.init() reads the system's mime type files
+    global mime_map
+
+    if name != 'mime_map':
+        raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+    import mimetypes
+
+    mimetypes.init()
+    mime_map = {v: k.strip('.') for k, v in mimetypes.types_map.items()}
+    mime_map['application/x-zip-compressed'] = 'zip'
+    mime_map['application/vnd.ms-excel'] = 'xls'
+    mime_map['text/html'] = 'html'
 
-mimetypes.init()
-mime_map = {v: k.strip('.') for k, v in mimetypes.types_map.items()}
-mime_map['application/x-zip-compressed'] = 'zip'
-mime_map['application/vnd.ms-excel'] = 'xls'
-mime_map['text/html'] = 'html'
+    return mime_map
 
 
 # From https://gist.github.com/zdavkeos/1098474
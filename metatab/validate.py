@@ -0,0 +1,163 @@
+# Copyright (c) 2017 Civic Knowledge. This file is licensed under the terms of the
+# Revised BSD License, included in this distribution as LICENSE
+
+"""
+Validate documents against their declarations.
+
+A Validator is compiled from the declared terms and sections of a declaration, into a table of rules indexed by
+the qualified term name, and checks a document in one pass over its terms. The checks are:
+
+* undeclared_term: The term is not declared, or for a child term, is not one of the args of its section. A warning
+* undeclared_section: The section is not declared. A warning
+* wrong_section: The term is declared in a different section. A warning
+* value_set: The term's value is not one of the values of its declared value set
+* multiple_values: A term with a ChildPropertyType of scalar appears more than once in its parent
+* required: A term with 'required' in its declared Options does not appear in the document
+
+Validate a document with the declarations it loaded:
+
+    for finding in validate(doc):
+        print(finding.as_dict())
+
+"""
+
+from collections import namedtuple
+
+ERROR = 'error'
+WARNING = 'warning'
+
+# Terms that control parsing, rather than carrying metadata
+SPECIAL_TERMS = frozenset(['root.root', 'root.section', 'root.declare', 'root.include', 'root.header'])
+
+
+class Finding(namedtuple('Finding', 'severity code message term file row col')):
+    """A problem found by validating a document"""
+
+    __slots__ = ()
+
+    def as_dict(self):
+        return dict(self._asdict())
+
+
+# The rules for a declared term. section is the lowercased name of the section the term is declared in, values is
+# a frozenset of the lowercased values of its value set, or None, and scalar and required are booleans
+TermRule = namedtuple('TermRule', 'section values scalar required')
+
+
+class Validator(object):
+    """Validate documents against a declaration"""
+
+    def __init__(self, terms, sections, term_sections=None):
+        """
+        :param terms: Declared terms, keyed by the lowercased qualified term name, as in MetatabDoc.decl_terms
+        :param sections: Declared sections, keyed by the lowercased section name, as in MetatabDoc.decl_sections
+        :param term_sections: The section each term belongs in. Defaults to the first section that lists it
+        """
+        from .terms import Term
+
+        if term_sections is None:
+            term_sections = {}
+
+            for section_name, section in sections.items():
+                for term_name in section['terms']:
+                    term_sections.setdefault(Term.normalize_term(term_name), section_name)
+
+        self.sections = frozenset(sections)
+        self.section_args = {section_name: frozenset(a.lower() for a in section['args'])
+                             for section_name, section in sections.items()}
+        self.rules = {}
+
+        for term_name, td in terms.items():
+            values = td.get('values') if td.get('valuesetname') else None
+            options = [o.strip().lower() for o in td.get('options', '').split(',')]
+
+            self.rules[term_name] = TermRule(
+                term_sections.get(term_name),
+                frozenset(str(v).lower() for v in values) if values else None,
+                td.get('childpropertytype') == 'scalar',
+                'required' in options)
+
+        self.required = tuple(term_name for term_name, rule in self.rules.items() if rule.required)
+
+    @classmethod
+    def from_doc(cls, doc):
+        """Return a Validator for the declarations loaded into a document"""
+        return cls(doc.decl_terms, doc.decl_sections)
+
+    @classmethod
+    def from_declaration(cls, decl, cache=None):
+        """Return a Validator for a declaration, loaded with get_declaration()"""
+        from .doc import get_declaration
+
+        d = get_declaration(decl, cache=cache)
+
+        return cls(d['terms'], d['sections'], d['term_sections'])
+
+    def validate(self, doc):
+        """Return a list of Findings for a document"""
+        from .terms import SectionTerm
+
+        findings = []
+        rules = self.rules
+        section_args = self.section_args
+        check_declared = bool(rules)
+        seen = set()
+        scalar_counts = {}
+
+        def finding(severity, code, message, t):
+            findings.append(Finding(severity, code, message, t.join_lc, t.file_name, t.row, t.col))
+
+        for t in doc.all_terms:
+
+            if isinstance(t, SectionTerm):
+                if check_declared and t.name.lower() not in self.sections:
+                    finding(WARNING, 'undeclared_section', "Section '{}' is not declared".format(t.name), t)
+                continue
+
+            term_name = t.join_lc
+
+            if term_name in SPECIAL_TERMS:
+                continue
+
+            try:
+                rule = rules[term_name]
+            except KeyError:
+                if check_declared and not (t.parent_term_lc != 'root' and t.section is not None and
+                                           t.record_term_lc in section_args.get(t.section.name.lower(), ())):
+                    finding(WARNING, 'undeclared_term', "Term '{}' is not declared".format(t.join), t)
+                continue
+
+            seen.add(term_name)
+
+            if rule.section and t.parent_term_lc == 'root' and t.section is not None \
+                    and t.section.name.lower() != rule.section:
+                finding(WARNING, 'wrong_section', "Term '{}' is in section '{}', but is declared in '{}'"
+                        .format(t.join, t.section.name, rule.section), t)
+
+            if rule.values is not None and t.value is not None and str(t.value).lower() not in rule.values:
+                finding(ERROR, 'value_set', "Value '{}' of term '{}' is not in its value set"
+                        .format(t.value, t.join), t)
+
+            if rule.scalar:
+                key = (id(t.parent), term_name)
+                scalar_counts[key] = n = scalar_counts.get(key, 0) + 1
+
+                if n == 2:
+                    finding(ERROR, 'multiple_values', "Term '{}' is scalar, but appears more than once in '{}'"
+                            .format(t.join, t.parent.join if t.parent is not None else 'root'), t)
+
+        for term_name in self.required:
+            if term_name not in seen:
+                findings.append(Finding(ERROR, 'required', "Required term '{}' is missing".format(term_name),
+                                        term_name, None, None, None))
+
+        return findings
+
+
+def validate(doc, validator=None):
+    """Return a list of Findings for a document, with a Validator, or one for the document's declarations"""
+
+    if validator is None:
+        validator = Validator.from_doc(doc)
+
+    return validator.validate(doc)
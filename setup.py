@@ -30,7 +30,7 @@ setup(
     version='0.8.2',
     description='Data format for storing structured data in spreadsheet tables',
     long_description=readme,
-    packages=['metatab','metatab.templates', 'metatab.test', 'metatab.test.test-data'],
+    packages=['metatab', 'metatab.benchmark', 'metatab.templates', 'metatab.test', 'metatab.test.test-data'],
 
     package_data={
         '': ['*.csv','*.json','*.txt','*.ipynb',''],
@@ -47,7 +47,8 @@ setup(
 
     entry_points={
         'console_scripts': [
-            'metatab=metatab.cli:metatab'
+            'metatab=metatab.cli:metatab',
+            'metatab-client=metatab.server:client'
         ],
 
         'appurl.urls': [
@@ -55,8 +56,9 @@ setup(
         ],
 
         'rowgenerators': [
-            "metatab+.txt =  metatab.rowgenerators:TextRowGenerator",
-            ".yaml =  metatab.rowgenerators:YamlMetatabSource"
+            "metatab+.txt =  metatab.rowgen:TextRowGenerator",
+            ".yaml =  metatab.rowgen:YamlMetatabSource",
+            ".json =  metatab.rowgen:JsonMetatabSource"
         ]
     },
 